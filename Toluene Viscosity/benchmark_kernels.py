@@ -0,0 +1,349 @@
+# --------------------------------------------------------------------------------------------
+
+# Speed and accuracy benchmark of the viscosity kernels.
+
+# A synthetic pressure tensor is generated for every requested length: all shear stresses
+# used by the Einstein and Green-Kubo relations are stationary Ornstein-Uhlenbeck processes
+# with the same auto-correlation function sigma^2 exp(-t/tau), so the exact viscosity is
+# V sigma^2 tau / kBT (sigma is chosen to give --viscosity). Each kernel is timed (best of
+# --repeat runs, throughput in steps/s), its peak memory is traced with tracemalloc (NumPy
+# and Python allocations) and its result is compared with a reference implementation:
+
+#   acf / green_kubo / batch_acf   the original per-component acf() of viscosity_calculation.py
+#   einstein                       integrate.cumulative_trapezoid of the full series
+#   einstein_multiple              explicit average over all time origins at a few lags
+#   aggregate                      NumPy mean, std, min and max of the trajectory matrix
+#   stress_readers                 fixtures/stress_tensor.csv, read by every reader of stress_readers.py
+#                                  from the file in its own format in fixtures/ (run once, not per length)
+
+# The run fails (exit code 1) if any kernel deviates from its reference by more than --rtol
+# of the largest reference value and, for kernels returning viscosities, by more than --atol
+# in mPa.s, so faster engines cannot silently change the published results. (The FFT mean
+# squared displacement of einstein_multiple loses a few digits at the shortest lags, where
+# the viscosity is tiny, which only the absolute tolerance accepts.) The deviation from the
+# exact viscosity is only reported: it is statistical noise.
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+import functools
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from scipy import integrate, signal
+from scipy.constants import Boltzmann
+import viscosity_calculation as vc
+from correlation import batch_acf, shear_components, fft_backends, scipy_fft
+from ensemble_stats import update_aggregate
+from viscosity_io import write_table
+from pressure_io import read_pressure_tensor, expected_columns, conversion_factors, PressureDataError
+import stress_readers
+
+# Kernels that can be benchmarked; batch_acf, green_kubo and einstein_multiple are run with every FFT backend
+kernels = ['acf', 'batch_acf', 'green_kubo', 'einstein', 'einstein_multiple', 'aggregate', 'stress_readers']
+
+# Number of lags at which the multiple-origin Einstein viscosity is checked by brute force
+check_lags = 20
+
+# The same pressure tensor in every supported format; stress_tensor.csv (in atm) is the reference
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Pressure unit of the fixtures of a reader, if not atm
+fixture_units = {"xvg": "bar"}
+
+
+def parser(argv=None):
+    available = [backend for backend in fft_backends if backend != 'scipy' or scipy_fft is not None]
+    parser = argparse.ArgumentParser(description='Time the viscosity kernels on synthetic data and check them against reference implementations.')
+    parser.add_argument('-s', '--steps', type=int, nargs='+', default=[10**4, 10**5, 10**6],
+                        help='Lengths of the synthetic pressure tensor series. Default is 1e4 1e5 1e6.')
+    parser.add_argument('-k', '--kernels', nargs='+', choices=kernels, default=kernels,
+                        help='Kernels to benchmark. Default is all.')
+    parser.add_argument('--fft-backends', nargs='+', choices=fft_backends, default=available,
+                        help='FFT backends of the FFT-based kernels. Default is: ' + ' '.join(available) + '.')
+    parser.add_argument('-t', '--timestep', type=float, default=0.002, help='Timestep in [ps]. Default is 0.002.')
+    parser.add_argument('-T', '--temperature', type=float, default=298, help='Temperature in [K]. Default is 298.')
+    parser.add_argument('-v', '--volume', type=float, default=141930.761, help='Volume in [A^3]. Default is 141930.761.')
+    parser.add_argument('--tau', type=float, default=0.2,
+                        help='Correlation time of the shear stresses in [ps]. Default is 0.2.')
+    parser.add_argument('--viscosity', type=float, default=0.5,
+                        help='Exact viscosity of the synthetic data in [mPa.s]. Default is 0.5.')
+    parser.add_argument('-e', '--each', type=int, default=100,
+                        help='Interval of the saved Einstein points and aggregated rows. Default is 100.')
+    parser.add_argument('--max-lag', type=int, default=None,
+                        help='Maximum lag of the multiple-origin Einstein viscosity. Default is half of the steps.')
+    parser.add_argument('--trajectories', type=int, default=20,
+                        help='Number of trajectory files of the aggregation benchmark. Default is 20.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timed runs per kernel (best is kept). Default is 3.')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='Do not measure the peak memory (one extra run per kernel).')
+    parser.add_argument('--rtol', type=float, default=1e-9,
+                        help='Largest accepted deviation from the reference, relative to the largest reference value. '
+                             'Default is 1e-9.')
+    parser.add_argument('--atol', type=float, default=1e-6,
+                        help='Largest accepted absolute deviation of viscosities from the reference in [mPa.s]. '
+                             'Default is 1e-6.')
+    parser.add_argument('--seed', type=int, default=12345, help='Seed of the synthetic data. Default is 12345.')
+    parser.add_argument('-o', '--output', default=None, help='Also save the results to this CSV file.')
+    return parser.parse_args(argv)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ornstein_uhlenbeck(rng, n, steps, timestep, tau, sigma):
+    '''n independent stationary Ornstein-Uhlenbeck series of shape (n, steps) with ACF sigma^2 exp(-t/tau).'''
+    phi = np.exp(-timestep / tau)
+    start = sigma * rng.standard_normal((n, 1))
+    noise = rng.standard_normal((n, steps))
+    return signal.lfilter([sigma * np.sqrt(1 - phi**2)], [1, -phi], noise, axis=-1, zi=phi * start)[0]
+
+
+def synthetic_pressure_tensor(steps, timestep, tau, sigma, seed=12345, pressure=1e5):
+    '''
+    (6, steps) pressure tensor [Pa]: Pxy, Pxz, Pyz, (Pxx-Pyy)/2, (Pyy-Pzz)/2 and (Pxx-Pzz)/2 all have
+    the ACF sigma^2 exp(-t/tau); an isotropic pressure fluctuation cancels in the shear combinations.
+    '''
+    rng = np.random.default_rng(seed)
+    u, w, isotropic, Pxy, Pxz, Pyz = ornstein_uhlenbeck(rng, 6, steps, timestep, tau, sigma)
+
+    P = np.empty((6, steps))
+    P[1] = pressure + isotropic
+    P[0] = P[1] + 2*u                    # (Pxx - Pyy)/2 = u
+    P[2] = P[1] + u - np.sqrt(3)*w       # (Pyy - Pzz)/2 = -u/2 + sqrt(3)/2 w
+    P[3:] = Pxy, Pxz, Pyz
+    return P
+
+
+def shear_sigma(viscosity, tau, temperature, volume):
+    '''Standard deviation [Pa] of the shear stresses giving the viscosity [Pa.s] for correlation time tau [ps].'''
+    return np.sqrt(viscosity * Boltzmann * temperature / (volume * 1e-30 * tau * 1e-12))
+
+
+def exact_green_kubo(t, viscosity, tau):
+    return viscosity * (1 - np.exp(-t / tau))
+
+
+def exact_einstein(t, viscosity, tau):
+    return viscosity * (1 - tau / t * (1 - np.exp(-t / tau)))
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Reference implementations (straightforward, unoptimized formulas)
+def reference_einstein(P, timestep, temperature, volume, points):
+    Pxx, Pyy, Pzz, Pxy, Pxz, Pyz = P
+    integrals = integrate.cumulative_trapezoid(y=[Pxy, Pxz, Pyz, (Pxx - Pyy) / 2, (Pyy - Pzz) / 2],
+                                               dx=timestep * 1e-12, axis=1)
+    integral = np.mean(integrals**2, axis=0)
+    Time = vc.time_axis(P.shape[1], timestep)[1:]
+    viscosity = integral * (volume * 1e-30) / (2 * Boltzmann * temperature * Time * 1e-12)
+    return viscosity[points - 1]
+
+
+def reference_einstein_multiple(P, timestep, temperature, volume, lags):
+    Pxx, Pyy, Pzz, Pxy, Pxz, Pyz = P
+    G = integrate.cumulative_trapezoid(y=[Pxy, Pxz, Pyz, (Pxx - Pyy) / 2, (Pyy - Pzz) / 2],
+                                       dx=timestep * 1e-12, axis=1, initial=0)
+    msd = np.array([np.mean((G[:, m:] - G[:, :-m])**2) for m in lags])
+    return msd * (volume * 1e-30) / (2 * Boltzmann * temperature * lags * timestep * 1e-12)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def measure(function, repeat, memory):
+    '''Best wall time [s] over `repeat` calls, the result of the last call and the peak traced memory [bytes].'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    peak = np.nan
+    if memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(times), result, peak
+
+
+def deviation(values, reference):
+    '''(maximum absolute deviation, the same relative to the largest absolute reference value)'''
+    values, reference = np.asarray(values, dtype=float), np.asarray(reference, dtype=float)
+    difference = np.max(np.abs(values - reference))
+    return difference, difference / np.max(np.abs(reference))
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def make_row(args, steps, kernel, backend, elapsed, items, unit, peak, difference, relative,
+             estimate=np.nan, expected=np.nan):
+    '''Print and return one result; difference is the maximum deviation from the reference in [mPa.s] (NaN for the ACF kernels).'''
+    row = {"steps": steps, "kernel": kernel, "backend": backend, "time(s)": elapsed,
+           "throughput": items / elapsed, "unit": unit, "peak_memory(MB)": peak / 1024**2,
+           "max_diff(mPa.s)": difference, "rel_diff": relative,
+           "passed": bool(relative <= args.rtol or difference <= args.atol),
+           "viscosity(mPa.s)": estimate * 1000, "exact(mPa.s)": expected * 1000}
+    print(f"  {kernel:<18}{backend:<7}{elapsed:>10.4f} s{items / elapsed:>12.3g} {unit:<9}"
+          f"{row['peak_memory(MB)']:>9.1f} MB   rel. diff {relative:.1e}  diff {difference:.1e} mPa.s  "
+          f"{'ok' if row['passed'] else 'FAILED'}")
+    return row
+
+
+def aggregate_benchmark(args, curves, time_ps, result_row):
+    '''Time update_aggregate() rebuilding the statistics of `curves` written as trajectory CSV files.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, values in enumerate(curves):
+            output_dir = os.path.join(tmp, f"NVT{i + 1}_stress_tensor_data")
+            os.makedirs(output_dir)
+            write_table(os.path.join(output_dir, "viscosity_GK"), {"time(ps)": time_ps, "viscosity(Pa.s)": values})
+
+        elapsed, (stats, _, _), peak = measure(lambda: update_aggregate("GK", tmp, tmp, rebuild=True),
+                                               args.repeat, args.memory)
+
+    reference = np.concatenate([curves.mean(axis=0), curves.std(axis=0, ddof=1), curves.min(axis=0), curves.max(axis=0)])
+    values = np.concatenate([stats.mean, stats.std(), stats.min, stats.max])
+    difference, relative = deviation(values, reference)
+    return result_row("aggregate", "-", elapsed, curves.size, "values/s", peak, difference * 1000, relative)
+
+
+def stress_readers_benchmark(args):
+    '''
+    Read the fixture of every registered reader and compare it with fixtures/stress_tensor.csv [Pa].
+    A reader without a fixture, or whose fixture cannot be read, fails.
+    '''
+    table = pd.read_csv(os.path.join(fixtures_dir, "stress_tensor.csv"))
+    reference = table[expected_columns].values.T * conversion_factors['atm']
+    steps = reference.shape[1]
+    print(f"\nfixtures/ ({steps} rows), stress_readers.py against stress_tensor.csv")
+
+    # Fixtures by the reader pressure_io would choose for them
+    fixtures = {name: [] for name in stress_readers.readers()}
+    for file in sorted(os.listdir(fixtures_dir)):
+        path = os.path.join(fixtures_dir, file)
+        try:
+            fixtures[stress_readers.reader_for(path).name].append(path)
+        except PressureDataError:
+            continue
+
+    rows = []
+    for name, paths in fixtures.items():
+        if not paths:
+            print(f"  No fixture for the {name} reader in {fixtures_dir}")
+            rows.append(make_row(args, steps, "stress_readers", name, np.nan, 0, "rows/s", np.nan, np.nan, np.inf))
+
+        for path in paths:
+            unit = fixture_units.get(name, 'atm')
+            try:
+                # One row more than the reference, so that extra rows are noticed
+                elapsed, P, peak = measure(lambda: read_pressure_tensor(path, steps + 1, unit=unit),
+                                           args.repeat, args.memory)
+            except PressureDataError as e:
+                print(f"  {os.path.basename(path)}: {e}")
+                rows.append(make_row(args, steps, "stress_readers", f"{name} ({os.path.basename(path)})", np.nan, 0,
+                                     "rows/s", np.nan, np.nan, np.inf))
+                continue
+            if P.shape != reference.shape:
+                print(f"  {os.path.basename(path)}: {P.shape[1]} rows instead of {steps}")
+                relative = np.inf
+            else:
+                relative = deviation(P, reference)[1]
+            rows.append(make_row(args, steps, "stress_readers", f"{name} ({os.path.basename(path)})", elapsed,
+                                 P.shape[1], "rows/s", peak, np.nan, relative))
+    return rows
+
+
+def run(args):
+    exact = args.viscosity / 1000
+    sigma = shear_sigma(exact, args.tau, args.temperature, args.volume)
+    physical = (args.timestep, args.temperature, args.volume)
+    rows = []
+
+    for steps in args.steps:
+        P = synthetic_pressure_tensor(steps, args.timestep, args.tau, sigma, args.seed)
+        Time = vc.time_axis(steps, args.timestep)
+        # Running integrals are compared with the exact viscosity at 20 tau (or the longest lag available)
+        t_check = min(20 * args.tau, Time[steps//2 - 1])
+        row_check = int(round(t_check / args.timestep))
+        print(f"\n{steps} steps ({steps * args.timestep:g} ps), exact viscosity {args.viscosity:g} mPa.s")
+
+        result_row = functools.partial(make_row, args, steps)
+
+        # Reference Green-Kubo: per-component acf() as in the original code
+        shear = shear_components(P, True)
+        elapsed, reference_acf, peak = measure(lambda: np.mean([vc.acf(row) for row in shear], axis=0),
+                                               args.repeat, args.memory and 'acf' in args.kernels)
+        reference_gk = vc.green_kubo_integral(reference_acf, *physical)
+        if 'acf' in args.kernels:
+            rows.append(result_row("acf", "numpy", elapsed, steps, "steps/s", peak, np.nan, 0.0,
+                                   reference_gk[row_check], exact_green_kubo(t_check, exact, args.tau)))
+
+        for backend in args.fft_backends:
+            if 'batch_acf' in args.kernels:
+                elapsed, avg_acf, peak = measure(lambda: batch_acf(shear_components(P, True), average=True, backend=backend),
+                                                 args.repeat, args.memory)
+                rows.append(result_row("batch_acf", backend, elapsed, steps, "steps/s", peak,
+                                       np.nan, deviation(avg_acf, reference_acf)[1]))
+
+            if 'green_kubo' in args.kernels:
+                elapsed, (_, viscosity_gk), peak = measure(lambda: vc.green_kubo(P, *physical, fft_backend=backend),
+                                                           args.repeat, args.memory)
+                difference, relative = deviation(viscosity_gk, reference_gk)
+                rows.append(result_row("green_kubo", backend, elapsed, steps, "steps/s", peak, difference * 1000,
+                                       relative, viscosity_gk[row_check], exact_green_kubo(t_check, exact, args.tau)))
+
+            if 'einstein_multiple' in args.kernels:
+                max_lag = steps//2 if args.max_lag is None else min(args.max_lag, steps - 1)
+                points = vc.einstein_points(max_lag, args.each)
+                elapsed, viscosity, peak = measure(
+                    lambda: vc.einstein_multiple_origins(P, *physical, points, max_lag, fft_backend=backend),
+                    args.repeat, args.memory)
+                lags = np.unique(np.linspace(1, max_lag, check_lags).astype(int))
+                reference = reference_einstein_multiple(P, *physical, lags)
+                checked = vc.einstein_multiple_origins(P, *physical, lags, max_lag, fft_backend=backend)
+                difference, relative = deviation(checked, reference)
+                i = min(np.searchsorted(points, row_check), len(points) - 1)
+                rows.append(result_row("einstein_multiple", backend, elapsed, steps, "steps/s", peak, difference * 1000,
+                                       relative, viscosity[i], exact_einstein(points[i] * args.timestep, exact, args.tau)))
+
+        if 'einstein' in args.kernels:
+            points = vc.einstein_points(steps - 1, args.each)
+            elapsed, viscosity, peak = measure(lambda: vc.einstein(P, *physical, points), args.repeat, args.memory)
+            difference, relative = deviation(viscosity, reference_einstein(P, *physical, points))
+            rows.append(result_row("einstein", "-", elapsed, steps, "steps/s", peak, difference * 1000, relative,
+                                   viscosity[-1], exact_einstein(Time[-1], exact, args.tau)))
+
+        if 'aggregate' in args.kernels:
+            # Noisy copies of the reference Green-Kubo curve on the saved time grid
+            rng = np.random.default_rng(args.seed)
+            curve = reference_gk[::args.each]
+            curves = curve * (1 + 0.1 * rng.standard_normal((args.trajectories, 1))) \
+                + 0.01 * exact * rng.standard_normal((args.trajectories, len(curve)))
+            rows.append(aggregate_benchmark(args, curves, Time[:len(reference_gk):args.each], result_row))
+
+        del P, shear
+
+    if 'stress_readers' in args.kernels:
+        rows.extend(stress_readers_benchmark(args))
+
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    args = parser(argv)
+    results = run(args)
+
+    if args.output:
+        results.to_csv(args.output, index=False)
+        print(f"\nResults saved to {args.output}")
+
+    failed = results[~results["passed"]]
+    if len(failed):
+        print("\nKernels deviating from their reference: " +
+              ", ".join(f"{row.kernel} ({row.backend}, {row.steps} steps)" for row in failed.itertuples()))
+        sys.exit(1)
+    print("\nAll kernels agree with their reference implementations.")
+
+
+if __name__ == "__main__":
+    main()
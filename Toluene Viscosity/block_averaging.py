@@ -0,0 +1,379 @@
+# --------------------------------------------------------------------------------------------
+
+# Statistical error of one trajectory by Flyvbjerg-Petersen block averaging, streamed.
+
+# The standard error of the mean of a correlated series follows from the variance of the
+# means of ever longer blocks: the series is repeatedly halved by averaging neighbouring
+# pairs, and once the blocks are longer than the correlation time the estimate
+# sqrt(var(block means) / blocks) stops growing. BlockAverager keeps, for every halving
+# level, only the running sums needed for the mean, variance and lag-1 covariance, plus one
+# unpaired value, so a series of N samples fed in chunks costs O(N) time and O(log N)
+# memory. The plateau level is chosen with the automatic criterion of Jonsson
+# (Phys. Rev. E 98, 043304, 2018): the first level from which the lag-1 correlations of all
+# coarser levels are consistent with zero (chi-squared test at 99 %).
+
+# Block averaging is applied to
+#   - the six stress components [Pa],
+#   - the Green-Kubo and Einstein running integrals at the lags --lags [ps], written as
+#     averages over time origins t0 of per-origin samples
+#       GK:       V/kBT * sigma(t0) * (G(t0 + t) - G(t0))
+#       Einstein: V/(2 kBT t) * (G(t0 + t) - G(t0))^2
+#     (G the running integral of the shear stress sigma, averaged over the shear components
+#     used by green_kubo() and einstein()), whose mean over t0 is the viscosity at lag t.
+# The samples are streamed with a history of the last max(--lags) steps only.
+
+# For each quantity the statistical inefficiency g = N * error^2 / variance gives the
+# decorrelation time g * timestep between effectively independent samples. With --target
+# the numbers of steps, or of trajectories of the same length, needed for that relative
+# error of the viscosities are printed.
+
+# Output: Viscosity_Data/<trajectory>_data/block_averaging.csv (one row per quantity) and
+# block_levels.csv (standard error at every block size, the Flyvbjerg-Petersen curves).
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import numpy as np
+from scipy.constants import Boltzmann
+from pressure_io import iter_pressure_tensor, PressureDataError, expected_columns, default_chunk_size, \
+    default_cache_dir
+from correlation import shear_components
+from viscosity_calculation import output_directory
+from viscosity_io import write_table, output_formats
+from instrumentation import stage, profile_run, enable as enable_profiling
+
+# Lags [ps] of the running integrals analysed by default
+default_lags = [1.0, 5.0, 10.0]
+
+# Confidence level of the plateau test
+confidence = 0.99
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def parser(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Standard errors and decorrelation times of one trajectory by streaming block averaging.'
+    )
+    parser.add_argument('datafiles', nargs='+',
+                        help='Pressure tensor files (CSV or a format of stress_readers.py); each is analysed separately.')
+    parser.add_argument('-u', '--unit', default='atm', choices=['Pa', 'atm', 'bar', 'GPa'],
+                        help='Unit of the provided pressure data. Default is atm.')
+    parser.add_argument('-s', '--steps', type=int, default=None,
+                        help='Number of steps (rows) to read. Default is the whole file.')
+    parser.add_argument('-t', '--timestep', type=float, required=True,
+                        help='Physical timestep between two successive pressure data points in [ps].')
+    parser.add_argument('-T', '--temperature', type=float, required=True,
+                        help='Temperature of the MD simulation in [K].')
+    parser.add_argument('-v', '--volume', type=float, required=True,
+                        help='Volume of the simulation box in [A^3].')
+    parser.add_argument('-d', '--diag', action='store_false',
+                        help='Do not use the diagonal elements of the pressure tensor for Green-Kubo.')
+    parser.add_argument('--lags', type=float, nargs='+', default=default_lags,
+                        help='Times [ps] at which the errors of the running GK and Einstein viscosities are estimated. '
+                             'Default is: ' + ' '.join(f"{lag:g}" for lag in default_lags) + '.')
+    parser.add_argument('--target', type=float, default=None,
+                        help='Relative standard error of the viscosities to plan for, e.g. 0.05.')
+    parser.add_argument('--chunk-size', type=int, default=default_chunk_size,
+                        help=f'Number of rows read at a time. Default is {default_chunk_size}.')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='Always parse the CSV file instead of using the binary pressure tensor cache.')
+    parser.add_argument('--cache-dir', default=default_cache_dir,
+                        help=f'Directory of the binary pressure tensor cache. Default is {default_cache_dir}.')
+    parser.add_argument('--output-format', choices=output_formats, default='csv',
+                        help='Format of the output tables. Default is csv.')
+    parser.add_argument('-p', '--plot', action='store_true', help='Plot the Flyvbjerg-Petersen curves.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write a timing and memory report of each stage to Profiles/ (same as setting VISCO_PROFILE=1).')
+    args = parser.parse_args(argv)
+
+    if any(lag <= 0 for lag in args.lags):
+        parser.error("--lags must be positive.")
+    return args
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+class _Level:
+    '''Running sums of the series at one halving level, and its value still waiting for a partner.'''
+
+    def __init__(self, channels):
+        self.count = 0
+        self.sum = np.zeros(channels)
+        self.sum_squares = np.zeros(channels)
+        self.sum_lag = np.zeros(channels)
+        self.first = np.zeros(channels)
+        self.last = np.zeros(channels)
+        self.pending = None
+
+    def update(self, x):
+        '''Add the samples x (channels, n); returns the block means passed to the next level.'''
+        if self.count == 0:
+            self.first = x[:, 0].copy()
+        else:
+            self.sum_lag += self.last * x[:, 0]
+        self.sum_lag += np.einsum("ij,ij->i", x[:, :-1], x[:, 1:])
+        self.sum += x.sum(axis=1)
+        self.sum_squares += np.einsum("ij,ij->i", x, x)
+        self.count += x.shape[1]
+        self.last = x[:, -1].copy()
+
+        if self.pending is not None:
+            x = np.concatenate([self.pending, x], axis=1)
+        pairs = x.shape[1] // 2
+        self.pending = x[:, 2 * pairs:].copy() if x.shape[1] % 2 else None
+        return 0.5 * (x[:, 0:2 * pairs:2] + x[:, 1:2 * pairs:2])
+
+    def moments(self):
+        '''Mean, variance and lag-1 autocovariance (both normalised by the count) of the level.'''
+        n = self.count
+        mean = self.sum / n
+        variance = np.maximum(self.sum_squares / n - mean**2, 0.0)
+        covariance = (self.sum_lag - mean * (2 * self.sum - self.first - self.last) + (n - 1) * mean**2) / n
+        return mean, variance, covariance
+
+
+class BlockAverager:
+    '''
+    Streaming Flyvbjerg-Petersen block averaging of `channels` series at once. update() takes
+    chunks of shape (channels, n) in order; the levels of block sizes 1, 2, 4, ... are filled
+    on the fly. The samples are shifted by the mean of the first chunk to limit cancellation.
+    '''
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.levels = []
+        self.shift = None
+
+    @property
+    def count(self):
+        return self.levels[0].count if self.levels else 0
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(self.channels, -1)
+        if x.shape[1] == 0:
+            return
+        if self.shift is None:
+            self.shift = x.mean(axis=1, keepdims=True)
+        x = x - self.shift
+
+        level = 0
+        while x.shape[1] > 0:
+            if level == len(self.levels):
+                self.levels.append(_Level(self.channels))
+            x = self.levels[level].update(x)
+            level += 1
+
+    def curves(self):
+        '''
+        (block sizes, standard error of the mean at each level (levels, channels), its
+        uncertainty, and the Jonsson statistic of each level); levels of at least two blocks.
+        '''
+        levels = [level for level in self.levels if level.count >= 2]
+        counts = np.array([level.count for level in levels], dtype=float)
+        moments = [level.moments() for level in levels]
+        variance = np.array([m[1] for m in moments])
+        covariance = np.array([m[2] for m in moments])
+
+        error = np.sqrt(variance / (counts[:, None] - 1))
+        error_error = error / np.sqrt(2 * (counts[:, None] - 1))
+
+        # M_j = sum over levels i >= j of n_i ((n_i - 1) var_i / n_i^2 + cov_i)^2 / var_i^2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = counts[:, None] * ((counts[:, None] - 1) * variance / counts[:, None]**2 + covariance)**2 \
+                / variance**2
+        terms = np.nan_to_num(terms)
+        statistic = np.cumsum(terms[::-1], axis=0)[::-1]
+        return 2.0 ** np.arange(len(levels)), error, error_error, statistic
+
+    def estimate(self):
+        '''
+        (mean, standard error, its uncertainty, plateau level, converged) per channel. Where no
+        level passes the plateau test the largest error of all levels is returned, unconverged.
+        '''
+        from scipy.stats import chi2
+
+        mean = self.levels[0].sum / self.count + self.shift[:, 0]
+        _, error, error_error, statistic = self.curves()
+        levels = len(error)
+        threshold = chi2.ppf(confidence, levels - np.arange(levels))[:, None]
+        passed = statistic < threshold
+
+        converged = passed.any(axis=0)
+        level = np.where(converged, np.argmax(passed, axis=0), np.argmax(error, axis=0))
+        channels = np.arange(self.channels)
+        return mean, error[level, channels], error_error[level, channels], level, converged
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+class OriginSamples:
+    '''
+    Per-origin samples of the Green-Kubo and Einstein viscosities at the lags `lags` (steps)
+    from a stream of (6, n) pressure tensor blocks in [Pa]. update() returns, for every lag,
+    a (2, origins) array (GK, Einstein) of the origins completed by the block; only the last
+    max(lags) steps of the shear stresses and their running integrals are kept.
+    '''
+
+    def __init__(self, lags, timestep, temperature, volume, diag=True):
+        self.lags = list(lags)
+        self.diag = diag
+        self.timestep_sec = timestep * 1e-12
+        self.scale = (volume * 1e-30) / (Boltzmann * temperature)
+        self.history = max(self.lags)
+        self.shear = None       # (6, history) shear stresses of the last steps
+        self.integral = None    # (6, history) running integrals G at the same steps
+
+    def update(self, P):
+        shear = shear_components(P, True)
+
+        # Trapezoid running integral, continued from the last step of the previous block
+        if self.shear is None:
+            steps = np.concatenate([np.zeros((6, 1)), (shear[:, :-1] + shear[:, 1:]) / 2], axis=1)
+            integral = np.cumsum(steps * self.timestep_sec, axis=1)
+            held = 0
+        else:
+            previous = self.shear[:, -1:]
+            steps = (np.concatenate([previous, shear[:, :-1]], axis=1) + shear) / 2
+            integral = self.integral[:, -1:] + np.cumsum(steps * self.timestep_sec, axis=1)
+            held = self.shear.shape[1]
+            shear = np.concatenate([self.shear, shear], axis=1)
+            integral = np.concatenate([self.integral, integral], axis=1)
+
+        samples = []
+        for lag in self.lags:
+            # Origins whose end point lies in this block
+            start, end = max(0, held - lag), max(0, shear.shape[1] - lag)
+            displacement = integral[:, start + lag:end + lag] - integral[:, start:end]
+            gk_channels = 6 if self.diag else 3
+            gk = (shear[:gk_channels, start:end] * displacement[:gk_channels]).mean(axis=0) * self.scale
+            einstein = np.square(displacement[:5]).mean(axis=0) * self.scale / (2 * lag * self.timestep_sec)
+            samples.append(np.stack([gk, einstein]))
+
+        self.shear, self.integral = shear[:, -self.history:].copy(), integral[:, -self.history:].copy()
+        return samples
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def block_analysis(blocks, timestep, temperature, volume, lags=default_lags, diag=True):
+    '''
+    Block averaging of the stress components and of the GK and Einstein viscosities at the
+    times `lags` [ps] from an iterable of (6, n) pressure tensor blocks in [Pa]. Returns
+    ({quantity: {"mean", "std_error", "decorrelation_time", ...}}, {quantity: (block sizes, errors)}).
+    '''
+    lag_steps = [max(1, int(round(lag / timestep))) for lag in lags]
+    stress = BlockAverager(6)
+    viscosity = [BlockAverager(2) for _ in lag_steps]
+    origins = OriginSamples(lag_steps, timestep, temperature, volume, diag)
+
+    for block in blocks:
+        with stage("block_average"):
+            stress.update(block)
+            for averager, samples in zip(viscosity, origins.update(block)):
+                averager.update(samples)
+
+    if stress.count < 2:
+        raise PressureDataError("Error: At least two steps are needed for block averaging.")
+
+    names = [(stress, list(expected_columns))]
+    for lag, averager in zip(lag_steps, viscosity):
+        if averager.count < 2:
+            raise PressureDataError(f"Error: The trajectory is too short for the lag of {lag * timestep:g} ps.")
+        names.append((averager, [f"GK({lag * timestep:g}ps)", f"Einstein({lag * timestep:g}ps)"]))
+
+    summary, curves = {}, {}
+    for averager, quantities in names:
+        mean, error, error_error, level, converged = averager.estimate()
+        sizes, errors, _, _ = averager.curves()
+        variance = averager.levels[0].moments()[1]
+        for i, name in enumerate(quantities):
+            inefficiency = averager.count * error[i]**2 / variance[i] if variance[i] > 0 else 1.0
+            summary[name] = {"mean": mean[i], "std_error": error[i], "error_of_error": error_error[i],
+                             "block_size": 2**int(level[i]), "converged": bool(converged[i]),
+                             "inefficiency": inefficiency, "decorrelation_time": inefficiency * timestep,
+                             "samples": averager.count}
+            curves[name] = (sizes, errors[:, i])
+    return summary, curves
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def write_block_tables(summary, curves, output_dir, output_format='csv', metadata=None):
+    '''Save the summary (block_averaging) and the error of every block size (block_levels) in output_dir.'''
+    names = list(summary)
+    write_table(os.path.join(output_dir, "block_averaging"), {
+        "quantity": np.array(names),
+        "mean": [summary[name]["mean"] for name in names],
+        "std_error": [summary[name]["std_error"] for name in names],
+        "error_of_error": [summary[name]["error_of_error"] for name in names],
+        "block_size(steps)": [summary[name]["block_size"] for name in names],
+        "converged": [int(summary[name]["converged"]) for name in names],
+        "inefficiency": [summary[name]["inefficiency"] for name in names],
+        "decorrelation_time(ps)": [summary[name]["decorrelation_time"] for name in names],
+        "samples": [summary[name]["samples"] for name in names],
+    }, output_format, metadata)
+
+    # Quantities with fewer samples have fewer levels; their missing levels are NaN
+    levels = max(len(sizes) for sizes, _ in curves.values())
+    columns = {"block_size(steps)": 2.0 ** np.arange(levels)}
+    for name, (_, errors) in curves.items():
+        columns[name] = np.concatenate([errors, np.full(levels - len(errors), np.nan)])
+    write_table(os.path.join(output_dir, "block_levels"), columns, output_format, metadata)
+
+
+def print_summary(summary, steps, target=None):
+    for name, result in summary.items():
+        unit = "Pa" if name in expected_columns else "mPa.s"
+        factor = 1 if unit == "Pa" else 1000
+        note = "" if result["converged"] else "  (no plateau: trajectory too short for a reliable error)"
+        print(f"{name:>18}: {result['mean'] * factor:.5g} +/- {result['std_error'] * factor:.2g} {unit}, "
+              f"decorrelation time {result['decorrelation_time']:.3g} ps{note}")
+
+        if target and unit != "Pa" and result["mean"] != 0:
+            # The squared error falls as 1 / (steps) for one trajectory or 1 / (trajectories)
+            ratio = (result["std_error"] / (target * abs(result["mean"])))**2
+            print(f"{'':>18}  for {target:.0%}: ~{int(np.ceil(ratio * steps))} steps, "
+                  f"or {int(np.ceil(ratio))} trajectories of {steps} steps")
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def run(args, datafile):
+    print(f"\nBlock averaging of {datafile}")
+    blocks = iter_pressure_tensor(datafile, args.steps, args.unit, args.chunk_size, args.cache, args.cache_dir)
+    summary, curves = block_analysis(blocks, args.timestep, args.temperature, args.volume, args.lags, args.diag)
+
+    steps = summary[expected_columns[0]]["samples"]
+    print(f"Number of data points read: {steps}")
+    print_summary(summary, steps, args.target)
+
+    output_dir = output_directory(datafile)
+    os.makedirs(output_dir, exist_ok=True)
+    metadata = {"datafile": os.path.basename(datafile), "steps": steps, "timestep": args.timestep,
+                "temperature": args.temperature, "volume": args.volume, "unit": args.unit, "diag": args.diag,
+                "method": "block_averaging", "lags": args.lags}
+    with stage("write_outputs"):
+        write_block_tables(summary, curves, output_dir, args.output_format, metadata)
+
+    if args.plot:
+        import plotting
+        plotting.plot_block_errors(curves, summary, os.path.join(output_dir, "block_averaging.png"))
+    return summary
+
+
+def main(argv=None):
+    args = parser(argv)
+    if args.profile:
+        enable_profiling()
+
+    failed = 0
+    for datafile in args.datafiles:
+        try:
+            with profile_run("block_averaging", os.path.splitext(os.path.basename(datafile))[0]):
+                run(args, datafile)
+        except PressureDataError as e:
+            print(e)
+            failed += 1
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
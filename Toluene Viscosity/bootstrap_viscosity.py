@@ -0,0 +1,157 @@
+# --------------------------------------------------------------------------------------------
+
+# Bootstrap or jackknife uncertainty of the mean viscosity and of its double exponential
+# extrapolation over all trajectories in Viscosity_Data.
+
+# The viscosity curves are read once into a (trajectories, time) matrix X. All replicate
+# mean curves are then formed in one matrix product: bootstrap replicates are W @ X with
+# multinomial resampling weights W (one row per replicate, drawn from a seeded generator),
+# jackknife replicates leave out one trajectory each, (sum(X) - X) / (M - 1).
+# Every replicate mean curve is fitted with the double exponential up to t_cut
+# (viscosity_fits.fit_many, in a process pool), which gives a confidence interval on the
+# extrapolated viscosity A*a*T1 + A*(1-a)*T2.
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.special import ndtri
+from ensemble_stats import trajectory_files, viscosity_matrix, normalize_method, analysis_dir
+from viscosity_fits import fit_double_exponential, fit_many, double_exponential_limit, min_fit_points
+from instrumentation import stage, profile_run, set_label
+
+# Resampling schemes
+resampling_methods = ['bootstrap', 'jackknife']
+
+
+def parser(argv=None):
+    parser = argparse.ArgumentParser(description='Bootstrap/jackknife confidence interval of the extrapolated viscosity.')
+    parser.add_argument('method', nargs='?', help='GK or Einstein (asked interactively if omitted).')
+    parser.add_argument('t_cut', nargs='?', type=int, help='Row number of t_cut (asked interactively if omitted).')
+    parser.add_argument('-r', '--resampling', choices=resampling_methods, default='bootstrap',
+                        help='Resampling scheme. Default is bootstrap.')
+    parser.add_argument('-n', '--replicates', type=int, default=1000,
+                        help='Number of bootstrap replicates (jackknife: one per trajectory). Default is 1000.')
+    parser.add_argument('--seed', type=int, default=12345,
+                        help='Seed of the random number generator. Default is 12345.')
+    parser.add_argument('-c', '--confidence', type=float, default=95,
+                        help='Confidence level of the interval in percent. Default is 95.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of processes fitting the replicates. Default is the number of CPUs.')
+    args = parser.parse_args(argv)
+
+    if args.method is None:
+        args.method = input("Enter method (GK or Einstein): ")
+    args.method = normalize_method(args.method)
+    if args.t_cut is None:
+        args.t_cut = int(input("Enter t_cut row number: "))
+    return args
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def bootstrap_means(matrix, replicates, rng):
+    '''Mean curves of `replicates` bootstrap samples of the rows of matrix, shape (replicates, time).'''
+    M = len(matrix)
+    weights = rng.multinomial(M, np.full(M, 1 / M), size=replicates) / M
+    return weights @ matrix
+
+
+def jackknife_means(matrix):
+    '''Leave-one-out mean curves of the rows of matrix, shape (trajectories, time).'''
+    M = len(matrix)
+    return (matrix.sum(axis=0) - matrix) / (M - 1)
+
+
+def standard_error(replicates, resampling):
+    '''Standard error of the statistic from its replicates along axis 0.'''
+    n = len(replicates)
+    if resampling == 'jackknife':
+        return np.sqrt((n - 1) / n * np.sum((replicates - replicates.mean(axis=0))**2, axis=0))
+    return replicates.std(axis=0, ddof=1)
+
+
+def confidence_interval(estimate, replicates, resampling, confidence):
+    '''Percentile interval for the bootstrap, normal interval from the jackknife standard error.'''
+    alpha = (100 - confidence) / 2
+    if resampling == 'jackknife':
+        z = ndtri(1 - alpha / 100)
+        se = standard_error(replicates, resampling)
+        return estimate - z * se, estimate + z * se
+    return tuple(np.percentile(replicates, [alpha, 100 - alpha]))
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def main(argv=None):
+    args = parser(argv)
+    method = args.method
+    set_label(f"{method}_{args.resampling}")
+
+    with stage("read_trajectories"):
+        time, names, matrix = viscosity_matrix(trajectory_files(method))
+    if len(names) < 2:
+        print(f"At least two viscosity_{method} files are needed, found {len(names)}.")
+        return
+    time = time / 1000  # ps -> ns, as in std_{method}.csv
+    print(f"Trajectories: {len(names)}, time points: {len(time)}")
+    if not min_fit_points <= args.t_cut <= len(time):
+        print(f"Error: t_cut = row {args.t_cut} is outside the {len(time)} time points of std_{method}.csv; "
+              f"the double exponential fit needs a t_cut between {min_fit_points} and {len(time)}.")
+        sys.exit(1)
+
+    with stage("resample"):
+        if args.resampling == 'jackknife':
+            means = jackknife_means(matrix)
+        else:
+            means = bootstrap_means(matrix, args.replicates, np.random.default_rng(args.seed))
+
+    # Standard error of the mean viscosity at every time point
+    os.makedirs(analysis_dir, exist_ok=True)
+    std_file = os.path.join(analysis_dir, f"{args.resampling}_std_{method}.csv")
+    pd.DataFrame({
+        "time(ns)": time,
+        "mean_visc": matrix.mean(axis=0),
+        "std_error": standard_error(means, args.resampling),
+    }).to_csv(std_file, index=False)
+
+    # Double exponential fit of the full ensemble mean and of every replicate up to t_cut
+    fit_time = time[:args.t_cut]
+    params, converged = fit_double_exponential(fit_time, matrix[:, :args.t_cut].mean(axis=0))
+    if not converged:
+        print("The double exponential fit of the mean viscosity did not converge.")
+        return
+    estimate = double_exponential_limit(params)
+
+    with stage("fit_replicates"):
+        replicate_params, replicate_converged = fit_many(fit_time, means[:, :args.t_cut], p0=params, jobs=args.jobs)
+    replicate_limits = double_exponential_limit(replicate_params)
+
+    fit_file = os.path.join(analysis_dir, f"{args.resampling}_fits_{method}.csv")
+    pd.DataFrame({
+        "A": replicate_params[:, 0],
+        "a": replicate_params[:, 1],
+        "T1": replicate_params[:, 2],
+        "T2": replicate_params[:, 3],
+        "viscosity(Pa.s)": replicate_limits,
+        "converged": replicate_converged,
+    }).to_csv(fit_file, index=False)
+
+    valid = replicate_limits[replicate_converged]
+    if len(valid) == 0:
+        print(f"Error: The double exponential fit up to t_cut = row {args.t_cut} did not converge for any of the "
+              f"{len(replicate_limits)} {args.resampling} replicates (see {fit_file}).")
+        sys.exit(1)
+    low, high = confidence_interval(estimate, valid, args.resampling, args.confidence)
+    print(f"Fits converged: {len(valid)} of {len(replicate_limits)} {args.resampling} replicates")
+    print(f"Viscosity (t -> inf) = {estimate * 1000:.4g} mPa.s, "
+          f"standard error {standard_error(valid, args.resampling) * 1000:.2g} mPa.s")
+    print(f"{args.confidence:g}% confidence interval: [{low * 1000:.4g}, {high * 1000:.4g}] mPa.s")
+    print(f"Standard error vs time: {std_file}")
+    print(f"Replicate fits: {fit_file}")
+
+
+if __name__ == "__main__":
+    with profile_run("bootstrap_viscosity"):
+        main()
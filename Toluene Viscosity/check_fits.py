@@ -0,0 +1,82 @@
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from viscosity_fits import fit_batch, fit_many, fit_double_exponential, double_exponential, double_exponential_limit, \
+    initial_guess, min_fit_points
+from ensemble_stats import normalize_method
+
+# Number of t_cut rows checked when --rows is not given (log-spaced over the std_*.csv file)
+default_checks = 8
+
+
+def check_rows(n_rows, count=default_checks):
+    '''count log-spaced t_cut rows between 100 and n_rows.'''
+    return np.unique(np.geomspace(min(100, n_rows), n_rows, count).astype(int))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the vectorized double exponential fits of the mean viscosity '
+                                                 'against scipy curve_fit for several t_cut rows.')
+    parser.add_argument('method', help='GK or Einstein.')
+    parser.add_argument('-r', '--rows', type=int, nargs='+', help='t_cut rows to check. Default is '
+                        f'{default_checks} log-spaced rows over the whole std_*.csv file.')
+    parser.add_argument('--rtol', type=float, default=1e-4,
+                        help='Largest accepted relative deviation of the viscosity limit from curve_fit. Default is 1e-4.')
+    args = parser.parse_args(argv)
+    method = normalize_method(args.method)
+
+    data = pd.read_csv(os.path.join("Trajectory_Analysis_CSV_Files", f"std_{method}.csv"))
+    time = data["time(ns)"].values
+    visc = data["mean_visc"].values
+    rows = check_rows(len(data)) if args.rows is None else np.array(args.rows)
+    if np.any(rows < min_fit_points) or np.any(rows > len(data)):
+        parser.error(f"--rows must be between {min_fit_points} and {len(data)}, the rows of std_{method}.csv")
+
+    # Every fit starts from the curve_fit solution at the previous t_cut row, as in scan_t_cut()
+    # (the first from initial_guess), so the batch iteration is checked near real minima too
+    starts, reference = np.empty((len(rows), 4)), np.empty((len(rows), 4))
+    start = np.array(initial_guess, dtype=float)
+    for i, row in enumerate(rows):
+        starts[i] = start
+        reference[i], converged = fit_double_exponential(time[:row], visc[:row], start)
+        if converged:
+            start = reference[i]
+
+    # fit_batch alone (unconverged fits are NaN) and fit_many with its curve_fit fallback,
+    # all t_cut rows in one batch as in the bootstrap
+    curves = np.broadcast_to(visc, (len(rows), len(visc)))
+    batch, batch_converged = fit_batch(time, curves, starts, n_points=rows)
+    combined, _ = fit_many(time, curves, starts, n_points=rows)
+
+    def sum_of_squares(p, row):
+        return np.sum((double_exponential(time[:row], *p) - visc[:row])**2)
+
+    failed = False
+    print(f"{'t_cut row':>10}{'curve_fit':>14}{'fit_batch':>14}{'fit_many':>14}  [mPa.s]  status")
+    for row, p_reference, p_batch, ok, p_many in zip(rows, reference, batch, batch_converged, combined):
+        expected = double_exponential_limit(p_reference)
+        limits = double_exponential_limit(np.array([p_batch, p_many]))
+
+        # A batch fit that did not converge is left to the fallback and only fit_many is compared.
+        # Where the data do not determine the limit (e.g. a time constant far beyond t_cut) a fit
+        # with the same sum of squares as curve_fit is as good and also accepted
+        compared = [p_batch, p_many] if ok else [p_many]
+        status = "ok" if ok else "ok (fallback)"
+        for p in compared:
+            if np.isclose(double_exponential_limit(p), expected, rtol=args.rtol, atol=0, equal_nan=True):
+                continue
+            if sum_of_squares(p, row) <= sum_of_squares(p_reference, row) * (1 + args.rtol):
+                status = "ok (flat)"
+            else:
+                status = "DIFFERS"
+                break
+        failed |= status == "DIFFERS"
+        print(f"{row:>10d}{expected * 1000:>14.6g}{limits[0] * 1000:>14.6g}{limits[1] * 1000:>14.6g}  {status}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import sys
+import json
+import argparse
+import subprocess
+
+# Start-up budget in seconds for importing each pipeline stage in a fresh interpreter
+# (measured import time, not including the interpreter itself). None of these modules
+# may load matplotlib at import time: plots are created through plotting.py on demand.
+startup_budget = {
+    "viscosity_calculation": 1.0,
+    "generate_visc_data_all_files": 1.0,
+    "calculate_avg_max_min": 0.6,
+    "standard_deviation": 0.6,
+    "t_cut": 0.6,
+    "double_exp_fit_avgvisc": 1.0,
+    "fit_std_power_law": 1.0,
+    "plot_visc_trajs": 0.6,
+    "plot_avg_max_min_visc": 0.6,
+    "live_green_kubo": 1.0,
+    "bootstrap_viscosity": 1.0,
+    "run_pipeline": 0.6,
+    "stacked_viscosity": 1.0,
+    "spectral_viscosity": 1.0,
+    "block_averaging": 1.0,
+}
+
+# Code run in the child interpreter: time the import and report whether matplotlib was loaded
+probe = (
+    "import sys, time, json; t = time.perf_counter(); import {module}; "
+    "print(json.dumps([time.perf_counter() - t, 'matplotlib' in sys.modules]))"
+)
+
+
+def measure(module, repeat):
+    '''Best import time [s] over `repeat` fresh interpreters, and whether matplotlib was imported.'''
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", probe.format(module=module)],
+                                capture_output=True, text=True, check=True).stdout
+        elapsed, loads_matplotlib = json.loads(output)
+        times.append(elapsed)
+    return min(times), loads_matplotlib
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of every pipeline stage against its budget.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of measurements per module. Default is 3.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply all budgets by this factor (e.g. for slow file systems). Default is 1.')
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<32}{'import (s)':>12}{'budget (s)':>12}  status")
+    for module, budget in startup_budget.items():
+        elapsed, loads_matplotlib = measure(module, args.repeat)
+        budget *= args.scale
+
+        status = "ok"
+        if elapsed > budget:
+            status = "OVER BUDGET"
+        if loads_matplotlib:
+            status = "IMPORTS MATPLOTLIB"
+        failed |= status != "ok"
+
+        print(f"{module:<32}{elapsed:>12.3f}{budget:>12.3f}  {status}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
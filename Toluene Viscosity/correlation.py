@@ -0,0 +1,304 @@
+# --------------------------------------------------------------------------------------------
+
+# Batched auto-correlation engine for the Green-Kubo calculation in viscosity_calculation.py
+
+# All components are stacked into one 2-D array (component, time) and transformed together
+# with real-input FFTs along the last axis. The input is zero-padded to a fast FFT length
+# (products of small primes) of at least 2*steps - 1 instead of the next power of two.
+# scipy.fft is used when available (multithreaded through `workers`), numpy.fft otherwise.
+
+# batch_correlations() computes several averaged auto-correlations and cross-correlations
+# of the rows of one array from a single forward transform (shear and bulk viscosity).
+
+# BlockedCorrelator and WelchAccumulator process a series block by block with bounded
+# memory (streaming ACF, and segment-averaged power spectra for spectral_viscosity.py).
+
+# -------------------------------------------------------------------------------------------
+
+import numpy as np
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+# FFT backends that can be requested
+fft_backends = ['scipy', 'numpy']
+default_fft_backend = 'scipy' if scipy_fft is not None else 'numpy'
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def fast_length(n, backend=default_fft_backend):
+    '''Smallest efficient FFT length of at least n points.'''
+    if backend == 'scipy' and scipy_fft is not None:
+        return scipy_fft.next_fast_len(n, real=True)
+
+    # Nearest size with power of 2 for numpy.fft
+    return 2 ** int(np.ceil(np.log2(n)))
+
+
+def fft_size(steps, backend=default_fft_backend):
+    '''Zero-padded FFT length for a linear (non-circular) correlation of `steps` points.'''
+    return fast_length(2*steps - 1, backend)
+
+
+def _rfft_pair(backend, workers):
+    if backend == 'scipy':
+        if scipy_fft is None:
+            raise ImportError("The scipy FFT backend requires scipy to be installed.")
+        return (lambda x, n: scipy_fft.rfft(x, n, axis=-1, workers=workers),
+                lambda x, n: scipy_fft.irfft(x, n, axis=-1, workers=workers))
+    return (lambda x, n: np.fft.rfft(x, n, axis=-1),
+            lambda x, n: np.fft.irfft(x, n, axis=-1))
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def batch_acf(data, average=False, backend=default_fft_backend, workers=None, max_lag=None):
+    '''
+    Auto-correlation functions of every row of `data` (shape (..., steps)) along the last axis,
+    normalised by the number of time origins and truncated to max_lag lags (default steps//2).
+
+    With average=True the ACFs are averaged over the second-to-last axis. The power spectra
+    are averaged before the inverse transform, so only one inverse FFT is needed per average.
+    '''
+    rfft, irfft = _rfft_pair(backend, workers)
+
+    steps = data.shape[-1]
+    lag = steps//2 if max_lag is None else min(max_lag, steps)
+    size = fft_size(steps, backend)
+
+    # Power spectrum |FFT|^2 of each component (real valued)
+    FFT = rfft(data, size)
+    PWR = np.square(FFT.real)
+    PWR += np.square(FFT.imag)
+    del FFT
+
+    if average:
+        PWR = PWR.mean(axis=-2)
+
+    # Auto-correlation from the inverse FFT of the power spectrum
+    COR = irfft(PWR, size)[..., :lag]
+    COR /= np.arange(steps, steps - lag, -1)
+
+    return COR
+
+
+def batch_correlations(data, groups, pairs=(), backend=default_fft_backend, workers=None, max_lag=None):
+    '''
+    Correlation functions of the rows of `data` (shape (..., rows, steps)) from one forward FFT:
+    for every entry of `groups` (a list or slice of rows) the ACF averaged over those rows, as in
+    batch_acf(average=True), then for every (i, j) of `pairs` the cross-correlation
+    <x_i(t0) x_j(t0 + t)>. Returns an array of shape (..., len(groups) + len(pairs), lags),
+    normalised and truncated as in batch_acf(); all spectra share one inverse transform.
+    '''
+    rfft, irfft = _rfft_pair(backend, workers)
+
+    steps = data.shape[-1]
+    lag = steps//2 if max_lag is None else min(max_lag, steps)
+    size = fft_size(steps, backend)
+
+    FFT = rfft(data, size)
+    spectra = []
+    for rows in groups:
+        selected = FFT[..., rows, :]
+        PWR = np.square(selected.real)
+        PWR += np.square(selected.imag)
+        spectra.append(PWR.mean(axis=-2))
+    for i, j in pairs:
+        spectra.append(FFT[..., i, :].conj() * FFT[..., j, :])
+    del FFT
+
+    COR = irfft(np.stack(spectra, axis=-2), size)[..., :lag]
+    COR /= np.arange(steps, steps - lag, -1)
+
+    return COR
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def shear_components(P, diag=True):
+    '''
+    Stack the independent shear stresses of the pressure tensor P (rows Pxx, Pyy, Pzz, Pxy, Pxz, Pyz
+    along axis -2) into one array: Pxy, Pxz, Pyz and, with diag=True, (Pxx-Pyy)/2, (Pyy-Pzz)/2, (Pxx-Pzz)/2.
+    '''
+    Pxx, Pyy, Pzz = P[..., 0, :], P[..., 1, :], P[..., 2, :]
+
+    shear = np.empty(P.shape[:-2] + (6 if diag else 3, P.shape[-1]), dtype=P.dtype)
+    shear[..., :3, :] = P[..., 3:, :]
+
+    if diag:
+        np.subtract(Pxx, Pyy, out=shear[..., 3, :])
+        np.subtract(Pyy, Pzz, out=shear[..., 4, :])
+        np.subtract(Pxx, Pzz, out=shear[..., 5, :])
+        shear[..., 3:, :] /= 2
+
+    return shear
+
+
+# Names of the rows of stress_channels(): the shear stresses of shear_components(), then the
+# isotropic pressure fluctuation
+channel_names = ["xy", "xz", "yz", "xx-yy", "yy-zz", "xx-zz", "bulk"]
+
+
+def stress_channels(P, diag=True, bulk=False):
+    '''
+    shear_components(P, diag) followed, with bulk=True, by the isotropic pressure fluctuation
+    (Pxx + Pyy + Pzz)/3 - <P>, the mean being taken over the steps of each trajectory.
+    Returns the stacked array and the names of its rows (see channel_names).
+    '''
+    shear = shear_components(P, diag)
+    names = channel_names[:shear.shape[-2]]
+    if not bulk:
+        return shear, names
+
+    channels = np.empty(P.shape[:-2] + (shear.shape[-2] + 1, P.shape[-1]), dtype=P.dtype)
+    channels[..., :-1, :] = shear
+    del shear
+    pressure = channels[..., -1, :]
+    np.add(P[..., 0, :], P[..., 1, :], out=pressure)
+    pressure += P[..., 2, :]
+    pressure /= 3
+    pressure -= pressure.mean(axis=-1, keepdims=True)
+    return channels, names + ["bulk"]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+class BlockedCorrelator:
+    '''
+    Streaming auto-correlation of several channels up to a fixed number of lags.
+
+    Data arrive in blocks of shape (channels, n). Each block is cross-correlated by FFT with
+    itself and the last max_lag-1 samples seen before it, and the products are added to
+    per-lag sums, so memory stays O(channels * (max_lag + n)) however long the series gets.
+    After any number of updates acf() equals batch_acf() of the whole series truncated to max_lag.
+    '''
+
+    def __init__(self, channels, max_lag, backend=default_fft_backend, workers=None):
+        self.max_lag = max_lag
+        self.backend = backend
+        self.workers = workers
+        self.count = 0                                   # Samples seen
+        self.history = np.empty((channels, 0))           # Last max_lag-1 samples
+        self.sums = np.zeros((channels, max_lag))        # Sum of x(t) x(t-k) for every lag k
+        self.pairs = np.zeros(max_lag, dtype=np.int64)   # Number of (t, t-k) pairs for every lag k
+
+    def update(self, block):
+        '''Add the samples of block (shape (channels, n)).'''
+        block = np.asarray(block, dtype=np.float64)
+        n = block.shape[-1]
+        if n == 0:
+            return
+        rfft, irfft = _rfft_pair(self.backend, self.workers)
+
+        h = self.history.shape[-1]
+        x = np.concatenate([self.history, block], axis=-1)
+        new = np.zeros_like(x)
+        new[:, h:] = block
+
+        # sum_t new(t) x(t-k) from the cross power spectrum, padded against wrap-around
+        size = fast_length(x.shape[-1] + self.max_lag - 1, self.backend)
+        X = rfft(x, size)
+        X.imag *= -1
+        X *= rfft(new, size)
+        self.sums += irfft(X, size)[:, :self.max_lag]
+        del X
+
+        # The new samples t = count, ..., count+n-1 pair with t-k >= 0 at lag k
+        lags = np.arange(self.max_lag)
+        self.pairs += np.clip(self.count + n - np.maximum(lags, self.count), 0, n)
+
+        self.count += n
+        self.history = x[:, max(0, x.shape[-1] - (self.max_lag - 1)):].copy()
+
+    def acf(self, average=True):
+        '''Auto-correlation functions (averaged over the channels with average=True) of the lags seen so far.'''
+        lag = min(self.max_lag, self.count)
+        COR = self.sums[:, :lag] / self.pairs[:lag]
+        return COR.mean(axis=0) if average else COR
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Windows of the Welch estimator (periodic, as used for spectral analysis)
+windows = {
+    'hann': lambda n: np.hanning(n + 1)[:-1],
+    'hamming': lambda n: np.hamming(n + 1)[:-1],
+    'blackman': lambda n: np.blackman(n + 1)[:-1],
+    'boxcar': np.ones,
+}
+
+
+class WelchAccumulator:
+    '''
+    Streaming Welch estimate of the power spectral density of several channels.
+
+    Data arrive in blocks of shape (channels, n) and are cut into windowed segments of
+    `length` samples, one every `step` samples. The segments are transformed `batch` at a
+    time in one (batch, channels, length) FFT (spread over `workers` threads by scipy.fft),
+    and only the per-frequency sums of the periodograms and of their squares are kept, so
+    memory stays O(channels * (length + n)) however long the series gets.
+    '''
+
+    def __init__(self, channels, length, step=None, window='hann', batch=16, backend=default_fft_backend,
+                 workers=None):
+        self.length = length
+        self.step = length//2 if step is None else step
+        self.window = windows[window](length)
+        self.batch = batch
+        self.backend = backend
+        self.workers = workers
+        self.count = 0                                     # Samples seen
+        self.segments = 0                                  # Segments transformed
+        self.history = np.empty((channels, 0))             # Samples not yet consumed by a full segment
+        self.sums = np.zeros(length//2 + 1)                # Sum of the channel-averaged periodograms
+        self.squares = np.zeros(length//2 + 1)             # Sum of their squares (segment-to-segment scatter)
+
+    def update(self, block):
+        '''Add the samples of block (shape (channels, n)).'''
+        block = np.asarray(block, dtype=np.float64)
+        self.count += block.shape[-1]
+        x = np.concatenate([self.history, block], axis=-1)
+
+        n_segments = max(0, (x.shape[-1] - self.length)//self.step + 1)
+        if n_segments:
+            rfft, _ = _rfft_pair(self.backend, self.workers)
+            # (channels, segments, length) views of the overlapping segments
+            segments = np.lib.stride_tricks.sliding_window_view(x, self.length, axis=-1)[:, ::self.step][:, :n_segments]
+            for first in range(0, n_segments, self.batch):
+                X = rfft(np.swapaxes(segments[:, first:first + self.batch], 0, 1) * self.window, self.length)
+                PWR = np.square(X.real)
+                PWR += np.square(X.imag)
+                PWR = PWR.mean(axis=1)
+                self.sums += PWR.sum(axis=0)
+                self.squares += np.square(PWR).sum(axis=0)
+                self.segments += len(PWR)
+
+        self.history = x[:, n_segments * self.step:].copy()
+
+    def frequencies(self):
+        '''Frequencies of the spectrum in cycles per sample.'''
+        return np.fft.rfftfreq(self.length)
+
+    def psd(self):
+        '''
+        Two-sided power spectral density per sample (multiply by the sampling interval for a
+        density per unit time), averaged over channels and segments: the Fourier transform
+        of the auto-correlation function, so psd()[0] is the sum of the ACF over all positive
+        and negative lags.
+        '''
+        return self.sums / (self.segments * np.sum(np.square(self.window)))
+
+    def standard_error(self):
+        '''
+        Standard error of psd() from the scatter between segments, inflated for the overlap of
+        neighbouring windows (Welch 1967: variance factor 1 + 2 sum_j c_j^2, with c_j the
+        normalised overlap of windows j steps apart). NaN with fewer than two segments.
+        '''
+        if self.segments < 2:
+            return np.full_like(self.sums, np.nan)
+        norm = self.segments * np.sum(np.square(self.window))
+        mean = self.sums / self.segments
+        variance = np.maximum(self.squares - self.segments * np.square(mean), 0) / (self.segments - 1)
+
+        w = self.window
+        overlap = [np.dot(w[:self.length - j], w[j:]) / np.dot(w, w) for j in range(self.step, self.length, self.step)]
+        factor = 1 + 2 * np.sum(np.square(overlap))
+        return np.sqrt(variance * factor * self.segments) / norm
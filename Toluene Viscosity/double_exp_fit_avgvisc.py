@@ -1,36 +1,121 @@
-import numpy as np
-import pandas as pd
-from scipy.optimize import curve_fit
-import matplotlib.pyplot as plt
-
-def double_exponential(t, A, a, T1, T2):
-    return A*a*T1*(1 - np.exp(-t / T1)) + A*(1 - a)*T2*(1 - np.exp(-t / T2))
-
-inputFile = input("Enter method (Green-Kubo or Einstein): ")
-t_cut = int(input("Enter t_cut row number: "))
-data = pd.read_csv(f"Trajectory_Analysis_CSV_Files/std_{inputFile}.csv")
-
-# Select only the first 1661 rows for fitting
-data_subset = data.iloc[:t_cut]
-time = data_subset["time(ns)"].values
-visc = data_subset["mean_visc"].values
-
-initial_guess = [0.0003, 0.5, 0.001, 0.001]
-params, _ = curve_fit(double_exponential, time, visc, p0=initial_guess)
-
-print("Fitted parameters:")
-print(f"A = {params[0]}")
-print(f"a = {params[1]}")
-print(f"T1 = {params[2]}")
-print(f"T2 = {params[3]}")
-
-visc_at_tcut = double_exponential(time[-1], *params)*1000
-plt.text(0.05, 0.85, f"Viscosity = {visc_at_tcut:.4g} mPa.s", transform=plt.gca().transAxes, fontsize=10)
-plt.plot(time, visc*1000, label="Data", linewidth=1)
-plt.plot(time, double_exponential(time, *params) * 1000, color="red", label="Fitted Curve", linewidth=1)
-plt.text(0.05, 0.9, f"A={params[0]:.4g}, a={params[1]:.4g}, T1={params[2]:.4g}, T2={params[3]:.4g}", transform=plt.gca().transAxes, fontsize=10)
-plt.xlabel("Time (ns)")
-plt.ylabel("Mean Viscosity (mPa.s)")
-plt.legend()
-plt.savefig(f"plots/fitted_avgvisc_{inputFile}.png")
-plt.close()
\ No newline at end of file
+import os
+import sys
+import argparse
+import pandas as pd
+from scipy.optimize import curve_fit
+from viscosity_fits import double_exponential, double_exponential_jacobian, double_exponential_limit, \
+    initial_guess, fit_double_exponential, min_fit_points
+from t_cut import crossing_rows
+from ensemble_stats import normalize_method
+from instrumentation import stage, profile_run, set_label
+
+
+def parser(argv=None):
+    parser = argparse.ArgumentParser(description='Double exponential fit of the mean viscosity up to t_cut.')
+    parser.add_argument('method', nargs='?', help='GK or Einstein (asked interactively if omitted).')
+    parser.add_argument('t_cut', nargs='?', type=int, help='Row number of t_cut (asked interactively if omitted).')
+    parser.add_argument('-t', '--threshold', type=float, nargs='+',
+                        help='Take t_cut from t_cut.py for this ratio std_visc / mean_visc instead of a row number. '
+                             'With several thresholds the fit is repeated for each of them (sensitivity scan).')
+    parser.add_argument('--no-plots', action='store_true', help='Only print the fitted parameters, do not plot.')
+    args = parser.parse_args(argv)
+
+    if args.method is None:
+        args.method = input("Enter method (GK or Einstein): ")
+    args.method = normalize_method(args.method)
+    if args.t_cut is None and args.threshold is None:
+        args.t_cut = int(input("Enter t_cut row number: "))
+    return args
+
+
+def threshold_scan(data, thresholds, rows, method):
+    '''Fit the mean viscosity up to the t_cut row of each threshold, each fit exactly as the single fit of main().'''
+    time = data["time(ns)"].values
+    visc = data["mean_visc"].values
+
+    # Every fit starts from initial_guess: a warm start from the previous t_cut moves the
+    # poorly determined fits at long t_cut away from the single fit of the same row
+    fits = {}
+    with stage("fit"):
+        for row in sorted(set(int(row) for row in rows if row >= min_fit_points)):
+            fits[row] = fit_double_exponential(time[:row], visc[:row], initial_guess)
+
+    results = []
+    for threshold, row in zip(thresholds, rows):
+        if row not in fits or not fits[row][1]:
+            results.append((threshold, row, float("nan"), float("nan")))
+            continue
+        p = fits[row][0]
+        results.append((threshold, row, double_exponential(time[row - 1], *p) * 1000, double_exponential_limit(p) * 1000))
+
+    print(f"{'threshold':>10}{'t_cut row':>10}{'visc at t_cut':>16}{'visc (t->inf)':>16}  [mPa.s]")
+    for threshold, row, at_cut, limit in results:
+        print(f"{threshold:>10g}{row:>10d}{at_cut:>16.4g}{limit:>16.4g}")
+
+    output_file = os.path.join("Trajectory_Analysis_CSV_Files", f"double_exp_threshold_scan_{method}.csv")
+    pd.DataFrame(results, columns=["threshold", "t_cut row", "viscosity at t_cut (mPa.s)",
+                                   "viscosity limit (mPa.s)"]).to_csv(output_file, index=False)
+    print(f"Threshold scan saved to {output_file}")
+
+
+def main(argv=None):
+    args = parser(argv)
+    inputFile = args.method
+    t_cut = args.t_cut
+    set_label(inputFile)
+    with stage("read_csv"):
+        data = pd.read_csv(f"Trajectory_Analysis_CSV_Files/std_{inputFile}.csv")
+
+    if args.threshold is not None and t_cut is None:
+        rows = crossing_rows(data["mean_visc"].values, data["std_visc"].values, args.threshold)
+        if len(args.threshold) > 1:
+            threshold_scan(data, args.threshold, rows, inputFile)
+            return
+        if rows[0] < 0:
+            print(f"No time point where std_visc reaches {args.threshold[0] * 100:g}% of mean_visc.")
+            return
+        t_cut = rows[0]
+        print(f"t_cut = row {t_cut} ({args.threshold[0] * 100:g}% threshold)")
+
+    # Select only the first t_cut rows for fitting
+    data_subset = data.iloc[:t_cut]
+    time = data_subset["time(ns)"].values
+    visc = data_subset["mean_visc"].values
+
+    if len(time) < min_fit_points:
+        print(f"Error: t_cut = row {t_cut} leaves {len(time)} data points, but the double exponential fit "
+              f"needs at least {min_fit_points}. Use more trajectories or a larger threshold.")
+        sys.exit(1)
+
+    with stage("fit"):
+        try:
+            params, _ = curve_fit(double_exponential, time, visc, p0=initial_guess, jac=double_exponential_jacobian)
+        except RuntimeError as e:
+            print(f"Error: The double exponential fit up to t_cut = row {t_cut} did not converge: {e}")
+            sys.exit(1)
+
+    print("Fitted parameters:")
+    print(f"A = {params[0]}")
+    print(f"a = {params[1]}")
+    print(f"T1 = {params[2]}")
+    print(f"T2 = {params[3]}")
+
+    visc_at_tcut = double_exponential(time[-1], *params)*1000
+    print(f"Viscosity at t_cut = {visc_at_tcut:.4g} mPa.s")
+
+    output_file = os.path.join("Trajectory_Analysis_CSV_Files", f"double_exp_fit_{inputFile}.csv")
+    pd.DataFrame([{
+        "t_cut row": t_cut, "A": params[0], "a": params[1], "T1": params[2], "T2": params[3],
+        "viscosity at t_cut (mPa.s)": visc_at_tcut, "viscosity limit (mPa.s)": double_exponential_limit(params) * 1000,
+    }]).to_csv(output_file, index=False)
+
+    # matplotlib is only loaded when plots are requested
+    if not args.no_plots:
+        with stage("plot"):
+            import plotting
+            plotting.plot_double_exp_fit(time, visc, double_exponential(time, *params), params, visc_at_tcut, inputFile)
+
+
+if __name__ == "__main__":
+    with profile_run("double_exp_fit_avgvisc"):
+        main()
@@ -0,0 +1,273 @@
+# --------------------------------------------------------------------------------------------
+
+# Streaming statistics of the viscosity over all trajectories in Viscosity_Data.
+
+# Every Viscosity_Data/*/viscosity_{method} table (.csv or .npz, see viscosity_io.py) is read
+# once and folded into running per-time-row count, mean, M2 (Welford's algorithm), minimum and maximum arrays, so memory
+# stays O(time points) no matter how many trajectories there are.
+
+# The running statistics are persisted per method together with the list of included
+# trajectory files and their modification times. When trajectories are added, only the new
+# files are read and merged with the parallel Welford combination; if an included file
+# changed or disappeared the statistics are rebuilt from scratch (a minimum or maximum
+# cannot be "removed" again).
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from viscosity_io import find_table, read_table
+from instrumentation import stage
+
+# Directory containing one <trajectory>_data subdirectory per trajectory
+viscosity_data_dir = "Viscosity_Data"
+
+# Directory of the ensemble CSV files
+analysis_dir = "Trajectory_Analysis_CSV_Files"
+
+# Method names as used in the file names (viscosity_GK.csv, std_Einstein.csv, ...)
+methods = ["GK", "Einstein"]
+method_aliases = {"gk": "GK", "green-kubo": "GK", "green_kubo": "GK", "greenkubo": "GK", "einstein": "Einstein"}
+
+
+def normalize_method(method):
+    '''File name form of a method name, e.g. "Green-Kubo" -> "GK", so all scripts read and write the same files.'''
+    return method_aliases.get(method.strip().lower(), method.strip())
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+class RunningStats:
+    '''Per-row running count, mean, M2, minimum and maximum of a set of curves on a common time grid.'''
+
+    def __init__(self):
+        self.time = np.empty(0)
+        self.count = np.empty(0, dtype=np.int64)
+        self.mean = np.empty(0)
+        self.M2 = np.empty(0)
+        self.min = np.empty(0)
+        self.max = np.empty(0)
+
+    def _grow(self, time):
+        # Extend the arrays when a longer curve arrives; its time grid must continue the current one
+        n = len(self.time)
+        if not np.allclose(time[:n], self.time[:len(time)]):
+            raise ValueError("Time points do not match those of the previous trajectories.")
+        if len(time) <= n:
+            return
+
+        extra = len(time) - n
+        self.time = np.concatenate([self.time, time[n:]])
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        self.mean = np.concatenate([self.mean, np.zeros(extra)])
+        self.M2 = np.concatenate([self.M2, np.zeros(extra)])
+        self.min = np.concatenate([self.min, np.full(extra, np.inf)])
+        self.max = np.concatenate([self.max, np.full(extra, -np.inf)])
+
+    def update(self, time, values):
+        '''Add one curve (values at the given time points).'''
+        time = np.asarray(time, dtype=float)
+        values = np.asarray(values, dtype=float)
+        self._grow(time)
+
+        n = len(values)
+        count = self.count[:n]
+        mean = self.mean[:n]
+
+        # Welford update of every time row at once
+        count += 1
+        delta = values - mean
+        mean += delta / count
+        self.M2[:n] += delta * (values - mean)
+        np.minimum(self.min[:n], values, out=self.min[:n])
+        np.maximum(self.max[:n], values, out=self.max[:n])
+
+    @classmethod
+    def from_curves(cls, time, matrix):
+        '''Statistics of the rows of a (curves, time) matrix, e.g. a group of stacked trajectories.'''
+        matrix = np.asarray(matrix, dtype=float)
+        stats = cls()
+        stats.time = np.asarray(time, dtype=float)[:matrix.shape[1]]
+        stats.count = np.full(matrix.shape[1], len(matrix), dtype=np.int64)
+        stats.mean = matrix.mean(axis=0)
+        stats.M2 = np.square(matrix - stats.mean).sum(axis=0)
+        stats.min = matrix.min(axis=0)
+        stats.max = matrix.max(axis=0)
+        return stats
+
+    def combine(self, other):
+        '''Merge the statistics of another RunningStats (parallel Welford combination).'''
+        if len(other.time) == 0:
+            return
+        self._grow(other.time)
+
+        n = len(other.time)
+        n_a, n_b = self.count[:n].astype(float), other.count.astype(float)
+        total = n_a + n_b
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = other.mean - self.mean[:n]
+            mean = np.where(total > 0, self.mean[:n] + delta * n_b / total, 0.0)
+            M2 = np.where(total > 0, self.M2[:n] + other.M2 + delta**2 * n_a * n_b / total, 0.0)
+
+        self.count[:n] += other.count
+        self.mean[:n] = mean
+        self.M2[:n] = M2
+        np.minimum(self.min[:n], other.min, out=self.min[:n])
+        np.maximum(self.max[:n], other.max, out=self.max[:n])
+
+    def std(self):
+        '''Sample standard deviation (ddof=1) of every time row; NaN where fewer than two curves.'''
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, np.sqrt(self.M2 / (self.count - 1)), np.nan)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def trajectory_files(method, working_dir=viscosity_data_dir):
+    '''(directory name, path) of every viscosity_{method} table (.csv or .npz) in working_dir, sorted by name.'''
+    files = []
+    for subdir in sorted(os.listdir(working_dir)):
+        viscosity_file = find_table(os.path.join(working_dir, subdir), f"viscosity_{method}")
+        if viscosity_file is not None:
+            files.append((subdir, viscosity_file))
+    return files
+
+
+def read_viscosity_file(path):
+    '''time(ps) and viscosity(Pa.s) columns of a per-trajectory viscosity table (CSV or .npz).'''
+    table = read_table(path, ["time(ps)", "viscosity(Pa.s)"])
+    return table["time(ps)"], table["viscosity(Pa.s)"]
+
+
+def viscosity_matrix(files):
+    '''
+    Read the given (name, path) viscosity files into one (trajectories, time) matrix.
+    Returns (time, names, matrix); all curves are cut to the length of the shortest one.
+    '''
+    names, curves, time = [], [], None
+    for name, path in files:
+        try:
+            t, values = read_viscosity_file(path)
+        except Exception as e:
+            print(f"Error reading {path}: {e}")
+            continue
+        n = len(t) if time is None else min(len(t), len(time))
+        if time is not None and not np.allclose(t[:n], time[:n]):
+            raise ValueError(f"Time points of {path} do not match those of the previous trajectories.")
+        if time is None or len(t) < len(time):
+            time = t
+        names.append(name)
+        curves.append(values)
+
+    if not curves:
+        return np.empty(0), names, np.empty((0, 0))
+
+    matrix = np.empty((len(curves), len(time)))
+    for row, values in zip(matrix, curves):
+        row[:] = values[:len(time)]
+    return time, names, matrix
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def accumulate(files, stats=None):
+    '''Fold the given (name, path) viscosity files into stats; returns (stats, names read).'''
+    stats = stats if stats is not None else RunningStats()
+    names = []
+    for name, path in files:
+        try:
+            time, values = read_viscosity_file(path)
+            with stage("welford"):
+                stats.update(time, values)
+            names.append(name)
+        except Exception as e:
+            print(f"Error reading {path}: {e}")
+    return stats, names
+
+
+def write_csv(frame, path):
+    '''Write a DataFrame to CSV through a temporary file, so readers never see a partial file.'''
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    frame.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def write_summaries(stats, method, output_dir=analysis_dir):
+    '''Write avg_min_max_visc_{method}.csv and std_{method}.csv; returns both paths.'''
+    with stage("write_summaries"):
+        os.makedirs(output_dir, exist_ok=True)
+
+        avg_min_max_file = os.path.join(output_dir, f"avg_min_max_visc_{method}.csv")
+        write_csv(pd.DataFrame({
+            "time(ps)": stats.time,
+            "Average Viscosity (Pa.s)": stats.mean,
+            "Minimum Viscosity (Pa.s)": stats.min,
+            "Maximum Viscosity (Pa.s)": stats.max,
+        }), avg_min_max_file)
+
+        std_file = os.path.join(output_dir, f"std_{method}.csv")
+        write_csv(pd.DataFrame({
+            "time(ns)": stats.time / 1000,
+            "mean_visc": stats.mean,
+            "std_visc": stats.std(),
+        }), std_file)
+
+        return avg_min_max_file, std_file
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def state_path(method, output_dir=analysis_dir):
+    return os.path.join(output_dir, f"aggregate_state_{method}.npz")
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def save_state(stats, members, path):
+    '''Persist the running statistics and the {name: [mtime_ns, size]} of the files they include.'''
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, time=stats.time, count=stats.count, mean=stats.mean, M2=stats.M2,
+             min=stats.min, max=stats.max, members=np.array(json.dumps(members)))
+    os.replace(tmp_path, path)
+
+
+def load_state(path):
+    '''Return (stats, members) saved by save_state, or (None, {}) if there is no usable state.'''
+    try:
+        with np.load(path) as state:
+            stats = RunningStats()
+            for key in ("time", "count", "mean", "M2", "min", "max"):
+                setattr(stats, key, state[key])
+            return stats, json.loads(str(state["members"]))
+    except (OSError, KeyError, ValueError):
+        return None, {}
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def update_aggregate(method, working_dir=viscosity_data_dir, output_dir=analysis_dir, rebuild=False):
+    '''
+    Bring the persisted statistics of `method` up to date with the files in working_dir.
+    Returns (stats, names of all included trajectories, names read in this call).
+    '''
+    files = trajectory_files(method, working_dir)
+    current = {name: file_signature(path) for name, path in files}
+
+    path = state_path(method, output_dir)
+    stats, members = (None, {}) if rebuild else load_state(path)
+
+    # Changed or removed trajectories invalidate the stored state
+    if stats is None or any(current.get(name) != signature for name, signature in members.items()):
+        stats, members = RunningStats(), {}
+
+    new_files = [(name, file) for name, file in files if name not in members]
+    names = []
+    if new_files:
+        new_stats, names = accumulate(new_files)
+        stats.combine(new_stats)
+        members.update({name: current[name] for name in names})
+
+        os.makedirs(output_dir, exist_ok=True)
+        save_state(stats, members, path)
+
+    return stats, sorted(members), names
@@ -1,31 +1,54 @@
-import numpy as np
-import pandas as pd
-from scipy.optimize import curve_fit
-import matplotlib.pyplot as plt
-
-def power_law(t, A, B):
-    return A * t**B
-
-inputFile = input("Enter method (Green-Kubo or Einstein): ")
-df = pd.read_csv(f"Trajectory_Analysis_CSV_Files/std_{inputFile}.csv")
-df = df[df['time(ns)'] > 0]
-
-x = df['time(ns)'].values
-y = df['std_visc'].values
-
-popt, pcov = curve_fit(power_law, x, y, p0=(1e-5, 1))
-A, B = popt
-
-print("Fitted parameters:")
-print("A =", A)
-print("B =", B)
-
-plt.figure()
-plt.plot(x, y, label="Data", linewidth=1)
-plt.plot(x, power_law(x, A, B), color="red", label="Fitted Curve", linewidth=1)
-plt.text(0.05, 0.9, f"A={A:.4g}, B={B:.4g}", transform=plt.gca().transAxes, fontsize=10)
-plt.xlabel("Time (ns)")
-plt.ylabel("Standard Deviation")
-plt.legend()
-plt.savefig(f"Plots/fitted_std_{inputFile}.png")
-plt.close()
\ No newline at end of file
+import argparse
+import numpy as np
+import pandas as pd
+from ensemble_stats import normalize_method
+from instrumentation import stage, profile_run, set_label
+from scipy.optimize import curve_fit
+
+def power_law(t, A, B):
+    return A * t**B
+
+
+def parser(argv=None):
+    parser = argparse.ArgumentParser(description='Power law fit of the standard deviation of viscosity.')
+    parser.add_argument('method', nargs='?', help='GK or Einstein (asked interactively if omitted).')
+    parser.add_argument('--no-plots', action='store_true', help='Only print the fitted parameters, do not plot.')
+    args = parser.parse_args(argv)
+
+    if args.method is None:
+        args.method = input("Enter method (GK or Einstein): ")
+    args.method = normalize_method(args.method)
+    return args
+
+
+def main(argv=None):
+    args = parser(argv)
+    inputFile = args.method
+    set_label(inputFile)
+    with stage("read_csv"):
+        df = pd.read_csv(f"Trajectory_Analysis_CSV_Files/std_{inputFile}.csv")
+    df = df[df['time(ns)'] > 0]
+
+    x = df['time(ns)'].values
+    y = df['std_visc'].values
+
+    with stage("fit"):
+        popt, pcov = curve_fit(power_law, x, y, p0=(1e-5, 1))
+    A, B = popt
+
+    print("Fitted parameters:")
+    print("A =", A)
+    print("B =", B)
+
+    pd.DataFrame([{"A": A, "B": B}]).to_csv(f"Trajectory_Analysis_CSV_Files/power_law_fit_{inputFile}.csv", index=False)
+
+    # matplotlib is only loaded when plots are requested
+    if not args.no_plots:
+        with stage("plot"):
+            import plotting
+            plotting.plot_power_law_fit(x, y, power_law(x, A, B), A, B, inputFile)
+
+
+if __name__ == "__main__":
+    with profile_run("fit_std_power_law"):
+        main()
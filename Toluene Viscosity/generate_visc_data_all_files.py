@@ -1,28 +1,151 @@
 import os
-import subprocess
-
-# Define the directory containing the CSV files
-input_dir = "NVT_Trajectories"
-
-# List all relevant files
-csv_files = [f for f in os.listdir(input_dir) if f.startswith("NVT") and f.endswith("_stress_tensor.csv")]
-
-# Loop through each file and execute viscosityCalculation.py
-ct = 1
-for csv_file in csv_files:
-    if(ct < 32):
-        ct += 1
-        continue
-    input_path = os.path.join(input_dir, csv_file)
-    output_dir = os.path.splitext(csv_file)[0] + "_data"  # Create output directory name
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Define the command to run the script
-    command = [
-        "python", "viscosity_calculation.py", input_path,
-        "-s", "1000001", "-t", "0.002", "-T", "298", "-v", "141930.7610", "-u", "GPa", "-p"
-    ]
-
-    # Run the script
-    subprocess.run(command, check=True)
-    print(f"Processed: {csv_file}")
+import sys
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import viscosity_calculation
+from pressure_io import input_files
+import instrumentation
+
+# Rough peak memory of one viscosity_calculation.run() per step read (pressure tensor,
+# shear stack, FFT buffers and Einstein integrals) plus the fixed cost of a worker process
+bytes_per_step = 400
+bytes_per_worker = 200 * 1024**2
+
+# Parameters of a finished run are stored next to its outputs to detect stale results
+stamp_file = "run_parameters.json"
+
+
+# Command line: where to find the trajectories and how to run them
+def parser():
+    parser = argparse.ArgumentParser(
+        description='Run viscosity_calculation.py on all NVT*_stress_tensor.* trajectories in parallel.'
+    )
+    parser.add_argument('--input-dir', default="NVT_Trajectories",
+                        help='Directory containing the pressure tensor files (CSV or a format of stress_readers.py). Default is NVT_Trajectories.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Maximum number of trajectories processed at the same time. Default is the number of CPUs.')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='Memory in GB the batch may use; limits the number of concurrent trajectories. '
+                             'Default is the currently available memory.')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Recompute trajectories whose outputs are already up to date.')
+    parser.add_argument('--no-plots', action='store_true',
+                        help='Do not create the per-trajectory plots (passes --no-plots to viscosity_calculation.py).')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write a timing and memory report per trajectory and for the batch to Profiles/ '
+                             '(same as setting VISCO_PROFILE=1).')
+    parser.add_argument('calc_args', nargs=argparse.REMAINDER,
+                        help='Arguments passed to viscosity_calculation.py after "--". '
+                             'Default is: -s 1000001 -t 0.002 -T 298 -v 141930.7610 -u GPa -p')
+    args = parser.parse_args()
+
+    if args.calc_args and args.calc_args[0] == "--":
+        args.calc_args = args.calc_args[1:]
+    if not args.calc_args:
+        args.calc_args = ["-s", "1000001", "-t", "0.002", "-T", "298", "-v", "141930.7610", "-u", "GPa", "-p"]
+    if args.no_plots:
+        args.calc_args = args.calc_args + ["--no-plots"]
+
+    return args
+
+
+# Currently available memory in bytes
+def available_memory():
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+# A trajectory is up to date if it was computed with the same arguments after the CSV last changed
+def up_to_date(input_path, calc_args):
+    output_dir = viscosity_calculation.output_directory(input_path)
+    output_format = viscosity_calculation.parser([input_path] + calc_args).output_format
+    outputs = [os.path.join(output_dir, name) for name in [stamp_file, *viscosity_calculation.output_files(output_format)]]
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+
+    with open(outputs[0]) as file:
+        stamp = json.load(file)
+
+    input_mtime = os.path.getmtime(input_path)
+    return stamp.get("args") == calc_args and all(os.path.getmtime(path) >= input_mtime for path in outputs)
+
+
+# Worker: run the calculation in-process and report (elapsed time, error message, profile report or None)
+def process_trajectory(input_path, calc_args):
+    start = time.perf_counter()
+    instrumentation.last_report = None
+    try:
+        args = viscosity_calculation.parser([input_path] + calc_args)
+        viscosity_calculation.run(args)
+    except (Exception, SystemExit) as e:
+        if isinstance(e, viscosity_calculation.PressureDataError):
+            error = str(e)
+        else:
+            error = "".join(traceback.format_exception_only(type(e), e)).strip()
+        return time.perf_counter() - start, error, instrumentation.last_report
+
+    with open(os.path.join(viscosity_calculation.output_directory(input_path), stamp_file), "w") as file:
+        json.dump({"args": calc_args}, file)
+
+    return time.perf_counter() - start, None, instrumentation.last_report
+
+
+def main():
+    args = parser()
+    if args.profile:
+        instrumentation.enable()
+
+    # List all relevant files
+    input_paths = input_files(args.input_dir)
+
+    pending = [path for path in input_paths if args.force or not up_to_date(path, args.calc_args)]
+    skipped = len(input_paths) - len(pending)
+    if skipped:
+        print(f"Skipping {skipped} trajectories with up-to-date outputs (use --force to recompute)")
+    if not pending:
+        return
+
+    # Limit concurrency so that all running trajectories fit in memory
+    steps_args = viscosity_calculation.parser([pending[0]] + args.calc_args)
+    memory_limit = args.memory_limit * 1024**3 if args.memory_limit else available_memory()
+    per_job = bytes_per_step * steps_args.steps + bytes_per_worker
+    workers = max(1, min(args.jobs, len(pending), int(memory_limit // per_job)))
+    print(f"Processing {len(pending)} trajectories with {workers} workers "
+          f"(~{per_job / 1024**3:.2f} GB each)")
+
+    failures = []
+    reports = []
+    batch_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_trajectory, path, args.calc_args): path for path in pending}
+        for future in as_completed(futures):
+            csv_file = os.path.basename(futures[future])
+            elapsed, error, report = future.result()
+            reports.append(report)
+            if error is None:
+                print(f"Processed: {csv_file} ({elapsed:.1f} s)")
+            else:
+                print(f"Failed: {csv_file} ({elapsed:.1f} s): {error}")
+                failures.append(csv_file)
+
+    print(f"\nBatch finished in {time.perf_counter() - batch_start:.1f} s: "
+          f"{len(pending) - len(failures)} processed, {len(failures)} failed, {skipped} skipped")
+    if instrumentation.enabled():
+        print(f"Profile of the batch: {instrumentation.write_batch_report('batch_viscosity_calculation', reports)}")
+    if failures:
+        print("Failed trajectories: " + ", ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
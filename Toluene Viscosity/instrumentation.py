@@ -0,0 +1,163 @@
+# --------------------------------------------------------------------------------------------
+
+# Optional timing and memory instrumentation of the viscosity scripts.
+
+# Profiling is enabled by the environment variable VISCO_PROFILE (1 for the default report
+# directory, or the report directory itself) or by the --profile option of
+# viscosity_calculation.py, generate_visc_data_all_files.py and run_pipeline.py, which set
+# the variable so that worker processes and pipeline stages inherit it.
+
+# Code is divided into named stages:
+#
+#   with stage("green_kubo"):
+#       ...
+#
+# Nested stages are recorded under their full path (e.g. "calculate/green_kubo/acf") with the
+# number of calls, total wall time, the peak resident memory of the process at the end of the
+# stage and how much that peak grew during the stage (the memory high-water mark it set).
+# profile_run() wraps one script run or trajectory and writes its stages as a JSON report,
+# <report dir>/<script>[_<label>].json; batch drivers collect those reports in one CSV file.
+
+# When profiling is disabled stage() returns a shared no-op context manager, so the cost is
+# one function call per stage.
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Environment variable enabling the instrumentation, and the default report directory
+profile_variable = "VISCO_PROFILE"
+default_report_dir = "Profiles"
+
+_disabled = nullcontext()
+_stack = []       # Names of the stages currently running
+_stages = {}      # path -> [calls, seconds, peak RSS at the end [bytes], growth of the peak [bytes]]
+_label = None     # Label of the current profile_run()
+last_report = None
+
+
+def enabled():
+    return os.environ.get(profile_variable, "") not in ("", "0")
+
+
+def enable(directory=None):
+    '''Turn profiling on for this process and the processes it starts (reports in `directory` if given).'''
+    if directory:
+        os.environ[profile_variable] = directory
+    elif not enabled():
+        os.environ[profile_variable] = "1"
+
+
+def report_dir():
+    value = os.environ.get(profile_variable, "")
+    return default_report_dir if value in ("", "0", "1") else value
+
+
+def peak_rss():
+    '''Peak resident memory of this process so far in bytes (None where unavailable).'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def stage(name):
+    '''Context manager timing the enclosed code as stage `name` (a no-op unless profiling is enabled).'''
+    if not enabled():
+        return _disabled
+    return _timed_stage(name)
+
+
+@contextmanager
+def _timed_stage(name):
+    _stack.append(name)
+    path = "/".join(_stack)
+    peak_before = peak_rss()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        peak_after = peak_rss()
+        _stack.pop()
+
+        record = _stages.setdefault(path, [0, 0.0, None, 0])
+        record[0] += 1
+        record[1] += elapsed
+        if peak_after is not None:
+            record[2] = peak_after
+            record[3] += peak_after - peak_before
+
+
+def stage_rows():
+    '''Recorded stages as a list of dicts, in the order they were first entered.'''
+    return [{"stage": path, "calls": calls, "seconds": seconds,
+             "peak_rss_mb": None if peak is None else peak / 1024**2, "peak_growth_mb": growth / 1024**2}
+            for path, (calls, seconds, peak, growth) in _stages.items()]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+@contextmanager
+def profile_run(script, label=None):
+    '''
+    Record the stages of one run of `script` (e.g. one trajectory, label = its file name) and
+    write them to the JSON report on exit. The report is also kept in `last_report`.
+    '''
+    global last_report, _label
+    if not enabled():
+        yield
+        return
+
+    _stages.clear()
+    _label = label
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        peak = peak_rss()
+        last_report = {
+            "script": script, "label": _label, "pid": os.getpid(), "started": started,
+            "total_seconds": time.perf_counter() - start,
+            "peak_rss_mb": None if peak is None else peak / 1024**2,
+            "stages": stage_rows(),
+        }
+        write_report(last_report)
+
+
+def set_label(label):
+    '''Label of the current run (e.g. the method, once the arguments are parsed).'''
+    global _label
+    _label = label
+
+
+def write_report(report):
+    os.makedirs(report_dir(), exist_ok=True)
+    name = report["script"] if report["label"] is None else f"{report['script']}_{report['label']}"
+    path = os.path.join(report_dir(), f"{name}.json")
+    with open(path, "w") as file:
+        json.dump(report, file, indent=1)
+    return path
+
+
+def write_batch_report(name, reports):
+    '''One CSV row per stage of every report (e.g. all trajectories of a batch); returns its path.'''
+    import pandas as pd
+
+    rows = [{"label": report["label"], "total_seconds": report["total_seconds"], **row}
+            for report in reports if report is not None for row in report["stages"]]
+    os.makedirs(report_dir(), exist_ok=True)
+    path = os.path.join(report_dir(), f"{name}.csv")
+    pd.DataFrame(rows, columns=["label", "total_seconds", "stage", "calls", "seconds", "peak_rss_mb",
+                                "peak_growth_mb"]).to_csv(path, index=False)
+    return path
@@ -0,0 +1,118 @@
+# --------------------------------------------------------------------------------------------
+
+# Live Green-Kubo viscosity of a trajectory whose pressure tensor CSV file is still being
+# written by a running NVT simulation.
+
+# The file is followed like `tail -f` (pressure_io.tail_pressure_chunks) and every block of
+# new rows is fed to a BlockedCorrelator (correlation.py), which keeps only the last
+# max_lag-1 samples and the per-lag sums of the ACF. Memory therefore stays O(max_lag)
+# however long the simulation runs. Every --write-every rows the running avg_acf.csv and
+# viscosity_GK.csv are rewritten in Viscosity_Data/<trajectory>_data, in the same format
+# as viscosity_calculation.py, so the convergence can be checked while the job runs.
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+from pressure_io import tail_pressure_chunks, conversion_factors, PressureDataError, default_chunk_size
+from correlation import BlockedCorrelator, shear_components, fft_backends, default_fft_backend
+from viscosity_calculation import time_axis, green_kubo_integral, write_green_kubo, output_directory
+from instrumentation import stage, profile_run
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def parser(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Running Green-Kubo viscosity of a pressure tensor file that is still being written.'
+    )
+    parser.add_argument('datafile', help='Pressure tensor CSV file (as for viscosity_calculation.py).')
+    parser.add_argument('-u', '--unit', default='atm', choices=['Pa', 'atm', 'bar', 'GPa'],
+                        help='Unit of the provided pressure data. Default is atm.')
+    parser.add_argument('-t', '--timestep', type=float, required=True,
+                        help='Physical timestep between two successive pressure data points in [ps].')
+    parser.add_argument('-T', '--temperature', type=float, required=True,
+                        help='Temperature of the MD simulation in [K].')
+    parser.add_argument('-v', '--volume', type=float, required=True,
+                        help='Volume of the simulation box in [A^3].')
+    parser.add_argument('-d', '--diag', action='store_false',
+                        help='Do not use the diagonal elements of the pressure tensor.')
+    parser.add_argument('-e', '--each', type=int, default=100,
+                        help='Save the viscosity every this many lags. Default is 100.')
+    parser.add_argument('--max-lag', type=int, default=50000,
+                        help='Number of ACF lags accumulated (sets the memory use). Default is 50000.')
+    parser.add_argument('-s', '--steps', type=int, default=None,
+                        help='Stop after this many data points. Default is to follow the file until it stops growing.')
+    parser.add_argument('--write-every', type=int, default=100000,
+                        help='Rewrite the output files every this many new data points. Default is 100000.')
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+                        help='Seconds to wait before checking the file for new data. Default is 5.')
+    parser.add_argument('--idle-timeout', type=float, default=600.0,
+                        help='Stop when the file did not grow for this many seconds (0: wait forever). Default is 600.')
+    parser.add_argument('--chunk-size', type=int, default=default_chunk_size,
+                        help=f'Maximum number of rows correlated at once. Default is {default_chunk_size}.')
+    parser.add_argument('--fft-backend', choices=fft_backends, default=default_fft_backend,
+                        help=f'FFT implementation used for the correlations. Default is {default_fft_backend}.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of threads of the scipy FFT backend. Default is 1.')
+    parser.add_argument('-p', '--plot', action='store_true',
+                        help='Also plot the ACF and viscosity each time the files are written.')
+    return parser.parse_args(argv)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def write_running(correlator, args, output_dir):
+    '''Write the current ACF and Green-Kubo viscosity; returns the viscosity at the last lag.'''
+    with stage("write"):
+        avg_acf = correlator.acf()
+        viscosity_gk = green_kubo_integral(avg_acf, args.timestep, args.temperature, args.volume)
+        write_green_kubo(time_axis(len(avg_acf), args.timestep), avg_acf, viscosity_gk, args.each, output_dir, args.plot)
+    return viscosity_gk[-1]
+
+
+def run(args):
+    conv_ratio = conversion_factors.get(args.unit, 1)
+    idle_timeout = args.idle_timeout or None
+    output_dir = output_directory(args.datafile)
+
+    correlator = BlockedCorrelator(6 if args.diag else 3, args.max_lag, args.fft_backend, args.workers)
+    written = 0
+
+    print(f"Following {args.datafile} (max. lag {args.max_lag * args.timestep} ps)")
+    try:
+        for block in tail_pressure_chunks(args.datafile, args.steps, args.chunk_size, args.poll_interval, idle_timeout):
+            block *= conv_ratio
+            with stage("correlate"):
+                correlator.update(shear_components(block, args.diag))
+
+            if correlator.count - written >= args.write_every:
+                written = correlator.count
+                viscosity = write_running(correlator, args, output_dir)
+                print(f"{correlator.count} data points ({correlator.count * args.timestep} ps): "
+                      f"Viscosity (Green-Kubo) {viscosity * 1000:.4g} [mPa.s]")
+    except KeyboardInterrupt:
+        # Stopping by hand still writes the results of all data read so far
+        print("\nStopped.")
+
+    if correlator.count == 0:
+        raise PressureDataError("Error: No data was read from the input file.")
+
+    viscosity = write_running(correlator, args, output_dir)
+    print(f"\nNumber of data points read: {correlator.count}")
+    print(f"Viscosity (Green-Kubo): {round(viscosity * 1000, 2)} [mPa.s]")
+    return correlator
+
+
+def main(argv=None):
+    args = parser(argv)
+
+    try:
+        with profile_run("live_green_kubo", os.path.splitext(os.path.basename(args.datafile))[0]):
+            run(args)
+    except PressureDataError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
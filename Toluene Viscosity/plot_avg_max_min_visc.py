@@ -1,53 +1,48 @@
-import os
-import pandas as pd
-import matplotlib.pyplot as plt
-
-# input method GK or Einstein
-method = input("Enter the method (GK or Einstein): ")
-
-# Define the path to the output CSV file
-input_csv = f"Trajectory_Analysis_CSV_Files/avg_min_max_visc_{method}.csv"
-
-# Define the output directory for saving the plot
-output_plot_dir = "Plots"
-os.makedirs(output_plot_dir, exist_ok=True)
-
-# Read the CSV file
-data = pd.read_csv(input_csv)
-
-# Extract the "time(ps)" column
-time = data["time(ps)"]
-
-# Convert Average, Minimum, and Maximum viscosity columns from Pa·s to mPa·s
-data["Average Viscosity (mPa.s)"] = data["Average Viscosity (Pa.s)"] * 1000
-data["Minimum Viscosity (mPa.s)"] = data["Minimum Viscosity (Pa.s)"] * 1000
-data["Maximum Viscosity (mPa.s)"] = data["Maximum Viscosity (Pa.s)"] * 1000
-
-# Plot Average, Minimum, and Maximum viscosity columns
-plt.figure(figsize=(12, 8))
-
-# Fill the area between Minimum and Maximum viscosities with light yellow
-plt.fill_between(
-    time,
-    data["Minimum Viscosity (mPa.s)"],
-    data["Maximum Viscosity (mPa.s)"],
-    color="lightblue",
-    label="Range (Min-Max)"
-)
-
-# Plot the Average Viscosity line in royal blue
-plt.plot(time, data["Average Viscosity (mPa.s)"], label="Average Viscosity", color="royalblue", linewidth=2)
-
-# Customize the plot
-plt.xlabel("Time (ps)", fontsize=14)
-plt.ylabel("Viscosity (mPa.s)", fontsize=14)
-plt.title("Average, Min, and Max Viscosity vs Time (in mPa.s)", fontsize=16)
-plt.legend(loc="best", fontsize=12)
-plt.grid(True)
-
-# Save the plot
-output_plot_path = os.path.join(output_plot_dir, f"avg_min_max_visc_{method}.png")
-plt.savefig(output_plot_path)
-plt.close()
-
-print(f"Plot saved: {output_plot_path}")
+import argparse
+import pandas as pd
+from ensemble_stats import normalize_method
+from instrumentation import stage, profile_run, set_label
+
+
+def parser(argv=None):
+    parser = argparse.ArgumentParser(description='Plot average, minimum and maximum viscosity vs time.')
+    parser.add_argument('method', nargs='?', help='GK or Einstein (asked interactively if omitted).')
+    args = parser.parse_args(argv)
+
+    # input method GK or Einstein
+    if args.method is None:
+        args.method = input("Enter the method (GK or Einstein): ")
+    args.method = normalize_method(args.method)
+    return args
+
+
+def main(argv=None):
+    method = parser(argv).method
+    set_label(method)
+
+    # Define the path to the output CSV file
+    input_csv = f"Trajectory_Analysis_CSV_Files/avg_min_max_visc_{method}.csv"
+
+    # Read the CSV file
+    with stage("read_csv"):
+        data = pd.read_csv(input_csv)
+
+    # Extract the "time(ps)" column
+    time = data["time(ps)"]
+
+    # Convert Average, Minimum, and Maximum viscosity columns from Pa·s to mPa·s
+    data["Average Viscosity (mPa.s)"] = data["Average Viscosity (Pa.s)"] * 1000
+    data["Minimum Viscosity (mPa.s)"] = data["Minimum Viscosity (Pa.s)"] * 1000
+    data["Maximum Viscosity (mPa.s)"] = data["Maximum Viscosity (Pa.s)"] * 1000
+
+    with stage("plot"):
+        import plotting
+        output_plot_path = plotting.plot_avg_min_max(time, data["Average Viscosity (mPa.s)"], data["Minimum Viscosity (mPa.s)"],
+                                                     data["Maximum Viscosity (mPa.s)"], method)
+
+    print(f"Plot saved: {output_plot_path}")
+
+
+if __name__ == "__main__":
+    with profile_run("plot_avg_max_min_visc"):
+        main()
@@ -1,53 +1,53 @@
-import os
-import pandas as pd
-import matplotlib.pyplot as plt
-
-# input method GK or Einstein
-method = input("Enter the method (GK or Einstein): ")
-# Define the path to the output CSV file
-input_csv = f"Trajectory_Analysis_CSV_Files/avg_min_max_visc_{method}.csv"
-
-# Define the output directory for saving the plot
-output_plot_dir = "Plots"
-os.makedirs(output_plot_dir, exist_ok=True)
-
-# Read the CSV file
-data = pd.read_csv(input_csv)
-
-# Extract the "time(ps)" column
-time = data["time(ps)"]
-
-# Convert all viscosity columns from Pa·s to mPa·s (multiply by 1000)
-for col in data.columns:
-    if "viscosity(Pa.s)" in col:
-        data[col] = data[col] * 1000
-
-# Filter viscosity columns
-viscosity_columns = [col for col in data.columns if "viscosity(Pa.s)" in col]
-
-# Plot all viscosity columns on a single graph
-plt.figure(figsize=(16, 12))  # Increased figure size for higher resolution
-
-for col in viscosity_columns:
-    if "Average" in col:
-        plt.plot(time, data[col], label=col.replace("Pa.s", "mPa.s"), linestyle="--", linewidth=2)
-    elif "Minimum" in col:
-        plt.plot(time, data[col], label=col.replace("Pa.s", "mPa.s"), linestyle=":", linewidth=2, color="blue")
-    elif "Maximum" in col:
-        plt.plot(time, data[col], label=col.replace("Pa.s", "mPa.s"), linestyle="-.", linewidth=2, color="red")
-    else:
-        plt.plot(time, data[col], label=col.replace("Pa.s", "mPa.s"), alpha=0.6)  # Individual viscosities with transparency
-
-# Customize the plot
-plt.xlabel("Time (ps)", fontsize=14)
-plt.ylabel("Viscosity (mPa.s)", fontsize=14)
-plt.title("All Viscosities vs Time (in mPa.s)", fontsize=16)
-plt.legend(loc="best", fontsize=10)
-plt.grid(True)
-
-# Save the plot
-output_plot_path = os.path.join(output_plot_dir, f"visc_trajs_plot_{method}.png")
-plt.savefig(output_plot_path, dpi=300)  # Set higher DPI for better resolution
-plt.close()
-
-print(f"Plot saved: {output_plot_path}")
+import argparse
+import pandas as pd
+from ensemble_stats import trajectory_files, read_viscosity_file, normalize_method
+from instrumentation import stage, profile_run, set_label
+
+
+def parser(argv=None):
+    parser = argparse.ArgumentParser(description='Plot the viscosity of all trajectories vs time in one graph.')
+    parser.add_argument('method', nargs='?', help='GK or Einstein (asked interactively if omitted).')
+    args = parser.parse_args(argv)
+
+    # input method GK or Einstein
+    if args.method is None:
+        args.method = input("Enter the method (GK or Einstein): ")
+    args.method = normalize_method(args.method)
+    return args
+
+
+def main(argv=None):
+    method = parser(argv).method
+    set_label(method)
+
+    # Per-trajectory curves are read from Viscosity_Data, the ensemble curves from the summary file
+    input_csv = f"Trajectory_Analysis_CSV_Files/avg_min_max_visc_{method}.csv"
+
+    # Read the CSV files
+    data = pd.read_csv(input_csv)
+    for name, path in trajectory_files(method):
+        time, values = read_viscosity_file(path)
+        trajectory = pd.Series(values, index=time)
+        # CSV and .npz tables may differ in the last digit of the time, so match within a tolerance
+        data[f"viscosity(Pa.s) ({name})"] = trajectory.reindex(data["time(ps)"], method="nearest",
+                                                               tolerance=1e-9).to_numpy()
+
+    # Extract the "time(ps)" column
+    time = data["time(ps)"]
+
+    # Convert all viscosity columns from Pa·s to mPa·s (multiply by 1000)
+    viscosity_columns = [col for col in data.columns if "viscosity(Pa.s)" in col]
+    for col in viscosity_columns:
+        data[col] = data[col] * 1000
+
+    # Plot all viscosity columns on a single graph
+    with stage("plot"):
+        import plotting
+        output_plot_path = plotting.plot_trajectories(time, data, viscosity_columns, method)
+
+    print(f"Plot saved: {output_plot_path}")
+
+
+if __name__ == "__main__":
+    with profile_run("plot_visc_trajs"):
+        main()
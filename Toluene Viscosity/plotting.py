@@ -0,0 +1,336 @@
+# --------------------------------------------------------------------------------------------
+
+# Plotting functions of the viscosity scripts.
+
+# matplotlib is only imported by this module, and the scripts only import this module
+# when a plot is actually requested, so runs with plotting disabled (--no-plots, or
+# viscosity_calculation.py without -p) never pay the matplotlib start-up cost.
+# The non-interactive Agg backend is used since all figures are written to files.
+
+# Rendering cost is kept down in three ways:
+#   - Series longer than max_points are reduced to min/max envelopes before drawing
+#     (envelope_indices()): every bucket of samples keeps its smallest and largest value,
+#     so spikes and the band of noisy curves look the same as with all points.
+#   - A figure is not drawn again if the PNG exists and was made from the same data: a
+#     key (hash of the data and labels) is stored next to it as .<figure>.png.key.
+#     Set VISCO_REPLOT=1 to redraw all figures.
+#   - Independent figures can be drawn in a process pool with render_figures().
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+from instrumentation import stage
+
+# Default output directory for the plots of the analysis scripts
+plots_dir = "Plots"
+
+# Longest series drawn point by point (about the pixel width of the largest figure)
+max_points = 4000
+
+# Environment variable forcing all figures to be redrawn
+replot_variable = "VISCO_REPLOT"
+
+# Changed whenever the look of the figures changes, so that stored keys no longer match
+figure_version = 1
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def envelope_indices(*series, points=max_points):
+    '''
+    Sorted indices of the samples to draw for series of equal length: the first and last
+    sample and, in each of about points/2 buckets, the minimum and maximum of every series.
+    All indices are returned for series of at most `points` samples.
+    '''
+    n = len(series[0])
+    if n <= points:
+        return np.arange(n)
+
+    size = -(-n // max(1, points // 2))
+    buckets = -(-n // size)
+    keep = [np.array([0, n - 1])]
+    for values in series:
+        values = np.asarray(values, dtype=float)
+        padded = np.full(buckets * size, np.nan)
+        padded[:n] = values
+        padded = padded.reshape(buckets, size)
+        valid = ~np.isnan(padded).all(axis=1)
+        offsets = np.arange(buckets)[valid] * size
+        with np.errstate(invalid="ignore"):
+            keep += [offsets + np.nanargmin(padded[valid], axis=1), offsets + np.nanargmax(padded[valid], axis=1)]
+    return np.unique(np.concatenate(keep))
+
+
+def envelope(x, y, points=max_points):
+    '''(x, y) reduced to the samples of envelope_indices().'''
+    x, y = np.asarray(x), np.asarray(y)
+    index = envelope_indices(y, points=points)
+    return x[index], y[index]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def figure_key(*items):
+    '''Hash of the data and parameters of a figure (arrays by content, everything else by repr).'''
+    digest = hashlib.blake2b(f"{figure_version} {max_points}".encode(), digest_size=16)
+    for item in items:
+        if isinstance(item, (str, int, float, tuple, list, type(None))):
+            digest.update(repr(item).encode())
+        else:
+            array = np.ascontiguousarray(np.asarray(item))
+            digest.update(f"{array.dtype}{array.shape}".encode())
+            digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def _key_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.key")
+
+
+def unchanged(path, key):
+    '''True if the figure `path` exists and was drawn from data with this key.'''
+    if os.environ.get(replot_variable, "") not in ("", "0") or not os.path.isfile(path):
+        return False
+    try:
+        with open(_key_path(path)) as file:
+            return file.read().strip() == key
+    except OSError:
+        return False
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Save the current figure (timed as stage "savefig" when profiling, see instrumentation.py)
+# and remember the key of its data
+def savefig(path, key=None, **kwargs):
+    with stage("savefig"):
+        plt.savefig(path, **kwargs)
+    if key is not None:
+        with open(_key_path(path), "w") as file:
+            file.write(key)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def _render(name, args, kwargs):
+    return globals()[name](*args, **kwargs)
+
+
+def render_figures(jobs, workers=None):
+    '''
+    Draw independent figures, each given as (plotting function name, args, kwargs), in a pool
+    of `workers` processes (one per figure if None, sequentially with workers=1). Returns
+    the values of the plotting functions in the order of the jobs.
+    '''
+    workers = len(jobs) if workers is None else workers
+    workers = max(1, min(workers, len(jobs), os.cpu_count() or 1))
+    if workers == 1:
+        return [_render(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_render, *zip(*jobs)))
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Single time series of viscosity_calculation.py (running viscosity or ACF)
+def plot_series(time, values, label, ylabel, title, path):
+    key = figure_key(time, values, label, ylabel, title)
+    if unchanged(path, key):
+        return path
+
+    plt.figure(figsize=(8,6))
+    plt.plot(*envelope(time, values), label=label)
+    plt.xlabel('Time (ps)')
+    plt.ylabel(ylabel)
+    plt.title(title)
+    plt.legend()
+    plt.tight_layout()
+    savefig(path, key)
+    plt.close()
+    return path
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Standard deviation across trajectories (standard_deviation.py)
+def plot_std(time_ns, std_visc, method):
+    os.makedirs(plots_dir, exist_ok=True)
+    path = os.path.join(plots_dir, f"std_{method}.png")
+    key = figure_key(time_ns, std_visc)
+    if unchanged(path, key):
+        return path
+
+    plt.figure()
+    plt.plot(*envelope(time_ns, std_visc), label="Std Viscosity")
+    plt.xlabel("Time (ns)")
+    plt.ylabel("Standard Deviation (Pa.s)")
+    plt.title("Std vs Time")
+    plt.legend()
+    savefig(path, key)
+    plt.close()
+    return path
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Average viscosity with the min-max range (plot_avg_max_min_visc.py), values in mPa.s
+def plot_avg_min_max(time, average, minimum, maximum, method):
+    os.makedirs(plots_dir, exist_ok=True)
+    path = os.path.join(plots_dir, f"avg_min_max_visc_{method}.png")
+    key = figure_key(time, average, minimum, maximum)
+    if unchanged(path, key):
+        return path
+
+    # Samples keeping the extremes of all three curves
+    index = envelope_indices(average, minimum, maximum)
+    time, average = np.asarray(time)[index], np.asarray(average)[index]
+    minimum, maximum = np.asarray(minimum)[index], np.asarray(maximum)[index]
+
+    plt.figure(figsize=(12, 8))
+
+    # Fill the area between Minimum and Maximum viscosities with light yellow
+    plt.fill_between(
+        time,
+        minimum,
+        maximum,
+        color="lightblue",
+        label="Range (Min-Max)"
+    )
+
+    # Plot the Average Viscosity line in royal blue
+    plt.plot(time, average, label="Average Viscosity", color="royalblue", linewidth=2)
+
+    # Customize the plot
+    plt.xlabel("Time (ps)", fontsize=14)
+    plt.ylabel("Viscosity (mPa.s)", fontsize=14)
+    plt.title("Average, Min, and Max Viscosity vs Time (in mPa.s)", fontsize=16)
+    plt.legend(loc="best", fontsize=12)
+    plt.grid(True)
+
+    # Save the plot
+    savefig(path, key)
+    plt.close()
+    return path
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# All viscosity columns of a DataFrame in one graph (plot_visc_trajs.py), values in mPa.s
+def plot_trajectories(time, data, viscosity_columns, method):
+    os.makedirs(plots_dir, exist_ok=True)
+    path = os.path.join(plots_dir, f"visc_trajs_plot_{method}.png")
+    key = figure_key(time, data[viscosity_columns].to_numpy(), list(viscosity_columns))
+    if unchanged(path, key):
+        return path
+
+    plt.figure(figsize=(16, 12))  # Increased figure size for higher resolution
+
+    for col in viscosity_columns:
+        x, y = envelope(time, data[col])
+        if "Average" in col:
+            plt.plot(x, y, label=col.replace("Pa.s", "mPa.s"), linestyle="--", linewidth=2)
+        elif "Minimum" in col:
+            plt.plot(x, y, label=col.replace("Pa.s", "mPa.s"), linestyle=":", linewidth=2, color="blue")
+        elif "Maximum" in col:
+            plt.plot(x, y, label=col.replace("Pa.s", "mPa.s"), linestyle="-.", linewidth=2, color="red")
+        else:
+            plt.plot(x, y, label=col.replace("Pa.s", "mPa.s"), alpha=0.6)  # Individual viscosities with transparency
+
+    # Customize the plot
+    plt.xlabel("Time (ps)", fontsize=14)
+    plt.ylabel("Viscosity (mPa.s)", fontsize=14)
+    plt.title("All Viscosities vs Time (in mPa.s)", fontsize=16)
+    plt.legend(loc="best", fontsize=10)
+    plt.grid(True)
+
+    # Save the plot
+    savefig(path, key, dpi=300)  # Set higher DPI for better resolution
+    plt.close()
+    return path
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Mean viscosity with its double exponential fit (double_exp_fit_avgvisc.py)
+def plot_double_exp_fit(time, visc, fitted, params, visc_at_tcut, method):
+    os.makedirs(plots_dir, exist_ok=True)
+    path = os.path.join(plots_dir, f"fitted_avgvisc_{method}.png")
+    key = figure_key(time, visc, fitted, params, visc_at_tcut)
+    if unchanged(path, key):
+        return path
+
+    plt.figure()
+    plt.text(0.05, 0.85, f"Viscosity = {visc_at_tcut:.4g} mPa.s", transform=plt.gca().transAxes, fontsize=10)
+    plt.plot(*envelope(time, visc*1000), label="Data", linewidth=1)
+    plt.plot(*envelope(time, fitted * 1000), color="red", label="Fitted Curve", linewidth=1)
+    plt.text(0.05, 0.9, f"A={params[0]:.4g}, a={params[1]:.4g}, T1={params[2]:.4g}, T2={params[3]:.4g}", transform=plt.gca().transAxes, fontsize=10)
+    plt.xlabel("Time (ns)")
+    plt.ylabel("Mean Viscosity (mPa.s)")
+    plt.legend()
+    savefig(path, key)
+    plt.close()
+    return path
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Standard deviation with its power law fit (fit_std_power_law.py)
+def plot_power_law_fit(x, y, fitted, A, B, method):
+    os.makedirs(plots_dir, exist_ok=True)
+    path = os.path.join(plots_dir, f"fitted_std_{method}.png")
+    key = figure_key(x, y, fitted, A, B)
+    if unchanged(path, key):
+        return path
+
+    plt.figure()
+    plt.plot(*envelope(x, y), label="Data", linewidth=1)
+    plt.plot(*envelope(x, fitted), color="red", label="Fitted Curve", linewidth=1)
+    plt.text(0.05, 0.9, f"A={A:.4g}, B={B:.4g}", transform=plt.gca().transAxes, fontsize=10)
+    plt.xlabel("Time (ns)")
+    plt.ylabel("Standard Deviation")
+    plt.legend()
+    savefig(path, key)
+    plt.close()
+    return path
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Frequency-dependent viscosity of spectral_viscosity.py (the f = 0 point is left out of the log axis;
+# all frequencies are drawn since envelope buckets would merge the low frequencies)
+def plot_spectral_viscosity(frequency, viscosity, error, path):
+    key = figure_key(frequency, viscosity, error)
+    if unchanged(path, key):
+        return path
+
+    plt.figure(figsize=(8,6))
+    plt.fill_between(frequency[1:], (viscosity - error)[1:] * 1000, (viscosity + error)[1:] * 1000,
+                     color="lightblue", label="Standard error")
+    plt.plot(frequency[1:], viscosity[1:] * 1000, label="Viscosity (spectral)")
+    plt.xscale("log")
+    plt.xlabel('Frequency (THz)')
+    plt.ylabel('Viscosity (mPa.s)')
+    plt.title(f'Viscosity vs Frequency (f = 0: {viscosity[0] * 1000:.4g} +/- {error[0] * 1000:.2g} mPa.s)')
+    plt.legend()
+    plt.tight_layout()
+    savefig(path, key)
+    plt.close()
+    return path
+
+
+def plot_block_errors(curves, summary, path):
+    '''Flyvbjerg-Petersen curves: standard error against block size, relative to the chosen plateau.'''
+    key = figure_key(*[values for curve in curves.values() for values in curve], sorted(summary))
+    if unchanged(path, key):
+        return path
+
+    plt.figure(figsize=(8,6))
+    for name, (sizes, errors) in curves.items():
+        line, = plt.plot(sizes, errors / summary[name]["std_error"], marker="o", markersize=3, label=name)
+        plt.plot(summary[name]["block_size"], 1.0, marker="*", markersize=10, color=line.get_color())
+    plt.axhline(1.0, color="grey", linestyle="--", linewidth=0.8)
+    plt.xscale("log", base=2)
+    plt.xlabel('Block size (steps)')
+    plt.ylabel('Standard error / plateau value')
+    plt.title('Block Averaging (Flyvbjerg-Petersen)')
+    plt.legend(fontsize="small", ncol=2)
+    plt.tight_layout()
+    savefig(path, key)
+    plt.close()
+    return path
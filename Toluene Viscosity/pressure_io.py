@@ -0,0 +1,379 @@
+# --------------------------------------------------------------------------------------------
+
+# Streaming ingestion of pressure tensor data for viscosity_calculation.py
+
+# The six Stress columns are read from the CSV file in fixed-size chunks and copied
+# straight into a preallocated (6, steps) NumPy buffer (one contiguous row per component).
+# Unit conversion and the missing-value check are done in place on each chunk, so the
+# whole file never exists as a pandas DataFrame.
+
+# Files that are still being written by a running MD job can be followed with
+# tail_pressure_chunks(), which yields blocks as complete lines are appended.
+
+# Parsed tensors can also be kept in an on-disk cache keyed by the content hash of the
+# CSV file. The first read stores the raw six columns as a (6, rows) float64 .npy file;
+# later runs open it with np.load(mmap_mode='r') and slice the first `steps` rows
+# without parsing any text.
+
+# Several trajectories can be stacked into one (M, 6, rows) array (in memory or in a
+# memory-mapped .npy file) with read_pressure_tensors(), for evaluating them in one call.
+# iter_pressure_tensor() yields a trajectory in converted blocks for streaming estimators.
+
+# Files that are not CSV (LAMMPS logs and fix ave/time files, GROMACS .xvg, NumPy and raw
+# binary records) are read by the pluggable readers of stress_readers.py, which yield the
+# same raw (6, rows) blocks, so unit conversion, caching and all estimators work unchanged.
+
+# -------------------------------------------------------------------------------------------
+
+import io
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Columns expected in the pressure tensor CSV file (a 'Frame' column is ignored)
+expected_columns = ['StressXX', 'StressYY', 'StressZZ', 'StressXY', 'StressXZ', 'StressYZ']
+
+# Conversion ratio from atm/bar/GPa to Pa
+conversion_factors = {
+    'Pa': 1,
+    'atm': 101325,
+    'bar': 100000,
+    'GPa': 1e9
+}
+
+# Default number of rows parsed per chunk
+default_chunk_size = 100000
+
+# Default directory of the binary pressure tensor cache
+default_cache_dir = "Pressure_Tensor_Cache"
+
+
+class PressureDataError(Exception):
+    '''Raised when the pressure tensor file cannot be read or fails validation.'''
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def _open_chunks(datafile, steps, chunk_size):
+    try:
+        # Skip malformed lines by setting on_bad_lines to 'skip'
+        return pd.read_csv(datafile, usecols=expected_columns, nrows=steps, chunksize=chunk_size,
+                           on_bad_lines='skip')
+    except TypeError:
+        # For older versions of pandas that don't have on_bad_lines
+        return pd.read_csv(datafile, usecols=expected_columns, nrows=steps, chunksize=chunk_size,
+                           error_bad_lines=False, warn_bad_lines=True)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def is_csv(datafile):
+    return os.path.splitext(datafile)[1].lower() == ".csv"
+
+
+def check_input(datafile):
+    '''Validate the header of a pressure tensor file of any supported format.'''
+    if is_csv(datafile):
+        return check_columns(datafile)
+    import stress_readers
+    stress_readers.reader_for(datafile).check(datafile)
+
+
+def cacheable(datafile):
+    '''False for formats that are already binary and memory-mapped directly (no cache needed).'''
+    if is_csv(datafile):
+        return True
+    import stress_readers
+    return stress_readers.reader_for(datafile).cacheable
+
+
+def input_files(directory):
+    '''Sorted paths of the NVT*_stress_tensor.<ext> trajectories in directory, for every supported format.'''
+    import stress_readers
+    extensions = {".csv", *stress_readers.extensions()}
+    names = (f for f in os.listdir(directory) if f.startswith("NVT"))
+    return [os.path.join(directory, f) for f in sorted(names)
+            if os.path.splitext(f)[0].endswith("_stress_tensor") and os.path.splitext(f)[1].lower() in extensions]
+
+
+def check_columns(datafile):
+    '''Validate the header of the pressure tensor file without reading any data rows.'''
+    try:
+        columns = pd.read_csv(datafile, nrows=0).columns
+    except Exception as e:
+        raise PressureDataError(f"Error reading the data file with Pandas: {e}")
+
+    if not all(col in columns for col in expected_columns):
+        raise PressureDataError(f"Error: CSV file must contain the following columns: {expected_columns}")
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def iter_pressure_chunks(datafile, steps=None, chunk_size=default_chunk_size):
+    '''
+    Yield the raw (unconverted) pressure tensor as float64 arrays of shape (6, rows),
+    one per chunk of at most chunk_size rows, in the order of expected_columns.
+    '''
+    if not is_csv(datafile):
+        import stress_readers
+        yield from stress_readers.reader_for(datafile).iter_chunks(datafile, steps, chunk_size)
+        return
+
+    check_columns(datafile)
+
+    try:
+        reader = _open_chunks(datafile, steps, chunk_size)
+        for chunk in reader:
+            # Reorder to expected_columns (usecols keeps the file order)
+            chunk = chunk[expected_columns]
+
+            try:
+                block = chunk.to_numpy(dtype=np.float64).T
+            except ValueError:
+                raise PressureDataError("Error: Non-numeric values found in the data file.")
+
+            if np.isnan(block).any():
+                raise PressureDataError("Error: CSV file contains missing values. Please clean the data before proceeding.")
+
+            yield block
+    except PressureDataError:
+        raise
+    except Exception as e:
+        raise PressureDataError(f"Error reading the data file with Pandas: {e}")
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def tail_pressure_chunks(datafile, steps=None, chunk_size=default_chunk_size, poll_interval=5.0, idle_timeout=None):
+    '''
+    Follow a pressure tensor file that is still being written, like `tail -f`.
+    Yields the raw pressure tensor as float64 arrays of shape (6, rows) as complete lines are
+    appended, until `steps` rows were read or the file did not grow for idle_timeout seconds
+    (None: wait forever).
+    '''
+    check_columns(datafile)
+
+    with open(datafile, "rb") as file:
+        columns = file.readline().decode().strip().split(",")
+        buffer = b""
+        rows = 0
+        idle_since = time.monotonic()
+
+        while steps is None or rows < steps:
+            data = file.read(1 << 24)
+            if not data:
+                if idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+                    break
+                time.sleep(poll_interval)
+                continue
+            idle_since = time.monotonic()
+
+            # Only parse complete lines; a partially written last line stays in the buffer
+            buffer += data
+            end = buffer.rfind(b"\n") + 1
+            if end == 0:
+                continue
+            lines, buffer = buffer[:end], buffer[end:]
+
+            try:
+                chunk = pd.read_csv(io.BytesIO(lines), header=None, names=columns, on_bad_lines='skip')
+                block = chunk[expected_columns].to_numpy(dtype=np.float64).T
+            except ValueError:
+                raise PressureDataError("Error: Non-numeric values found in the data file.")
+            except Exception as e:
+                raise PressureDataError(f"Error reading the data file with Pandas: {e}")
+
+            if np.isnan(block).any():
+                raise PressureDataError("Error: CSV file contains missing values. Please clean the data before proceeding.")
+
+            if steps is not None:
+                block = block[:, :steps - rows]
+            for start in range(0, block.shape[1], chunk_size):
+                yield block[:, start:start + chunk_size]
+            rows += block.shape[1]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def read_pressure_tensor(datafile, steps, unit='atm', dtype=np.float64, chunk_size=default_chunk_size, out=None):
+    '''
+    Read the first `steps` rows of the pressure tensor file into a (6, rows) array in [Pa].
+    Rows are Pxx, Pyy, Pzz, Pxy, Pxz, Pyz; each row is contiguous in memory.
+    `out` may be a preallocated (6, steps) array (e.g. one slice of a stacked array).
+    '''
+    conv_ratio = conversion_factors.get(unit, 1)
+
+    # Preallocate the output once; chunks are converted directly into it
+    pressure = np.empty((6, steps), dtype=dtype) if out is None else out
+    rows = 0
+
+    for block in iter_pressure_chunks(datafile, steps, chunk_size):
+        n = block.shape[1]
+        np.multiply(block, conv_ratio, out=pressure[:, rows:rows + n], casting='same_kind')
+        rows += n
+
+    if rows == 0:
+        raise PressureDataError("Error: No data was read from the input file.")
+
+    # Malformed lines may have been skipped: return a view on the rows actually read
+    return pressure[:, :rows]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def _scan_file(datafile, block_size=1 << 24):
+    '''Return the BLAKE2b content hash of the file and its number of lines in one pass.'''
+    digest = hashlib.blake2b(digest_size=16)
+    lines = 0
+    with open(datafile, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+            lines += block.count(b"\n")
+    return digest.hexdigest(), lines + 1
+
+
+def _write_json(path, record):
+    # Write to a temporary file first so that concurrent runs never see a partial record
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(record, file)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def cached_tensor_path(datafile, cache_dir=default_cache_dir, chunk_size=default_chunk_size):
+    '''
+    Return the path of the cached raw (6, rows) tensor of datafile, building it if needed.
+
+    Invalidation rule: the content hash of a source file is remembered together with its
+    size and modification time. When either changes the file is hashed again, and a new
+    cache entry is built only if the content itself changed.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+
+    source = os.path.abspath(datafile)
+    stat = os.stat(source)
+    source_key = hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
+    source_record_path = os.path.join(cache_dir, f"{source_key}.source.json")
+
+    record = _read_json(source_record_path)
+    if record and record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+        digest, lines = record["digest"], record["lines"]
+    else:
+        digest, lines = _scan_file(source)
+        _write_json(source_record_path, {
+            "source": source, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "digest": digest, "lines": lines
+        })
+
+    tensor_path = os.path.join(cache_dir, f"{digest}.npy")
+    meta_path = os.path.join(cache_dir, f"{digest}.json")
+
+    # The metadata file is written last and marks a complete cache entry
+    if _read_json(meta_path) is None:
+        check_input(source)
+
+        # The number of lines is an upper bound on the number of data rows
+        tmp_path = f"{tensor_path}.{os.getpid()}.tmp"
+        tensor = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float64, shape=(6, lines))
+        rows = 0
+        try:
+            for block in iter_pressure_chunks(source, None, chunk_size):
+                n = block.shape[1]
+                tensor[:, rows:rows + n] = block
+                rows += n
+            tensor.flush()
+        except BaseException:
+            del tensor
+            os.remove(tmp_path)
+            raise
+        del tensor
+
+        os.replace(tmp_path, tensor_path)
+        _write_json(meta_path, {"source": source, "rows": rows, "columns": expected_columns})
+
+    return tensor_path
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def read_pressure_tensor_cached(datafile, steps, unit='atm', dtype=np.float64, chunk_size=default_chunk_size,
+                                cache_dir=default_cache_dir, out=None):
+    '''
+    Same as read_pressure_tensor, but served from the binary cache in cache_dir.
+    Data in [Pa] and float64 is returned as a read-only memory map without any copy,
+    unless `out` is given. Binary formats are read directly.
+    '''
+    if not cacheable(datafile):
+        return read_pressure_tensor(datafile, steps, unit=unit, dtype=dtype, chunk_size=chunk_size, out=out)
+
+    tensor_path = cached_tensor_path(datafile, cache_dir, chunk_size)
+    rows = min(steps, _read_json(os.path.splitext(tensor_path)[0] + ".json")["rows"])
+
+    if rows == 0:
+        raise PressureDataError("Error: No data was read from the input file.")
+
+    raw = np.load(tensor_path, mmap_mode="r")[:, :rows]
+
+    conv_ratio = conversion_factors.get(unit, 1)
+    if out is None and conv_ratio == 1 and np.dtype(dtype) == raw.dtype:
+        return raw
+
+    pressure = np.empty((6, rows), dtype=dtype) if out is None else out[:, :rows]
+    np.multiply(raw, conv_ratio, out=pressure, casting='same_kind')
+    return pressure
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def read_pressure_tensors(datafiles, steps, unit='atm', dtype=np.float64, chunk_size=default_chunk_size,
+                          cache=True, cache_dir=default_cache_dir, out=None):
+    '''
+    Stack the first `steps` rows of several pressure tensor files into an (M, 6, rows) array
+    in [Pa], rows being the length of the shortest file. Each file is converted directly into
+    its slice of the stack; `out` may be a preallocated (M, 6, steps) array, e.g. a memory map
+    opened with np.lib.format.open_memmap to keep the stack on disk.
+    '''
+    pressure = np.empty((len(datafiles), 6, steps), dtype=dtype) if out is None else out
+    rows = steps
+
+    for i, datafile in enumerate(datafiles):
+        if cache:
+            P = read_pressure_tensor_cached(datafile, steps, unit=unit, dtype=dtype, chunk_size=chunk_size,
+                                            cache_dir=cache_dir, out=pressure[i])
+        else:
+            P = read_pressure_tensor(datafile, steps, unit=unit, dtype=dtype, chunk_size=chunk_size, out=pressure[i])
+        rows = min(rows, P.shape[1])
+
+    return pressure[..., :rows]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def iter_pressure_tensor(datafile, steps=None, unit='atm', chunk_size=default_chunk_size, cache=True,
+                         cache_dir=default_cache_dir):
+    '''
+    Yield the first `steps` rows (all rows if None) of the pressure tensor in [Pa] as float64
+    blocks of shape (6, rows) with at most chunk_size rows, from the memory-mapped binary cache
+    or by parsing the CSV file, for estimators that stream over a trajectory.
+    '''
+    conv_ratio = conversion_factors.get(unit, 1)
+    if cache and cacheable(datafile):
+        tensor_path = cached_tensor_path(datafile, cache_dir, chunk_size)
+        rows = _read_json(os.path.splitext(tensor_path)[0] + ".json")["rows"]
+        rows = rows if steps is None else min(steps, rows)
+        # The cache file may hold more (unused) rows than were read from the source
+        raw = np.load(tensor_path, mmap_mode="r")[:, :rows]
+        blocks = (raw[:, start:start + chunk_size] for start in range(0, rows, chunk_size))
+    else:
+        blocks = iter_pressure_chunks(datafile, steps, chunk_size)
+
+    rows = 0
+    for block in blocks:
+        rows += block.shape[1]
+        yield block * conv_ratio
+
+    if rows == 0:
+        raise PressureDataError("Error: No data was read from the input file.")
@@ -0,0 +1,274 @@
+# --------------------------------------------------------------------------------------------
+
+# Non-interactive driver of the whole analysis chain.
+
+# Every script of the chain is a stage with a command line, declared input and output files
+# (glob patterns) and the stages it has to wait for. A stage is run again only when the
+# signature of its inputs (modification time and size of every matched file, or their
+# content hashes with --hash) or its command line changed since its last successful run,
+# or when one of its outputs is missing. Signatures are kept in pipeline_state.json.
+
+# Stages run as separate processes with stdin closed, so no script can wait for input();
+# their output goes to Trajectory_Analysis_CSV_Files/pipeline_logs/<stage>.log. Stages whose
+# dependencies are done run concurrently, e.g. the GK and Einstein branches.
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from ensemble_stats import methods, normalize_method, viscosity_data_dir, analysis_dir
+import instrumentation
+
+# A stage of the pipeline: script (in this directory) with its arguments, the glob patterns
+# of its input and output files and the names of the stages it depends on
+Stage = namedtuple("Stage", ["name", "script", "args", "inputs", "outputs", "after"])
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+state_file = os.path.join(analysis_dir, "pipeline_state.json")
+log_dir = os.path.join(analysis_dir, "pipeline_logs")
+plots_dir = "Plots"
+
+
+def parser(argv=None):
+    parser = argparse.ArgumentParser(description='Run the viscosity analysis chain, redoing only stages whose inputs changed.')
+    parser.add_argument('--methods', nargs='+', default=methods,
+                        help='Methods to analyse. Default is: ' + ' '.join(methods) + '.')
+    parser.add_argument('-t', '--threshold', type=float, default=0.4,
+                        help='Ratio std_visc / mean_visc that defines t_cut. Default is 0.4.')
+    parser.add_argument('--input-dir', default="NVT_Trajectories",
+                        help='Directory of the pressure tensor files. Default is NVT_Trajectories.')
+    parser.add_argument('--skip-trajectories', action='store_true',
+                        help='Do not run generate_visc_data_all_files.py; only analyse the existing Viscosity_Data.')
+    parser.add_argument('--no-plots', action='store_true', help='Do not create any plots.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Maximum number of stages run at the same time. Default is the number of CPUs.')
+    parser.add_argument('--hash', action='store_true',
+                        help='Compare input files by content hash instead of modification time and size.')
+    parser.add_argument('-f', '--force', action='store_true', help='Run all stages.')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Only list the stages that are out of date.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write timing reports of every stage and of the pipeline to Profiles/ (same as VISCO_PROFILE=1).')
+    parser.add_argument('calc_args', nargs=argparse.REMAINDER,
+                        help='Arguments for viscosity_calculation.py after "--" (see generate_visc_data_all_files.py).')
+    args = parser.parse_args(argv)
+
+    args.methods = [normalize_method(method) for method in args.methods]
+    if args.calc_args and args.calc_args[0] == "--":
+        args.calc_args = args.calc_args[1:]
+    return args
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def build_stages(args):
+    '''The stages of the analysis chain for the given options, in a valid execution order.'''
+    no_plots = ["--no-plots"] if args.no_plots else []
+    plot = (lambda path: []) if args.no_plots else (lambda path: [os.path.join(plots_dir, path)])
+    stages = []
+
+    calc = []
+    if not args.skip_trajectories and os.path.isdir(args.input_dir):
+        calc = ["trajectories"]
+        calc_args = ["--", *args.calc_args] if args.calc_args else []
+        stages.append(Stage("trajectories", "generate_visc_data_all_files.py",
+                            ["--input-dir", args.input_dir, *no_plots, *calc_args],
+                            [os.path.join(args.input_dir, "NVT*_stress_tensor.*")],
+                            [os.path.join(viscosity_data_dir, "*", "avg_acf.*")], []))
+
+    for m in args.methods:
+        trajectories = [os.path.join(viscosity_data_dir, "*", f"viscosity_{m}{ext}") for ext in (".csv", ".npz")]
+        summary = os.path.join(analysis_dir, f"avg_min_max_visc_{m}.csv")
+        std = os.path.join(analysis_dir, f"std_{m}.csv")
+        threshold = str(args.threshold)
+
+        stages += [
+            Stage(f"aggregate-{m}", "calculate_avg_max_min.py", [m], trajectories, [summary, std], calc),
+            Stage(f"t_cut-{m}", "t_cut.py", [m, "-t", threshold], [std],
+                  [os.path.join(analysis_dir, f"t_cut_{m}.csv")], [f"aggregate-{m}"]),
+            Stage(f"double_exp-{m}", "double_exp_fit_avgvisc.py", [m, "-t", threshold, *no_plots], [std],
+                  [os.path.join(analysis_dir, f"double_exp_fit_{m}.csv"), *plot(f"fitted_avgvisc_{m}.png")],
+                  [f"aggregate-{m}"]),
+            Stage(f"power_law-{m}", "fit_std_power_law.py", [m, *no_plots], [std],
+                  [os.path.join(analysis_dir, f"power_law_fit_{m}.csv"), *plot(f"fitted_std_{m}.png")],
+                  [f"aggregate-{m}"]),
+        ]
+        if not args.no_plots:
+            stages += [
+                Stage(f"plot_std-{m}", "standard_deviation.py", [m], [std], plot(f"std_{m}.png"), [f"aggregate-{m}"]),
+                Stage(f"plot_avg_min_max-{m}", "plot_avg_max_min_visc.py", [m], [summary],
+                      plot(f"avg_min_max_visc_{m}.png"), [f"aggregate-{m}"]),
+                Stage(f"plot_trajectories-{m}", "plot_visc_trajs.py", [m], [summary, *trajectories],
+                      plot(f"visc_trajs_plot_{m}.png"), [f"aggregate-{m}"]),
+            ]
+
+    return stages
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def file_digest(path, block_size=1 << 24):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def signature(stage, use_hash, previous):
+    '''{path: [mtime_ns, size] or [mtime_ns, size, digest]} of all inputs, plus the command line.'''
+    files = {}
+    for pattern in stage.inputs:
+        for path in sorted(glob.glob(pattern)):
+            stat = os.stat(path)
+            entry = [stat.st_mtime_ns, stat.st_size]
+            if use_hash:
+                # Only files whose time or size changed are hashed again
+                old = previous.get("files", {}).get(path, [])
+                entry.append(old[2] if old[:2] == entry and len(old) == 3 else file_digest(path))
+            files[path] = entry
+    return {"command": [stage.script, *stage.args], "files": files}
+
+
+def same_signature(current, previous, use_hash):
+    if current["command"] != previous.get("command") or current["files"].keys() != previous.get("files", {}).keys():
+        return False
+    if use_hash:
+        return all(len(old) == 3 and old[2] == new[2] for new, old in
+                   ((current["files"][path], previous["files"][path]) for path in current["files"]))
+    return all(current["files"][path] == previous["files"][path][:2] for path in current["files"])
+
+
+def outputs_exist(stage):
+    return all(glob.glob(pattern) for pattern in stage.outputs)
+
+
+def load_state():
+    try:
+        with open(state_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    os.makedirs(analysis_dir, exist_ok=True)
+    tmp_path = f"{state_file}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(state, file, indent=1)
+    os.replace(tmp_path, state_file)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def run_stage(stage):
+    '''Run the script of a stage with its output in the stage log; returns (elapsed time, error or None).'''
+    os.makedirs(log_dir, exist_ok=True)
+    start = time.perf_counter()
+    with open(os.path.join(log_dir, f"{stage.name}.log"), "w") as log:
+        returncode = subprocess.run([sys.executable, os.path.join(script_dir, stage.script), *stage.args],
+                                    stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT).returncode
+    elapsed = time.perf_counter() - start
+
+    if returncode != 0:
+        return elapsed, f"exit code {returncode}"
+    if not outputs_exist(stage):
+        return elapsed, "outputs were not written"
+    return elapsed, None
+
+
+def run_pipeline(stages, args):
+    '''Run the out-of-date stages in dependency order; returns the names of the failed stages.'''
+    state = load_state()
+    lock = threading.Lock()
+    status = {}  # name -> "done", "skipped" or "failed"
+    pending = list(stages)
+    running = {}
+
+    def finish(stage, current, result):
+        # Record the input signature taken before the run once the stage succeeded
+        elapsed, error = result
+        if error is None:
+            with lock:
+                state[stage.name] = current
+                save_state(state)
+        return elapsed, error
+
+    timings = []
+    started, start = time.strftime("%Y-%m-%dT%H:%M:%S"), time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        while pending or running:
+            for stage in list(pending):
+                if any(status.get(dep) is None for dep in stage.after):
+                    continue
+                pending.remove(stage)
+
+                if any(status[dep] == "failed" for dep in stage.after):
+                    status[stage.name] = "failed"
+                    print(f"[skip] {stage.name}: a dependency failed")
+                    continue
+
+                # The signature is taken once the dependencies have written their outputs
+                current = signature(stage, args.hash, state.get(stage.name, {}))
+                if not args.force and outputs_exist(stage) and same_signature(current, state.get(stage.name, {}), args.hash):
+                    status[stage.name] = "skipped"
+                    print(f"[up to date] {stage.name}")
+                    continue
+
+                if args.dry_run:
+                    status[stage.name] = "done"
+                    print(f"[would run] {stage.name}: {stage.script} {' '.join(stage.args)}")
+                    continue
+
+                print(f"[run] {stage.name}: {stage.script} {' '.join(stage.args)}")
+                running[executor.submit(lambda s=stage, c=current: finish(s, c, run_stage(s)))] = stage
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                elapsed, error = future.result()
+                timings.append({"stage": stage.name, "calls": 1, "seconds": elapsed, "peak_rss_mb": None,
+                                "peak_growth_mb": None})
+                if error is None:
+                    status[stage.name] = "done"
+                    print(f"[done] {stage.name} ({elapsed:.1f} s)")
+                else:
+                    status[stage.name] = "failed"
+                    print(f"[failed] {stage.name} ({elapsed:.1f} s): {error}, "
+                          f"see {os.path.join(log_dir, stage.name + '.log')}")
+
+    if instrumentation.enabled() and timings:
+        # Wall time of every stage process; the stages write their own detailed reports
+        instrumentation.write_report({"script": "run_pipeline", "label": None, "pid": os.getpid(), "started": started,
+                                      "total_seconds": time.perf_counter() - start, "peak_rss_mb": None,
+                                      "stages": timings})
+
+    return [name for name, result in status.items() if result == "failed"]
+
+
+def main(argv=None):
+    args = parser(argv)
+    if args.profile:
+        instrumentation.enable()
+    stages = build_stages(args)
+
+    start = time.perf_counter()
+    failed = run_pipeline(stages, args)
+    print(f"\nPipeline finished in {time.perf_counter() - start:.1f} s")
+
+    if failed:
+        print("Failed stages: " + ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
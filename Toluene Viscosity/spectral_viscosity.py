@@ -0,0 +1,163 @@
+# --------------------------------------------------------------------------------------------
+
+# Frequency-dependent viscosity from the power spectrum of the shear stress (Welch method).
+
+# The Green-Kubo viscosity is the zero-frequency limit of the shear-stress power spectral
+# density S(f) = integral of <s(0) s(t)> exp(-2 pi i f t) dt over all t:
+#
+#   eta(f) = V / (2 kB T) * S(f),     eta = eta(0) = V / kBT * integral_0^inf <s(0) s(t)> dt
+#
+# (eta(f) is the real part of the complex viscosity at angular frequency 2 pi f).
+# S(f) is estimated with Welch's method: the shear stresses used by green_kubo() are cut
+# into windowed segments of --segment steps overlapping by --overlap, and the periodograms
+# of all segments and components are averaged. Segments are streamed from the pressure
+# tensor file (or its binary cache) and transformed --batch at a time, so memory does not
+# depend on the trajectory length, and the batched FFTs run on --workers threads.
+
+# The standard error of eta(f) follows from the scatter between segments, corrected for
+# the overlap of the windows. The frequency resolution is 1 / (segment length); segments
+# must be much longer than the decay time of the stress ACF for eta(0) to be unbiased.
+
+# Output: Viscosity_Data/<trajectory>_data/viscosity_spectral.csv (or .npz) with columns
+# frequency(THz), viscosity(Pa.s) and std_error(Pa.s).
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+from scipy.constants import Boltzmann
+from pressure_io import iter_pressure_tensor, PressureDataError, default_chunk_size, default_cache_dir
+from correlation import WelchAccumulator, shear_components, windows, fft_backends, default_fft_backend
+from viscosity_calculation import output_directory
+from viscosity_io import write_table, output_formats
+from instrumentation import stage, profile_run, enable as enable_profiling
+
+# Default segment length in steps (131 ps at a 2 fs timestep)
+default_segment = 65536
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def parser(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Frequency-dependent shear viscosity from the Welch power spectrum of the shear stress.'
+    )
+    parser.add_argument('datafile', help='Pressure tensor file (CSV or a format of stress_readers.py, as for viscosity_calculation.py).')
+    parser.add_argument('-u', '--unit', default='atm', choices=['Pa', 'atm', 'bar', 'GPa'],
+                        help='Unit of the provided pressure data. Default is atm.')
+    parser.add_argument('-s', '--steps', type=int, default=None,
+                        help='Number of steps (rows) to read. Default is the whole file.')
+    parser.add_argument('-t', '--timestep', type=float, required=True,
+                        help='Physical timestep between two successive pressure data points in [ps].')
+    parser.add_argument('-T', '--temperature', type=float, required=True,
+                        help='Temperature of the MD simulation in [K].')
+    parser.add_argument('-v', '--volume', type=float, required=True,
+                        help='Volume of the simulation box in [A^3].')
+    parser.add_argument('-d', '--diag', action='store_false',
+                        help='Do not use the diagonal elements of the pressure tensor.')
+    parser.add_argument('--segment', type=int, default=default_segment,
+                        help=f'Length of the Welch segments in steps. Default is {default_segment}.')
+    parser.add_argument('--overlap', type=float, default=0.5,
+                        help='Fraction of a segment shared with the next one. Default is 0.5.')
+    parser.add_argument('--window', choices=list(windows), default='hann',
+                        help='Window applied to every segment. Default is hann.')
+    parser.add_argument('--batch', type=int, default=16,
+                        help='Number of segments transformed in one FFT call. Default is 16.')
+    parser.add_argument('--chunk-size', type=int, default=default_chunk_size,
+                        help=f'Number of rows read at a time. Default is {default_chunk_size}.')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='Always parse the CSV file instead of using the binary pressure tensor cache.')
+    parser.add_argument('--cache-dir', default=default_cache_dir,
+                        help=f'Directory of the binary pressure tensor cache. Default is {default_cache_dir}.')
+    parser.add_argument('--fft-backend', choices=fft_backends, default=default_fft_backend,
+                        help=f'FFT implementation used for the periodograms. Default is {default_fft_backend}.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of threads of the scipy FFT backend (-1 for all cores). Default is 1.')
+    parser.add_argument('--output-format', choices=output_formats, default='csv',
+                        help='Format of the output table. Default is csv.')
+    parser.add_argument('-p', '--plot', action='store_true', help='Plot eta(f) with its standard error.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write a timing and memory report of each stage to Profiles/ (same as setting VISCO_PROFILE=1).')
+    args = parser.parse_args(argv)
+
+    if args.segment < 2:
+        parser.error("--segment must be at least 2 steps.")
+    if not 0 <= args.overlap < 1:
+        parser.error("--overlap must be at least 0 and smaller than 1.")
+    if args.batch < 1:
+        parser.error("--batch must be at least 1.")
+    return args
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def spectral_viscosity(blocks, timestep, temperature, volume, segment=default_segment, overlap=0.5, window='hann',
+                       diag=True, batch=16, fft_backend=default_fft_backend, workers=None):
+    '''
+    Welch estimate of eta(f) from an iterable of (6, n) pressure tensor blocks in [Pa]
+    (e.g. iter_pressure_tensor(), or [P] for a tensor in memory). Returns
+    (frequency [THz], viscosity [Pa.s], standard error [Pa.s], WelchAccumulator).
+    '''
+    step = max(1, int(round(segment * (1 - overlap))))
+    welch = None
+    for block in blocks:
+        shear = shear_components(block, diag)
+        if welch is None:
+            welch = WelchAccumulator(shear.shape[0], segment, step, window, batch, fft_backend, workers)
+        with stage("welch"):
+            welch.update(shear)
+
+    if welch is None or welch.segments == 0:
+        raise PressureDataError(f"Error: At least {segment} steps are needed for one spectral segment.")
+
+    # Two-sided density per second, times V / (2 kBT)
+    scale = (volume * 1e-30) * (timestep * 1e-12) / (2 * Boltzmann * temperature)
+    return welch.frequencies() / timestep, welch.psd() * scale, welch.standard_error() * scale, welch
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def run(args):
+    print(f"Welch spectrum of {args.datafile}: segments of {args.segment} steps ({args.segment * args.timestep:g} ps), "
+          f"{args.overlap:g} overlap, {args.window} window")
+    blocks = iter_pressure_tensor(args.datafile, args.steps, args.unit, args.chunk_size, args.cache, args.cache_dir)
+    frequency, viscosity, error, welch = spectral_viscosity(
+        blocks, args.timestep, args.temperature, args.volume, args.segment, args.overlap, args.window, args.diag,
+        args.batch, args.fft_backend, args.workers)
+
+    print(f"Number of data points read: {welch.count} ({welch.segments} segments)")
+    print(f"Frequency resolution: {frequency[1]:.4g} THz")
+    print(f"Viscosity (spectral, f = 0): {viscosity[0] * 1000:.4g} +/- {error[0] * 1000:.2g} [mPa.s]")
+
+    output_dir = output_directory(args.datafile)
+    os.makedirs(output_dir, exist_ok=True)
+    metadata = {"datafile": os.path.basename(args.datafile), "steps": welch.count, "timestep": args.timestep,
+                "temperature": args.temperature, "volume": args.volume, "unit": args.unit, "diag": args.diag,
+                "method": "spectral", "segment": args.segment, "overlap": args.overlap, "window": args.window,
+                "segments": welch.segments}
+    with stage("write_outputs"):
+        write_table(os.path.join(output_dir, "viscosity_spectral"), {
+            "frequency(THz)": frequency,
+            "viscosity(Pa.s)": viscosity,
+            "std_error(Pa.s)": error,
+        }, args.output_format, metadata)
+
+    if args.plot:
+        import plotting
+        plotting.plot_spectral_viscosity(frequency, viscosity, error, os.path.join(output_dir, "viscosity_spectral.png"))
+    return frequency, viscosity, error
+
+
+def main(argv=None):
+    args = parser(argv)
+    if args.profile:
+        enable_profiling()
+
+    try:
+        with profile_run("spectral_viscosity", os.path.splitext(os.path.basename(args.datafile))[0]):
+            run(args)
+    except PressureDataError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# --------------------------------------------------------------------------------------------
+
+# Ensemble viscosity of all trajectories in a few vectorized calls.
+
+# Instead of one viscosity_calculation.py run per trajectory followed by
+# calculate_avg_max_min.py re-reading every output table, the pressure tensors of M
+# trajectories are stacked into one (M, 6, steps) array (in memory, or in a memory-mapped
+# .npy file with --mmap) and the batched FFT auto-correlations and Einstein integrals run
+# once along the last axis. The per-trajectory running viscosities come back as
+# (M, points) arrays and are folded straight into the ensemble statistics, which are
+# written as avg_min_max_visc_{method}.csv and std_{method}.csv.
+
+# Trajectories are processed in groups small enough to fit in memory (--group-size,
+# --memory-limit); the statistics of the groups are merged with the parallel Welford
+# combination. With --write-trajectories the per-trajectory tables of
+# viscosity_calculation.py are also written, so the plotting scripts can be used as usual.
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+import viscosity_calculation
+from viscosity_calculation import calculate_viscosity, saved_curves, write_outputs, output_directory
+from pressure_io import read_pressure_tensors, input_files, PressureDataError
+from ensemble_stats import RunningStats, write_summaries, methods, analysis_dir
+from generate_visc_data_all_files import available_memory, bytes_per_step, stamp_file
+from instrumentation import stage, profile_run, enable as enable_profiling
+
+# Arguments of viscosity_calculation.py used when none are given after "--"
+default_calc_args = ["-s", "1000001", "-t", "0.002", "-T", "298", "-v", "141930.7610", "-u", "GPa"]
+
+
+def parser(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Viscosity of all NVT*_stress_tensor.* trajectories evaluated together as one stacked array.'
+    )
+    parser.add_argument('--input-dir', default="NVT_Trajectories",
+                        help='Directory containing the pressure tensor files (CSV or a format of stress_readers.py). Default is NVT_Trajectories.')
+    parser.add_argument('--group-size', type=int, default=None,
+                        help='Number of trajectories stacked in one call. Default is as many as fit in --memory-limit.')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='Memory in GB a group may use. Default is the currently available memory.')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Keep the stacked pressure tensors in a memory-mapped file in the cache directory.')
+    parser.add_argument('--write-trajectories', action='store_true',
+                        help='Also write the per-trajectory tables (and plots with -p) of viscosity_calculation.py.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write a timing and memory report of each stage to Profiles/ (same as setting VISCO_PROFILE=1).')
+    parser.add_argument('calc_args', nargs=argparse.REMAINDER,
+                        help='Arguments of viscosity_calculation.py after "--" (without the data file). '
+                             'Default is: ' + ' '.join(default_calc_args))
+    args = parser.parse_args(argv)
+
+    if args.calc_args and args.calc_args[0] == "--":
+        args.calc_args = args.calc_args[1:]
+    if not args.calc_args:
+        args.calc_args = default_calc_args
+    return args
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def trajectory(result, i):
+    '''ViscosityResult of the i-th trajectory of a stacked result.'''
+    return result._replace(einstein=result.einstein[i], acf=result.acf[i], green_kubo=result.green_kubo[i],
+                           bulk_acf=None if result.bulk is None else result.bulk_acf[i],
+                           bulk=None if result.bulk is None else result.bulk[i],
+                           cross=None if result.cross is None else {pair: c[i] for pair, c in result.cross.items()})
+
+
+def evaluate_group(paths, calc, stack_dir=None):
+    '''
+    Stack the pressure tensors of `paths` and calculate their viscosities in one call.
+    calc are the parsed arguments of viscosity_calculation.py; returns a ViscosityResult
+    whose arrays have a leading trajectory axis.
+    '''
+    dtype = np.float32 if calc.float32 else np.float64
+    out, stack_path = None, None
+    if stack_dir is not None:
+        os.makedirs(stack_dir, exist_ok=True)
+        stack_path = os.path.join(stack_dir, f"stack.{os.getpid()}.tmp.npy")
+        out = np.lib.format.open_memmap(stack_path, mode="w+", dtype=dtype, shape=(len(paths), 6, calc.steps))
+
+    try:
+        with stage("read_pressure"):
+            P = read_pressure_tensors(paths, calc.steps, unit=calc.unit, dtype=dtype, chunk_size=calc.chunk_size,
+                                      cache=calc.cache, cache_dir=calc.cache_dir, out=out)
+        with stage("calculate"):
+            return calculate_viscosity(P, calc.timestep, calc.temperature, calc.volume, diag=calc.diag,
+                                       fft_backend=calc.fft_backend, workers=calc.workers, each=calc.each,
+                                       origins=calc.einstein_origins, max_lag=calc.max_lag, cutoff=calc.cutoff,
+                                       n_sigma=calc.noise_sigma, bulk=calc.bulk, cross=calc.cross)
+    finally:
+        if stack_path is not None:
+            del out
+            os.remove(stack_path)
+
+
+def evaluate_ensemble(paths, calc, group_size, stack_dir=None, write_trajectories=False, calc_args=None):
+    '''
+    Viscosity of all trajectories `paths`, `group_size` at a time. Returns {method: RunningStats};
+    the running viscosities of each group are folded into the statistics and not kept, so memory
+    does not grow with the number of trajectories.
+    '''
+    stats = {method: RunningStats() for method in methods}
+
+    for first in range(0, len(paths), group_size):
+        group = paths[first:first + group_size]
+        start = time.perf_counter()
+        result = evaluate_group(group, calc, stack_dir)
+
+        for method, (t, values) in saved_curves(result).items():
+            with stage("welford"):
+                stats[method].combine(RunningStats.from_curves(t, values))
+
+        for i, path in enumerate(group):
+            print(f"Processed: {os.path.basename(path)}: Einstein {result.einstein[i, -1] * 1000:.2f}, "
+                  f"Green-Kubo {result.green_kubo[i, -1] * 1000:.2f} [mPa.s]")
+
+        if write_trajectories:
+            metadata = {"steps": result.time.shape[0], "timestep": calc.timestep, "temperature": calc.temperature,
+                        "volume": calc.volume, "unit": calc.unit, "diag": calc.diag,
+                        "einstein_origins": calc.einstein_origins,
+                        "precision": "float32" if calc.output_float32 else "float64", "gk_cutoff": result.gk_cutoff,
+                        "bulk_cutoff": result.bulk_cutoff}
+            with stage("write_outputs"):
+                for i, path in enumerate(group):
+                    output_dir = output_directory(path)
+                    write_outputs(trajectory(result, i), output_dir, plot=calc.plot and not calc.no_plots,
+                                  output_format=calc.output_format,
+                                  metadata={**metadata, "datafile": os.path.basename(path)},
+                                  float32=calc.output_float32, compress=calc.compress, plot_workers=calc.plot_workers)
+                    # Same stamp as generate_visc_data_all_files.py, which then skips these trajectories
+                    with open(os.path.join(output_dir, stamp_file), "w") as file:
+                        json.dump({"args": calc_args}, file)
+
+        print(f"Group of {len(group)} trajectories done in {time.perf_counter() - start:.1f} s")
+
+    return stats
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def main(argv=None):
+    args = parser(argv)
+    if args.profile:
+        enable_profiling()
+
+    paths = input_files(args.input_dir)
+    if not paths:
+        print(f"No NVT*_stress_tensor.* files in {args.input_dir}")
+        sys.exit(1)
+    calc = viscosity_calculation.parser([paths[0]] + args.calc_args)
+    if calc.converge is not None:
+        print("--converge is not used for stacked trajectories: all steps are read, with the noise cutoff.")
+
+    # As many trajectories per group as fit in memory (see generate_visc_data_all_files.py)
+    group_size = args.group_size
+    if group_size is None:
+        memory_limit = args.memory_limit * 1024**3 if args.memory_limit else available_memory()
+        group_size = int(memory_limit // (bytes_per_step * calc.steps))
+    group_size = max(1, min(group_size, len(paths)))
+    print(f"Processing {len(paths)} trajectories in groups of {group_size} "
+          f"(~{group_size * bytes_per_step * calc.steps / 1024**3:.2f} GB each)")
+
+    start = time.perf_counter()
+    with profile_run("stacked_viscosity"):
+        try:
+            stats = evaluate_ensemble(paths, calc, group_size, calc.cache_dir if args.mmap else None,
+                                       args.write_trajectories, args.calc_args)
+        except PressureDataError as e:
+            print(e)
+            sys.exit(1)
+
+        for method in methods:
+            for path in write_summaries(stats[method], method, analysis_dir):
+                print(f"Saved {path}")
+    print(f"\nFinished in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,48 @@
-import os
-import pandas as pd
-
-# input method Green-Kubo or Einstein
-method = input("Enter the method (Green-Kubo or Einstein): ")
-working_dir = "Trajectory_Analysis_CSV_Files"
-
-file_path = os.path.join(working_dir, f"avg_min_max_visc_{method}.csv")
-df = pd.read_csv(file_path)
-
-cols = [c for c in df.columns if "viscosity(Pa.s)" in c and "NVT" in c]
-df["time(ns)"] = df["time(ps)"] / 1000
-df["mean_visc"] = df[cols].mean(axis=1)
-df["std_visc"] = df[cols].std(axis=1)
-
-output_file = os.path.join(working_dir, f"std_{method}.csv")
-df[["time(ns)", "mean_visc", "std_visc"]].to_csv(output_file, index=False)
-import matplotlib.pyplot as plt
-
-plots_dir = os.path.join("Plots")
-os.makedirs(plots_dir, exist_ok=True)
-
-data = pd.read_csv(output_file)
-plt.figure()
-plt.plot(data["time(ns)"], data["std_visc"], label="Std Viscosity")
-plt.xlabel("Time (ns)")
-plt.ylabel("Standard Deviation (Pa.s)")
-plt.title("Std vs Time")
-plt.legend()
-plt.savefig(os.path.join(plots_dir, f"std_{method}.png"))
-plt.close()
+import os
+import argparse
+import pandas as pd
+from ensemble_stats import trajectory_files, accumulate, write_summaries, normalize_method, analysis_dir
+from instrumentation import stage, profile_run, set_label
+
+
+def parser(argv=None):
+    parser = argparse.ArgumentParser(description='Plot the standard deviation of viscosity across all trajectories.')
+    parser.add_argument('method', nargs='?', help='GK or Einstein (asked interactively if omitted).')
+    parser.add_argument('--no-plots', action='store_true', help='Only write the CSV file, do not plot.')
+    args = parser.parse_args(argv)
+
+    # input method Green-Kubo or Einstein
+    if args.method is None:
+        args.method = input("Enter the method (GK or Einstein): ")
+    args.method = normalize_method(args.method)
+    return args
+
+
+def main(argv=None):
+    args = parser(argv)
+    method = args.method
+    set_label(method)
+
+    # std_{method}.csv is written by calculate_avg_max_min.py in the same pass as the
+    # average, minimum and maximum; compute it here only if it does not exist yet
+    output_file = os.path.join(analysis_dir, f"std_{method}.csv")
+    if not os.path.exists(output_file):
+        stats, names = accumulate(trajectory_files(method))
+        if not names:
+            print(f"No viscosity_{method} files found!")
+            return
+        _, output_file = write_summaries(stats, method)
+        print(f"Standard deviation CSV created: {output_file}")
+
+    df = pd.read_csv(output_file)
+
+    # matplotlib is only loaded when plots are requested
+    if not args.no_plots:
+        with stage("plot"):
+            import plotting
+            plotting.plot_std(df["time(ns)"], df["std_visc"], method)
+
+
+if __name__ == "__main__":
+    with profile_run("standard_deviation"):
+        main()
@@ -0,0 +1,309 @@
+# --------------------------------------------------------------------------------------------
+
+# Native readers of MD engine stress output for pressure_io.py
+
+# Every reader streams the six pressure tensor components of a file straight into float64
+# blocks of shape (6, rows) in the order Pxx, Pyy, Pzz, Pxy, Pxz, Pyz, in the units of the
+# file (converted by pressure_io with conversion_factors and -u, e.g. atm for LAMMPS
+# `units real`, bar for `units metal` and GROMACS), so no CSV export is needed:
+
+#   lammps   LAMMPS log file (thermo_style custom ... pxx pyy pzz pxy pxz pyz; several runs are
+#            joined, the step repeated at the start of a run is skipped) or fix ave/time file
+#            (columns named like v_pxx or c_thermo_press[1] ... c_thermo_press[6])
+#            extensions .log, .lammps, .ave (.txt and .dat if they start like a fix ave/time file)
+#   xvg      GROMACS `gmx energy` output with the Pres-XX ... Pres-YZ terms            .xvg
+#   npy      NumPy array of shape (rows, 6) or (6, rows), memory mapped                .npy
+#   binary   raw fixed-size records (e.g. dumped from an energy file) described by a JSON
+#            file next to it, <file>.json: {"dtype": {"step": "<i8", "Pxx": "<f4", ...},
+#            "offset": 0}; the records are memory mapped with np.memmap          .bin, .raw
+
+# Other formats are added with register(); the small files in fixtures/ hold the same
+# tensor in every format (fixtures/stress_tensor.csv, in atm) for checking a reader.
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import re
+import json
+from collections import namedtuple
+import numpy as np
+from pressure_io import PressureDataError, expected_columns
+
+# A reader: file extensions it handles, a generator of raw (6, rows) blocks
+# iter_chunks(datafile, steps, chunk_size), a header check check(datafile), whether the
+# pressure_io binary cache is worth using for it, and optionally sniff(first line) -> bool
+# for extensions shared with other formats
+Reader = namedtuple("Reader", ["name", "extensions", "iter_chunks", "check", "cacheable", "sniff"])
+
+_readers = {}
+
+# Component names in the order of expected_columns
+components = ["pxx", "pyy", "pzz", "pxy", "pxz", "pyz"]
+
+
+def register(name, extensions, iter_chunks, check, cacheable=True, sniff=None):
+    '''Add a reader for the given file extensions (with the leading dot).'''
+    _readers[name] = Reader(name, [ext.lower() for ext in extensions], iter_chunks, check, cacheable, sniff)
+
+
+def readers():
+    '''Names of the registered readers.'''
+    return list(_readers)
+
+
+def extensions():
+    return {ext for reader in _readers.values() for ext in reader.extensions}
+
+
+def reader_for(datafile):
+    '''Reader of a pressure tensor file, chosen by its extension (and first line where needed).'''
+    ext = os.path.splitext(datafile)[1].lower()
+    candidates = [reader for reader in _readers.values() if ext in reader.extensions]
+    if len(candidates) > 1 or any(reader.sniff is not None for reader in candidates):
+        with open(datafile, errors="replace") as file:
+            first = file.readline()
+        candidates = [reader for reader in candidates if reader.sniff is None or reader.sniff(first)]
+    if not candidates:
+        raise PressureDataError(f"Error: Unsupported pressure tensor file format: {datafile}")
+    return candidates[0]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def component_index(name):
+    '''Position in expected_columns of a column name such as Pxx, v_pxx, StressXX, Pres-XX or c_press[1].'''
+    indexed = re.fullmatch(r"c_\w+\[([1-6])\]", name)
+    if indexed:
+        return int(indexed.group(1)) - 1
+    key = re.sub(r"^(v_|c_|f_|stress|pres-?)", "", name.strip().lower())
+    key = key if key.startswith("p") else "p" + key
+    return components.index(key) if key in components else None
+
+
+def column_map(names, datafile):
+    '''Indices of the six components among the column names, or PressureDataError.'''
+    index = {}
+    for column, name in enumerate(names):
+        i = component_index(name)
+        if i is not None and i not in index:
+            index[i] = column
+    if len(index) < 6:
+        missing = [expected_columns[i] for i in range(6) if i not in index]
+        raise PressureDataError(f"Error: {datafile} has no columns for {', '.join(missing)}.")
+    return [index[i] for i in range(6)]
+
+
+def _text_blocks(rows, columns, steps, chunk_size):
+    '''Group an iterator of token lists into (6, n) float64 blocks of the selected columns.'''
+    block, count = [], 0
+    for tokens in rows:
+        block.append(tokens)
+        count += 1
+        if len(block) == chunk_size or count == steps:
+            yield _to_block(block, columns)
+            block = []
+        if count == steps:
+            return
+    if block:
+        yield _to_block(block, columns)
+
+
+def _to_block(lines, columns):
+    try:
+        values = np.array(lines, dtype=np.float64)
+    except ValueError:
+        raise PressureDataError("Error: Non-numeric values found in the data file.")
+    return np.ascontiguousarray(values[:, columns].T)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# LAMMPS log and fix ave/time files
+def _lammps_header(line):
+    '''Column names of a thermo header ("Step ...") or fix ave/time header ("# TimeStep ..."), else None.'''
+    tokens = line.split()
+    if tokens[:1] == ["Step"]:
+        return tokens
+    if tokens[:2] == ["#", "TimeStep"]:
+        return tokens[1:]
+    return None
+
+
+def _lammps_rows(datafile):
+    '''(column names, token lists) of all data lines of every thermo section of the file.'''
+    names, width, step_column, last_step = None, 0, None, None
+    with open(datafile, errors="replace") as file:
+        for line in file:
+            header = _lammps_header(line)
+            if header is not None:
+                if names is not None and header != names:
+                    raise PressureDataError(f"Error: The thermo columns of {datafile} change between runs.")
+                names, width = header, len(header)
+                step_column = 0 if header[0] in ("Step", "TimeStep") else None
+                continue
+            if names is None:
+                continue
+
+            tokens = line.split()
+            # Warnings, "Loop time ..." and other text between thermo lines are skipped
+            if len(tokens) != width or not _numeric(tokens[0]):
+                continue
+            # A new run repeats the last step of the previous one
+            if step_column is not None:
+                if tokens[step_column] == last_step:
+                    continue
+                last_step = tokens[step_column]
+            yield names, tokens
+
+
+def _numeric(token):
+    return token[:1].isdigit() or token[:1] in "-+." and token[1:2].isdigit()
+
+
+def lammps_chunks(datafile, steps=None, chunk_size=100000):
+    rows = _lammps_rows(datafile)
+    first = next(rows, None)
+    if first is None:
+        raise PressureDataError(f"Error: No thermo data found in {datafile}.")
+    names = first[0]
+    columns = column_map(names, datafile)
+
+    def tokens():
+        yield first[1]
+        for _, line in rows:
+            yield line
+    yield from _text_blocks(tokens(), columns, steps, chunk_size)
+
+
+def lammps_check(datafile):
+    with open(datafile, errors="replace") as file:
+        for line in file:
+            header = _lammps_header(line)
+            if header is not None:
+                column_map(header, datafile)
+                return
+    raise PressureDataError(f"Error: No thermo header (Step ... or # TimeStep ...) found in {datafile}.")
+
+
+def lammps_sniff(first_line):
+    return first_line.startswith("# Time-averaged data") or _lammps_header(first_line) is not None \
+        or first_line.startswith("LAMMPS")
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# GROMACS xvg files of gmx energy
+def _xvg_names(datafile):
+    '''Column names of an .xvg file (time first, then the legends s0, s1, ...).'''
+    legends = {}
+    with open(datafile, errors="replace") as file:
+        for line in file:
+            if line.startswith("#"):
+                continue
+            if not line.startswith("@"):
+                break
+            match = re.match(r'@\s+s(\d+)\s+legend\s+"(.*)"', line)
+            if match:
+                legends[int(match.group(1))] = match.group(2)
+    return ["time"] + [legends.get(i, "") for i in range(max(legends, default=-1) + 1)]
+
+
+def xvg_chunks(datafile, steps=None, chunk_size=100000):
+    names = _xvg_names(datafile)
+    columns = column_map(names, datafile)
+
+    def tokens():
+        with open(datafile, errors="replace") as file:
+            for line in file:
+                if line.startswith(("#", "@")):
+                    continue
+                fields = line.split()
+                if len(fields) == len(names):
+                    yield fields
+    yield from _text_blocks(tokens(), columns, steps, chunk_size)
+
+
+def xvg_check(datafile):
+    column_map(_xvg_names(datafile), datafile)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Binary arrays and records, memory mapped
+def _binary_blocks(columns, rows, steps, chunk_size):
+    '''(6, n) float64 blocks from a list of six memory-mapped 1-D arrays.'''
+    rows = rows if steps is None else min(steps, rows)
+    for start in range(0, rows, chunk_size):
+        block = np.empty((6, min(chunk_size, rows - start)))
+        for i, column in enumerate(columns):
+            block[i] = column[start:start + block.shape[1]]
+        if np.isnan(block).any():
+            raise PressureDataError("Error: The data file contains missing values. Please clean the data before proceeding.")
+        yield block
+
+
+def _npy_columns(datafile):
+    try:
+        array = np.load(datafile, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        raise PressureDataError(f"Error reading {datafile}: {e}")
+    if array.ndim != 2 or 6 not in array.shape:
+        raise PressureDataError(f"Error: {datafile} must hold an array of shape (rows, 6) or (6, rows).")
+    array = array.T if array.shape[1] == 6 and array.shape[0] != 6 else array
+    return list(array), array.shape[1]
+
+
+def npy_chunks(datafile, steps=None, chunk_size=100000):
+    columns, rows = _npy_columns(datafile)
+    yield from _binary_blocks(columns, rows, steps, chunk_size)
+
+
+def npy_check(datafile):
+    _npy_columns(datafile)
+
+
+def _record_columns(datafile):
+    layout_path = datafile + ".json"
+    try:
+        with open(layout_path) as file:
+            layout = json.load(file)
+        dtype = np.dtype(list(layout["dtype"].items()))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise PressureDataError(f"Error: The record layout {layout_path} is missing or invalid: {e}")
+
+    offset = layout.get("offset", 0)
+    rows = (os.path.getsize(datafile) - offset) // dtype.itemsize
+    records = np.memmap(datafile, dtype=dtype, mode="r", offset=offset, shape=(rows,))
+    columns = column_map(list(dtype.names), datafile)
+    return [records[dtype.names[i]] for i in columns], rows
+
+
+def record_chunks(datafile, steps=None, chunk_size=100000):
+    columns, rows = _record_columns(datafile)
+    yield from _binary_blocks(columns, rows, steps, chunk_size)
+
+
+def record_check(datafile):
+    _record_columns(datafile)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+register("lammps", [".log", ".lammps", ".ave", ".txt", ".dat"], lammps_chunks, lammps_check, sniff=lammps_sniff)
+register("xvg", [".xvg"], xvg_chunks, xvg_check)
+register("npy", [".npy"], npy_chunks, npy_check, cacheable=False)
+register("binary", [".bin", ".raw"], record_chunks, record_check, cacheable=False)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+if __name__ == "__main__":
+    import sys
+
+    from pressure_io import iter_pressure_chunks, is_csv
+
+    # Summary of the pressure tensor found in each file, e.g. python stress_readers.py fixtures/*
+    for path in sys.argv[1:]:
+        try:
+            name = "csv" if is_csv(path) else reader_for(path).name
+            blocks = list(iter_pressure_chunks(path, None))
+        except PressureDataError as e:
+            print(f"{path}: {e}")
+            continue
+        tensor = np.concatenate(blocks, axis=1)
+        print(f"{path}: {name}, {tensor.shape[1]} rows, mean " + ", ".join(
+            f"{column} {value:.6g}" for column, value in zip(expected_columns, tensor.mean(axis=1))))
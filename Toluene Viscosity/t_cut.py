@@ -1,21 +1,104 @@
-import pandas as pd
-
-method = input("Enter the method (Green-Kubo or Einstein): ")
-# Path to the CSV file
-file_path = f"Trajectory_Analysis_CSV_Files/std_{method}.csv"
-
-# Read the CSV file
-df = pd.read_csv(file_path)
-
-# Calculate 40% of mean_visc
-threshold = 0.4 * df['mean_visc']
-
-# Iterate through the DataFrame starting from the first non-zero mean_visc
-for idx, row in df.iterrows():
-    if(idx < 2):
-        continue
-    if row['mean_visc'] > 0 and row['std_visc'] >= 0.4 * row['mean_visc']:
-        print(f"Row {idx} exceeds 40% threshold at time {row['time(ns)']} ns.")
-        break
-else:
-    print("No time point where std_visc reaches 40% of mean_visc.")
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from ensemble_stats import normalize_method
+from instrumentation import stage, profile_run, set_label
+
+# Default threshold: t_cut is the first time where std_visc >= 0.4 * mean_visc
+default_threshold = 0.4
+
+# The first rows (t = 0 and the first step) are never taken as t_cut
+default_start = 2
+
+
+def parser(argv=None):
+    parser = argparse.ArgumentParser(description='Find the first time where std_visc reaches 40% of mean_visc.')
+    parser.add_argument('method', nargs='?', help='GK or Einstein (asked interactively if omitted).')
+    parser.add_argument('-t', '--threshold', type=float, nargs='+', default=[default_threshold],
+                        help='One or more ratios std_visc / mean_visc to scan. Default is 0.4.')
+    parser.add_argument('--leave-one-out', action='store_true',
+                        help='Also find t_cut for the ensemble without each trajectory in turn (sensitivity to single trajectories).')
+    args = parser.parse_args(argv)
+
+    if args.method is None:
+        args.method = input("Enter the method (GK or Einstein): ")
+    args.method = normalize_method(args.method)
+    return args
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def crossing_rows(mean, std, thresholds=(default_threshold,), start=default_start):
+    '''
+    First row >= start where mean > 0 and std >= threshold * mean, for every threshold at once.
+    mean and std have shape (..., rows); returns an int array of shape (len(thresholds), ...),
+    -1 where the threshold is never reached.
+    '''
+    mean, std = np.asarray(mean), np.asarray(std)
+    thresholds = np.asarray(thresholds, dtype=float).reshape((-1,) + (1,) * mean.ndim)
+
+    crossed = (mean > 0) & (std >= thresholds * mean)
+    crossed[..., :start] = False
+
+    rows = np.argmax(crossed, axis=-1)
+    rows[~crossed.any(axis=-1)] = -1
+    return rows
+
+
+def leave_one_out_stats(matrix):
+    '''Mean and sample standard deviation over trajectories (rows of matrix) leaving out each one in turn.'''
+    M = len(matrix)
+    total, squares = matrix.sum(axis=0), np.square(matrix).sum(axis=0)
+    mean = (total - matrix) / (M - 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var = (squares - np.square(matrix) - (M - 1) * np.square(mean)) / (M - 2)
+    return mean, np.sqrt(np.maximum(var, 0))
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def main(argv=None):
+    args = parser(argv)
+    method = args.method
+    set_label(method)
+    # Path to the CSV file
+    file_path = f"Trajectory_Analysis_CSV_Files/std_{method}.csv"
+
+    # Read the CSV file
+    with stage("read_csv"):
+        df = pd.read_csv(file_path)
+    time = df['time(ns)'].to_numpy()
+
+    # First crossing of every threshold in one pass
+    with stage("crossing_rows"):
+        rows = crossing_rows(df['mean_visc'].to_numpy(), df['std_visc'].to_numpy(), args.threshold)
+    for threshold, idx in zip(args.threshold, rows):
+        if idx >= 0:
+            print(f"Row {idx} exceeds {threshold * 100:g}% threshold at time {time[idx]} ns.")
+        else:
+            print(f"No time point where std_visc reaches {threshold * 100:g}% of mean_visc.")
+
+    results = {"threshold": args.threshold, "row": rows, "time(ns)": np.where(rows >= 0, time[rows], np.nan)}
+
+    if args.leave_one_out:
+        from ensemble_stats import trajectory_files, viscosity_matrix
+        with stage("read_trajectories"):
+            _, names, matrix = viscosity_matrix(trajectory_files(method))
+        if len(names) < 3:
+            print("At least three trajectories are needed for the leave-one-out scan.")
+        else:
+            with stage("leave_one_out"):
+                loo_rows = crossing_rows(*leave_one_out_stats(matrix), args.threshold)
+            print("\nt_cut row without each trajectory:")
+            for name, row in zip(names, loo_rows.T):
+                print(f"  {name}: " + ", ".join(str(r) for r in row))
+            for name, row in zip(names, loo_rows.T):
+                results[f"row without {name}"] = row
+
+    output_file = os.path.join("Trajectory_Analysis_CSV_Files", f"t_cut_{method}.csv")
+    pd.DataFrame(results).to_csv(output_file, index=False)
+    print(f"t_cut saved to {output_file}")
+
+
+if __name__ == "__main__":
+    with profile_run("t_cut"):
+        main()
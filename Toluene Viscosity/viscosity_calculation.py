@@ -1,342 +1,774 @@
-# --------------------------------------------------------------------------------------------
-
-# visco.py is a code for calculating viscosity from molecular dynamics (MD) simulations.
-# Copyright (C) 2021 Omid Shayestehpour
-
-# This program is free software: you can redistribute it and/or modify it under
-# the terms of the GNU Lesser General Public License as published by the Free
-# Software Foundation, either version 3 of the License, or (at your option) any
-# later version.
-
-# Calculation of viscosity using the Einstein or Green-Kubo expressions.
-# Viscosity is computed from the integral of the elements of the pressure tensor
-# (or their auto-correlation function) collected from NVT MD simulations.
-
-# Notice: the pressure tensor file should be a CSV file with the following columns 
-# (with or without a 'Frame' column) and units of [atm/bar/Pa]:
-# Frame (optional), StressXX, StressYY, StressZZ, StressXY, StressXZ, StressYZ
-
-# -------------------------------------------------------------------------------------------
-
-import sys
-import argparse
-import numpy as np
-import pandas as pd
-from matplotlib import pyplot as plt
-from scipy import integrate
-from scipy.constants import Boltzmann
-import os
-
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Define Auto-Correlation Function (ACF) using FFT for efficiency
-def acf(data):  
-    steps = data.shape[0]
-    lag = steps//2
-
-    # Nearest size with power of 2 (for efficiency) to zero-pad the input data
-    size = 2 ** int(np.ceil(np.log2(2*steps - 1)))
- 
-    # Compute the FFT
-    FFT = np.fft.fft(data, size)
-
-    # Get the power spectrum
-    PWR = FFT.conjugate() * FFT
-
-    # Calculate the auto-correlation from inverse FFT of the power spectrum
-    COR = np.fft.ifft(PWR)[:steps].real
-
-    autocorrelation = COR / np.arange(steps, 0, -1)
-
-    return autocorrelation[:lag]
-
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-def parser():
-    parser = argparse.ArgumentParser(
-        prog="visco.py",
-        description='Calculation of viscosity from (NVT) molecular dynamics simulations.'
-    )
-
-    parser.add_argument(
-        'datafile', 
-        help='Path to the pressure tensor CSV data file. \
-        The CSV should contain columns: Frame (optional), StressXX, StressYY, StressZZ, StressXY, StressXZ, StressYZ.'
-    )
-
-    parser.add_argument(
-        '-u', '--unit', choices=['Pa', 'atm', 'bar', 'GPa'], default='atm', 
-        help='Unit of the provided pressure data: Pa, atm, bar, or GPa. Default is atm.'
-    )
-
-    parser.add_argument(
-        '-s', '--steps', type=int, required=True, 
-        help='Number of steps (rows) to read from the pressure tensor file.'
-    )
-
-    parser.add_argument(
-        '-t', '--timestep', type=float, required=True, 
-        help='Physical timestep between two successive pressure data points in [ps].'
-    )
-
-    parser.add_argument(
-        '-T', '--temperature', type=float, required=True, 
-        help='Temperature of the MD simulation in [K].'
-    )
-
-    parser.add_argument(
-        '-v', '--volume', type=float, required=True, 
-        help='Volume of the simulation box in [A^3] (Angstorm cube).'
-    )
-
-    parser.add_argument(
-        '-d', '--diag', action='store_false',  
-        help='Exclude diagonal elements of the pressure tensor for viscosity calculation using Green-Kubo approach. \
-        By default, diagonal elements are included.'
-    )
-
-    parser.add_argument(
-        '-p', '--plot', action='store_true',  
-        help='Show plots of auto-correlation functions and running integral of viscosity.'
-    )
-
-    parser.add_argument(
-        '-e', '--each', type=int, default=100, 
-        help='Interval of steps to save the time evolution of viscosity. Default is 100.'
-    )
-
-    args = parser.parse_args()
-
-    # Check if the file exists
-    try:
-        with open(args.datafile, "r") as file:
-            pass
-    except IOError as error:
-        print(f'Error: {error}')
-        sys.exit(1)
-
-    return args
-
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Viscosity from Einstein relation
-def einstein():
-    Pxxyy = (Pxx - Pyy) / 2
-    Pyyzz = (Pyy - Pzz) / 2
-
-    '''
-    Calculate the viscosity from the Einstein relation 
-    by integrating the components of the pressure tensor
-    '''
-    timestep_sec = args.timestep * 1e-12  # Convert ps to seconds
-
-    # Perform cumulative integration using the trapezoidal rule
-    Pxy_int = integrate.cumulative_trapezoid(y=Pxy, dx=timestep_sec, initial=0)
-    Pxz_int = integrate.cumulative_trapezoid(y=Pxz, dx=timestep_sec, initial=0)
-    Pyz_int = integrate.cumulative_trapezoid(y=Pyz, dx=timestep_sec, initial=0)
-    Pxxyy_int = integrate.cumulative_trapezoid(y=Pxxyy, dx=timestep_sec, initial=0)
-    Pyyzz_int = integrate.cumulative_trapezoid(y=Pyyzz, dx=timestep_sec, initial=0)
-
-    # Compute the integral as per Einstein relation
-    integral = (Pxy_int**2 + Pxz_int**2 + Pyz_int**2 + Pxxyy_int**2 + Pyyzz_int**2) / 5
-
-    # Avoid division by zero by ensuring Time[1:] is non-zero
-    viscosity = integral[1:] * (args.volume * 1e-30) / (2 * kBT * Time[1:] * 1e-12)
-
-    return viscosity
-
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Viscosity from Green-Kubo relation
-def green_kubo():
-    # Calculate the ACFs
-    Pxy_acf = acf(Pxy)
-    Pxz_acf = acf(Pxz)
-    Pyz_acf = acf(Pyz)
-
-    # Calculate the shear components of the pressure tensor and their ACF
-    if args.diag:
-        Pxxyy = (Pxx - Pyy) / 2
-        Pyyzz = (Pyy - Pzz) / 2
-        Pxxzz = (Pxx - Pzz) / 2
-
-        Pxxyy_acf = acf(Pxxyy)
-        Pyyzz_acf = acf(Pyyzz)
-        Pxxzz_acf = acf(Pxxzz)
-
-    # Compute the average ACF
-    if args.diag:
-        avg_acf = (Pxy_acf + Pxz_acf + Pyz_acf + Pxxyy_acf + Pyyzz_acf + Pxxzz_acf) / 6
-    else:
-        avg_acf = (Pxy_acf + Pxz_acf + Pyz_acf) / 3
-
-    # Integrate the average ACF to get the viscosity
-    timestep_sec = args.timestep * 1e-12  # Convert ps to seconds
-    integral = integrate.cumulative_trapezoid(y=avg_acf, dx=timestep_sec, initial=0)
-    viscosity_gk = integral * (args.volume * 1e-30) / kBT
-    return avg_acf, viscosity_gk
-args = parser()
-
-# Conversion ratio from atm/bar/GPa to Pa
-conversion_factors = {
-    'Pa': 1,
-    'atm': 101325,
-    'bar': 100000,
-    'GPa': 1e9
-}
-
-conv_ratio = conversion_factors.get(args.unit, 1)
-
-# Calculate the kBT value
-kBT = Boltzmann * args.temperature
-
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Read the pressure tensor elements from CSV file using Pandas
-print('\nReading the pressure tensor data file with Pandas')
-
-try:
-    # Read the CSV file, assuming it may have a header. Read only the specified number of steps.
-    # Skip malformed lines by setting on_bad_lines to 'skip'
-    df = pd.read_csv(args.datafile, nrows=args.steps, on_bad_lines='skip')
-except TypeError:
-    # For older versions of pandas that don't have on_bad_lines
-    df = pd.read_csv(args.datafile, nrows=args.steps, error_bad_lines=False, warn_bad_lines=True)
-except Exception as e:
-    print(f"Error reading the data file with Pandas: {e}")
-    sys.exit(1)
-
-# Check if 'Frame' column exists and drop it if present
-if 'Frame' in df.columns:
-    df = df.drop(columns=['Frame'])
-
-# Define expected columns based on your CSV
-expected_columns = ['StressXX', 'StressYY', 'StressZZ', 'StressXY', 'StressXZ', 'StressYZ']
-
-# Ensure that all expected columns are present
-if not all(col in df.columns for col in expected_columns):
-    print(f"Error: CSV file must contain the following columns: {expected_columns}")
-    sys.exit(1)
-
-# Select only the required columns
-df = df[expected_columns]
-
-# Check for missing values
-if df.isnull().values.any():
-    print("Error: CSV file contains missing values. Please clean the data before proceeding.")
-    sys.exit(1)
-
-# Rename columns to match internal variable names
-df.rename(columns={
-    'StressXX': 'Pxx',
-    'StressYY': 'Pyy',
-    'StressZZ': 'Pzz',
-    'StressXY': 'Pxy',
-    'StressXZ': 'Pxz',
-    'StressYZ': 'Pyz'
-}, inplace=True)
-
-# Convert to float and apply unit conversion
-try:
-    df = df.astype(float) * conv_ratio
-except ValueError:
-    print("Error: Non-numeric values found in the data file.")
-    sys.exit(1)
-
-# Assign to respective variables as NumPy arrays
-Pxx = df['Pxx'].values
-Pyy = df['Pyy'].values
-Pzz = df['Pzz'].values
-Pxy = df['Pxy'].values
-Pxz = df['Pxz'].values
-Pyz = df['Pyz'].values
-
-print(f"Number of data points read: {len(Pxx)}")
-if len(Pxx) == 0:
-    print("Error: No data was read from the input file.")
-    sys.exit(1)
-
-# Generate the time array based on actual data points read
-end_time_ps = len(Pxx) * args.timestep
-print(f"Total simulation time: {end_time_ps} ps")
-Time = np.linspace(0, end_time_ps, num=len(Pxx), endpoint=False)
-
-viscosity_einstein = einstein()
-
-# Create output directory based on the input file name
-base_filename = os.path.splitext(os.path.basename(args.datafile))[0]  # Extract base name
-output_dir = os.path.join("Viscosity_Data",f"{base_filename}_data")  # Define output directory name
-os.makedirs(output_dir, exist_ok=True)  # Create the directory if it doesn't exist
-
-print(f"\nViscosity (Einstein): {round((viscosity_einstein[-1] * 1000), 2)} [mPa.s]")
-
-# Plot the running integral of viscosity
-if args.plot:
-    plt.figure(figsize=(8,6))
-    plt.plot(Time[:len(viscosity_einstein)], viscosity_einstein * 1000, label='Viscosity (Einstein)')
-    plt.xlabel('Time (ps)')
-    plt.ylabel('Viscosity (mPa.s)')
-    plt.title('Viscosity (Einstein) vs Time')
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, "viscosity_Einstein.png"))
-    # plt.show()
-
-
-
-
-# Save the running integral of viscosity as a CSV file
-df_einstein = pd.DataFrame({
-    "time(ps)": Time[:len(viscosity_einstein):args.each],
-    "viscosity(Pa.s)": viscosity_einstein[::args.each]
-})
-df_einstein.to_csv(os.path.join(output_dir, "viscosity_Einstein.csv"), index=False)
-
-
-# df_einstein.to_csv("viscosity_Einstein.csv", index=False)
-
-
-avg_acf, viscosity_gk = green_kubo()
-
-# Plot the normalized average ACF
-if args.plot:
-    norm_avg_acf = avg_acf / avg_acf[0]
-    plt.figure(figsize=(8,6))
-    plt.plot(Time[:len(norm_avg_acf)], norm_avg_acf, label='Normalized ACF (Green-Kubo)')
-    plt.xlabel('Time (ps)')
-    plt.ylabel('Normalized ACF')
-    plt.title('Auto-Correlation Function (Green-Kubo) vs Time')
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, "acf_plot.png"))
-    # plt.show()
-    
-
-
-# Save the normalized average ACF as a CSV file
-norm_avg_acf = avg_acf / avg_acf[0]
-df_acf = pd.DataFrame({
-    "time(ps)": Time[:len(norm_avg_acf)],
-    "ACF": norm_avg_acf
-})
-# df_acf.to_csv("avg_acf.csv", index=False)
-df_acf.to_csv(os.path.join(output_dir, "avg_acf.csv"), index=False)
-
-
-print(f"Viscosity (Green-Kubo): {round((viscosity_gk[-1] * 1000), 2)} [mPa.s]")
-print("Note: Do not trust these values! You should fit an exponential function to the running integral and take its limit.")
-
-# Plot the time evolution of the viscosity estimate
-if args.plot:
-    plt.figure(figsize=(8,6))
-    plt.plot(Time[:len(viscosity_gk)], viscosity_gk * 1000, label='Viscosity (Green-Kubo)')
-    plt.xlabel('Time (ps)')
-    plt.ylabel('Viscosity (mPa.s)')
-    plt.title('Viscosity (Green-Kubo) vs Time')
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, "viscosity_GK.png"))
-    # plt.show()
-
-
-# Save running integral of the viscosity as a CSV file
-df_gk = pd.DataFrame({
-    "time(ps)": Time[:len(viscosity_gk):args.each],  # Actual time points
-    "viscosity(Pa.s)": viscosity_gk[::args.each]    # Corresponding viscosity values
-})
-df_gk.to_csv(os.path.join(output_dir, "viscosity_GK.csv"), index=False)
+# --------------------------------------------------------------------------------------------
+
+# visco.py is a code for calculating viscosity from molecular dynamics (MD) simulations.
+# Copyright (C) 2021 Omid Shayestehpour
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# Calculation of viscosity using the Einstein or Green-Kubo expressions.
+# Viscosity is computed from the integral of the elements of the pressure tensor
+# (or their auto-correlation function) collected from NVT MD simulations.
+
+# Notice: the pressure tensor file should be a CSV file with the following columns 
+# (with or without a 'Frame' column) and units of [atm/bar/Pa]:
+# Frame (optional), StressXX, StressYY, StressZZ, StressXY, StressXZ, StressYZ
+
+# -------------------------------------------------------------------------------------------
+
+import sys
+import argparse
+import numpy as np
+from scipy import integrate
+from scipy.constants import Boltzmann
+import os
+from collections import namedtuple
+from pressure_io import read_pressure_tensor, read_pressure_tensor_cached, iter_pressure_tensor, PressureDataError, \
+    default_chunk_size, default_cache_dir
+from correlation import batch_acf, batch_correlations, stress_channels, channel_names, fft_backends, \
+    default_fft_backend
+from viscosity_io import write_table, table_files, output_formats
+from instrumentation import stage, profile_run, enable as enable_profiling
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Define Auto-Correlation Function (ACF) using FFT for efficiency
+# (single series reference; green_kubo() uses the batched engine in correlation.py)
+def acf(data):  
+    steps = data.shape[0]
+    lag = steps//2
+
+    # Nearest size with power of 2 (for efficiency) to zero-pad the input data
+    size = 2 ** int(np.ceil(np.log2(2*steps - 1)))
+ 
+    # Compute the FFT
+    FFT = np.fft.fft(data, size)
+
+    # Get the power spectrum
+    PWR = FFT.conjugate() * FFT
+
+    # Calculate the auto-correlation from inverse FFT of the power spectrum
+    COR = np.fft.ifft(PWR)[:steps].real
+
+    autocorrelation = COR / np.arange(steps, 0, -1)
+
+    return autocorrelation[:lag]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def parser(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="visco.py",
+        description='Calculation of viscosity from (NVT) molecular dynamics simulations.'
+    )
+
+    parser.add_argument(
+        'datafile', 
+        help='Path to the pressure tensor CSV data file. \
+        The CSV should contain columns: Frame (optional), StressXX, StressYY, StressZZ, StressXY, StressXZ, StressYZ. \
+        LAMMPS log and fix ave/time files, GROMACS .xvg, .npy and raw binary records are read directly (see stress_readers.py).'
+    )
+
+    parser.add_argument(
+        '-u', '--unit', choices=['Pa', 'atm', 'bar', 'GPa'], default='atm', 
+        help='Unit of the provided pressure data: Pa, atm, bar, or GPa. Default is atm.'
+    )
+
+    parser.add_argument(
+        '-s', '--steps', type=int, required=True, 
+        help='Number of steps (rows) to read from the pressure tensor file.'
+    )
+
+    parser.add_argument(
+        '-t', '--timestep', type=float, required=True, 
+        help='Physical timestep between two successive pressure data points in [ps].'
+    )
+
+    parser.add_argument(
+        '-T', '--temperature', type=float, required=True, 
+        help='Temperature of the MD simulation in [K].'
+    )
+
+    parser.add_argument(
+        '-v', '--volume', type=float, required=True, 
+        help='Volume of the simulation box in [A^3] (Angstorm cube).'
+    )
+
+    parser.add_argument(
+        '-d', '--diag', action='store_false',  
+        help='Exclude diagonal elements of the pressure tensor for viscosity calculation using Green-Kubo approach. \
+        By default, diagonal elements are included.'
+    )
+
+    parser.add_argument(
+        '-p', '--plot', action='store_true',  
+        help='Show plots of auto-correlation functions and running integral of viscosity.'
+    )
+
+    parser.add_argument(
+        '--no-plots', action='store_true',
+        help='Do not create any plots, even if -p is given (e.g. for fast batch runs).'
+    )
+
+    parser.add_argument(
+        '--plot-workers', type=int, default=1,
+        help='Number of processes drawing the three plots of -p at the same time. Default is 1.'
+    )
+
+    parser.add_argument(
+        '-e', '--each', type=int, default=100, 
+        help='Interval of steps to save the time evolution of viscosity. Default is 100.'
+    )
+
+    parser.add_argument(
+        '--einstein-origins', choices=einstein_origins, default='single',
+        help='Einstein relation from a single time origin, or averaged over all time origins with an FFT-based '
+             'mean squared displacement (lower noise). Default is single.'
+    )
+
+    parser.add_argument(
+        '--max-lag', type=int, default=None,
+        help='Maximum lag in steps of the multiple-origin Einstein viscosity. Default is half of the steps read.'
+    )
+
+    parser.add_argument(
+        '--cutoff', choices=gk_cutoffs, default='full',
+        help='Integrate the Green-Kubo ACF over all steps//2 lags (full), or only up to the lag where it has '
+             'decayed into its statistical noise (noise). Default is full.'
+    )
+
+    parser.add_argument(
+        '--noise-sigma', type=float, default=default_noise_sigma,
+        help=f'Width of the ACF noise band in standard deviations for --cutoff noise. Default is {default_noise_sigma}.'
+    )
+
+    parser.add_argument(
+        '--bulk', action='store_true',
+        help='Also calculate the bulk viscosity from the ACF of the isotropic pressure fluctuation '
+             '(Pxx+Pyy+Pzz)/3 - <P>, in the same FFT as the shear ACF (viscosity_bulk and bulk_acf tables).'
+    )
+
+    parser.add_argument(
+        '--cross', nargs='+', default=[], metavar='A:B',
+        help='Cross-correlations of pairs of stress channels to save as consistency checks (between two off-diagonal '
+             'stresses, or a shear stress and bulk, they vanish in an isotropic fluid), normalized by the standard deviations, e.g. xy:xz xx-yy:bulk. Channels: '
+             + ', '.join(channel_names) + '.'
+    )
+
+    parser.add_argument(
+        '--converge', type=float, default=None, metavar='TOLERANCE',
+        help='Read the file in chunks and stop once the Green-Kubo viscosity at the noise cutoff changes by less '
+             'than this relative tolerance between two checks (implies --cutoff noise; with the cache, the first '
+             'run still parses the whole file, use --no-cache to parse only the rows needed).'
+    )
+
+    parser.add_argument(
+        '--float32', action='store_true',
+        help='Store the pressure tensor in single precision to halve memory. Default is double precision.'
+    )
+
+    parser.add_argument(
+        '--chunk-size', type=int, default=default_chunk_size,
+        help=f'Number of rows parsed at a time from the pressure tensor file. Default is {default_chunk_size}.'
+    )
+
+    parser.add_argument(
+        '--no-cache', dest='cache', action='store_false',
+        help='Always parse the CSV file instead of using the binary pressure tensor cache.'
+    )
+
+    parser.add_argument(
+        '--cache-dir', default=default_cache_dir,
+        help=f'Directory of the binary pressure tensor cache. Default is {default_cache_dir}.'
+    )
+
+    parser.add_argument(
+        '--output-format', choices=output_formats, default='csv',
+        help='Format of the output tables: CSV, NumPy .npz with the run parameters as metadata '
+             '(avg_acf is then also saved every `each` lags), or both. Default is csv.'
+    )
+
+    parser.add_argument(
+        '--output-float32', action='store_true',
+        help='Save the viscosity and ACF values in single precision. Default is double precision.'
+    )
+
+    parser.add_argument(
+        '--compress', action='store_true',
+        help='Compress the .npz output files.'
+    )
+
+    parser.add_argument(
+        '--fft-backend', choices=fft_backends, default=default_fft_backend,
+        help=f'FFT library used for the auto-correlation functions. Default is {default_fft_backend}.'
+    )
+
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Write a timing and memory report of each stage to Profiles/ (same as setting VISCO_PROFILE=1).'
+    )
+
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Number of threads used by the scipy FFT backend (-1 for all cores). Default is 1.'
+    )
+
+    args = parser.parse_args(argv)
+    if args.converge is not None:
+        args.cutoff = 'noise'
+
+    available = channel_names if args.diag else channel_names[:3] + ["bulk"]
+    for pair in args.cross:
+        names = pair.split(":")
+        if len(names) != 2 or not all(name in available for name in names):
+            parser.error(f"--cross {pair}: expected two of {', '.join(available)} separated by ':'.")
+
+    # Check if the file exists
+    try:
+        with open(args.datafile, "r") as file:
+            pass
+    except IOError as error:
+        print(f'Error: {error}')
+        sys.exit(1)
+
+    return args
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Library API
+#
+# The functions below only take NumPy arrays and physical parameters, so they can be
+# called many times in one process (batch driver, benchmarks, notebooks):
+#
+#   P = load_pressure_tensor("NVT1_stress_tensor.csv", steps=1000001, unit='GPa')
+#   result = calculate_viscosity(P, timestep=0.002, temperature=298, volume=141930.761)
+#
+# P is a (6, steps) array with rows Pxx, Pyy, Pzz, Pxy, Pxz, Pyz in [Pa],
+# timestep is in [ps], temperature in [K] and volume in [A^3]. Several trajectories of the
+# same length can be stacked into an (M, 6, steps) array; every result then has a leading
+# trajectory axis (see stacked_viscosity.py).
+
+# Results of calculate_viscosity(): time [ps], running viscosities [Pa.s], the average ACF [Pa^2],
+# the interval `each` of the saved points and the step indices of the Einstein viscosity
+# and, with the noise cutoff, the last lag of the Green-Kubo integral (None: all steps//2 lags).
+# With bulk=True also the bulk ACF [Pa^2], running bulk viscosity [Pa.s] and its cutoff, and
+# the requested cross-correlations {"A:B": normalized correlation} (None when not calculated)
+ViscosityResult = namedtuple("ViscosityResult", ["time", "einstein", "acf", "green_kubo", "each", "einstein_points",
+                                                 "gk_cutoff", "bulk_acf", "bulk", "bulk_cutoff", "cross"],
+                             defaults=[None, None, None, None, None])
+
+# Einstein estimators: a single time origin or the average over all time origins
+einstein_origins = ['single', 'multiple']
+
+# Number of steps integrated at a time by einstein()
+einstein_block = 65536
+
+# Green-Kubo integration range: all lags, or up to the noise cutoff (see noise_cutoff())
+gk_cutoffs = ['full', 'noise']
+default_noise_sigma = 2.0
+
+# Growth of the number of rows read between two checks of --converge
+converge_growth = 1.25
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def time_axis(steps, timestep):
+    '''Time [ps] of each of the `steps` pressure tensor samples.'''
+    return np.linspace(0, steps * timestep, num=steps, endpoint=False)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def einstein_points(last, each=1):
+    '''Step indices 1, 1+each, 1+2*each, ... up to `last`, with `last` itself always included.'''
+    points = np.arange(1, last + 1, each)
+    if len(points) and points[-1] != last:
+        points = np.append(points, last)
+    return points
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Viscosity from Einstein relation
+def einstein(P, timestep, temperature, volume, points=None, block=einstein_block):
+    '''
+    Calculate the viscosity from the Einstein relation 
+    by integrating the components of the pressure tensor.
+    Returns the running viscosity at the sorted step indices `points` (time timestep * points),
+    by default at every step 1, ..., steps-1 (see einstein_points() for decimation).
+
+    The five shear combinations Pxy, Pxz, Pyz, (Pxx-Pyy)/2 and (Pyy-Pzz)/2 are integrated
+    together with the trapezoidal rule, `block` steps at a time in reused (5, block) buffers,
+    and only the requested points are kept, so no full-length intermediate is ever created.
+    The summation order is the same as integrate.cumulative_trapezoid.
+    P may have leading trajectory axes (..., 6, steps); the result then has shape (..., len(points)).
+    '''
+    steps = P.shape[-1]
+    lead = P.shape[:-2]
+    timestep_sec = timestep * 1e-12  # Convert ps to seconds
+    kBT = Boltzmann * temperature
+
+    # Points of the running integral that are returned
+    points = np.arange(1, steps) if points is None else np.asarray(points)
+    integral = np.empty(lead + (len(points),))
+
+    # Shear combinations of the current block, preceded by the last sample of the previous block
+    shear = np.empty(lead + (5, block + 1))
+    running = np.empty(lead + (5, block))
+    carry = np.zeros(lead + (5,))
+
+    for start in range(0, steps, block):
+        end = min(start + block, steps)
+        n = end - start
+        Pxx, Pyy, Pzz = P[..., 0, start:end], P[..., 1, start:end], P[..., 2, start:end]
+
+        shear[..., :3, 1:n + 1] = P[..., 3:, start:end]
+        np.subtract(Pxx, Pyy, out=shear[..., 3, 1:n + 1])
+        np.subtract(Pyy, Pzz, out=shear[..., 4, 1:n + 1])
+        shear[..., 3:, 1:n + 1] /= 2
+        if start == 0:
+            shear[..., 0] = shear[..., 1]
+
+        # Trapezoid increments dx * (y[k-1] + y[k]) / 2, accumulated onto the previous block
+        np.add(shear[..., :n], shear[..., 1:n + 1], out=running[..., :n])
+        running[..., :n] *= timestep_sec
+        running[..., :n] /= 2.0
+        if start == 0:
+            running[..., 0] = 0.0
+        running[..., 0] += carry
+        np.cumsum(running[..., :n], axis=-1, out=running[..., :n])
+        carry = running[..., n - 1].copy()
+        shear[..., 0] = shear[..., n]
+
+        # Keep only the requested points of this block
+        first, last = np.searchsorted(points, [start, end])
+        selected = np.moveaxis(running[..., points[first:last] - start], -2, 0)
+        integral[..., first:last] = (selected[0]**2 + selected[1]**2 + selected[2]**2 + selected[3]**2 + selected[4]**2) / 5
+
+    Time = time_axis(steps, timestep)[points]
+    viscosity = integral * (volume * 1e-30) / (2 * kBT * Time * 1e-12)
+
+    return viscosity
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Viscosity from Einstein relation averaged over multiple time origins
+def einstein_multiple_origins(P, timestep, temperature, volume, points=None, max_lag=None,
+                              fft_backend=default_fft_backend, workers=None):
+    '''
+    Einstein viscosity from the mean squared displacement of the integrated shear stresses,
+    averaged over all time origins t0: < (G(t0 + t) - G(t0))^2 > / (2 kBT t) * V.
+    Returns the viscosity at the lags `points` (default 1, ..., max_lag; max_lag defaults to steps//2).
+
+    The MSD uses the FFT algorithm MSD(m) = S1(m) - 2 S2(m), where S2 is the auto-correlation
+    of G from batch_acf() and S1 follows from a cumulative sum of G^2, so the cost is
+    O(N log N) instead of O(N^2) for an explicit loop over time origins.
+    P may have leading trajectory axes (..., 6, steps), as for einstein().
+    '''
+    steps = P.shape[-1]
+    max_lag = steps//2 if max_lag is None else min(max_lag, steps - 1)
+    timestep_sec = timestep * 1e-12  # Convert ps to seconds
+    kBT = Boltzmann * temperature
+
+    # Running integrals G of the five shear combinations used by einstein()
+    shear = np.empty(P.shape[:-2] + (5, steps))
+    shear[..., :3, :] = P[..., 3:, :]
+    np.subtract(P[..., 0, :], P[..., 1, :], out=shear[..., 3, :])
+    np.subtract(P[..., 1, :], P[..., 2, :], out=shear[..., 4, :])
+    shear[..., 3:, :] /= 2
+    G = integrate.cumulative_trapezoid(y=shear, dx=timestep_sec, axis=-1, initial=0)
+    del shear
+    # The MSD does not depend on a constant offset; removing the mean limits the cancellation in S1 - 2 S2
+    G -= G.mean(axis=-1, keepdims=True)
+
+    # S2(m): average over components of the auto-correlation of G
+    S2 = batch_acf(G, average=True, backend=fft_backend, workers=workers, max_lag=max_lag + 1)
+
+    # S1(m) = (sum_{t < N-m} G(t)^2 + sum_{t >= m} G(t)^2) / (N - m), averaged over components
+    D = np.square(G).mean(axis=-2)
+    del G
+    cumulative = np.concatenate([np.zeros(D.shape[:-1] + (1,)), np.cumsum(D, axis=-1)], axis=-1)
+    lags = np.arange(max_lag + 1)
+    S1 = (cumulative[..., steps - lags] + cumulative[..., -1:] - cumulative[..., lags]) / (steps - lags)
+
+    msd = S1 - 2 * S2
+
+    points = np.arange(1, max_lag + 1) if points is None else np.asarray(points)
+    Time = time_axis(steps, timestep)[points]
+    viscosity = msd[..., points] * (volume * 1e-30) / (2 * kBT * Time * 1e-12)
+
+    return viscosity
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Viscosity from Green-Kubo relation
+def green_kubo(P, timestep, temperature, volume, diag=True, fft_backend=default_fft_backend, workers=None):
+    '''
+    Calculate the average shear-stress ACF and the running Green-Kubo integral of viscosity.
+    Returns (avg_acf, viscosity_gk), both with steps//2 lags (along the last axis for stacked P).
+    '''
+    # Calculate the average ACF of all shear components in one batched FFT (see correlation.py)
+    with stage("acf"):
+        avg_acf = stress_correlations(P, diag, fft_backend=fft_backend, workers=workers)["shear"]
+    with stage("integral"):
+        return avg_acf, green_kubo_integral(avg_acf, timestep, temperature, volume)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def stress_correlations(P, diag=True, bulk=False, cross=(), fft_backend=default_fft_backend, workers=None):
+    '''
+    Average shear-stress ACF [Pa^2] and, with bulk=True, the ACF of the isotropic pressure
+    fluctuation, plus the cross-correlations of the channel pairs `cross` (e.g. "xy:xz", see
+    correlation.channel_names), all from one batched FFT of the stress channels.
+    Returns {"shear": avg_acf, "bulk": bulk_acf, "xy:xz": ...} with steps//2 lags; the
+    cross-correlations are divided by the standard deviations of both channels (|value| <= 1).
+    '''
+    pairs = [tuple(pair.split(":")) for pair in cross]
+    with_bulk = bulk or any("bulk" in pair for pair in pairs)
+    channels, names = stress_channels(P, diag, with_bulk)
+    shear = len(names) - with_bulk
+
+    groups = [slice(0, shear)] + ([slice(shear, shear + 1)] if bulk else [])
+    index = [(names.index(a), names.index(b)) for a, b in pairs]
+    COR = batch_correlations(channels, groups, index, backend=fft_backend, workers=workers)
+
+    correlations = {"shear": COR[..., 0, :]}
+    if bulk:
+        correlations["bulk"] = COR[..., 1, :]
+    for k, (pair, (i, j)) in enumerate(zip(cross, index)):
+        # Zero-lag values <x_i^2>, <x_j^2> of the same (mean-including) estimator
+        norm = np.sqrt(np.mean(np.square(channels[..., i, :]), axis=-1) * np.mean(np.square(channels[..., j, :]), axis=-1))
+        correlations[pair] = COR[..., len(groups) + k, :] / norm[..., None]
+    return correlations
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def green_kubo_integral(avg_acf, timestep, temperature, volume):
+    '''Running Green-Kubo viscosity [Pa.s] from the average shear-stress ACF [Pa^2].'''
+    # Integrate the average ACF to get the viscosity
+    timestep_sec = timestep * 1e-12  # Convert ps to seconds
+    kBT = Boltzmann * temperature
+    integral = integrate.cumulative_trapezoid(y=avg_acf, dx=timestep_sec, initial=0)
+    return integral * (volume * 1e-30) / kBT
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Where the Green-Kubo ACF has decayed into noise
+def acf_noise(avg_acf, steps, diag=True, channels=None):
+    '''
+    Standard deviation of the average shear-stress ACF at every lag k for `steps` samples, by
+    Bartlett's formula for one component assuming the true ACF vanishes beyond k,
+    sigma(k)^2 = (C(0)^2 + 2 sum_{0<m<k} C(m)^2) / (steps - k), divided by the number of
+    effectively independent components: in an isotropic fluid the three off-diagonal stresses
+    are uncorrelated and the diagonal combinations (Pxx-Pyy)/2, (Pyy-Pzz)/2, (Pxx-Pzz)/2 have
+    pairwise correlations of -1/2 or 1/2, so the six act as 36/7.5 = 4.8 independent series.
+    `channels` overrides that number, e.g. 1 for the bulk ACF.
+    '''
+    squares = np.square(avg_acf)
+    running = 2 * np.cumsum(squares, axis=-1) - squares[..., :1]
+    total = np.concatenate([squares[..., :1], running[..., :-1]], axis=-1)
+    if channels is None:
+        channels = 4.8 if diag else 3
+    return np.sqrt(total / (channels * (steps - np.arange(avg_acf.shape[-1]))))
+
+
+def noise_cutoff(avg_acf, steps, n_sigma=default_noise_sigma, diag=True, channels=None):
+    '''
+    First lag k from which |ACF| stays inside n_sigma * acf_noise() up to lag 2k, i.e. the
+    ACF has stayed in the noise for as long as it took to get there. For stacked ACFs the
+    result has the leading shape; -1 where no such lag exists within the lags available.
+    '''
+    lags = avg_acf.shape[-1]
+    outside = np.abs(avg_acf) >= n_sigma * acf_noise(avg_acf, steps, diag, channels)
+    count = np.concatenate([np.zeros(outside.shape[:-1] + (1,), dtype=np.int64),
+                            np.cumsum(outside, axis=-1)], axis=-1)
+
+    # Number of lags j in [k, 2k] outside the band, for every k with 2k < lags
+    k = np.arange(1, (lags + 1)//2)
+    if len(k) == 0:
+        return np.full(avg_acf.shape[:-1], -1)
+    quiet = count[..., 2*k + 1] - count[..., k] == 0
+    cutoff = k[np.argmax(quiet, axis=-1)]
+    return np.where(quiet.any(axis=-1), cutoff, -1)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def calculate_viscosity(P, timestep, temperature, volume, diag=True, fft_backend=default_fft_backend, workers=None,
+                        each=1, origins='single', max_lag=None, cutoff='full', n_sigma=default_noise_sigma, bulk=False,
+                        cross=()):
+    '''
+    Einstein and Green-Kubo running viscosities of the pressure tensor P. The Einstein viscosity
+    is kept every `each` steps, from one time origin or averaged over all origins up to max_lag.
+    With cutoff='noise' the Green-Kubo ACF and integral end at noise_cutoff() (for a stack, the
+    largest cutoff of its trajectories, so that all curves keep a common time grid).
+    bulk=True adds the bulk viscosity and `cross` the cross-correlations of stress_correlations(),
+    computed in the same FFT as the shear ACF.
+    '''
+    steps = P.shape[-1]
+    with stage("einstein"):
+        if origins == 'multiple':
+            max_lag = steps//2 if max_lag is None else min(max_lag, steps - 1)
+            points = einstein_points(max_lag, each)
+            viscosity_einstein = einstein_multiple_origins(P, timestep, temperature, volume, points, max_lag,
+                                                           fft_backend, workers)
+        else:
+            points = einstein_points(steps - 1, each)
+            viscosity_einstein = einstein(P, timestep, temperature, volume, points)
+
+    with stage("green_kubo"):
+        with stage("acf"):
+            correlations = stress_correlations(P, diag, bulk, cross, fft_backend, workers)
+        avg_acf, bulk_acf = correlations.pop("shear"), correlations.pop("bulk", None)
+        with stage("integral"):
+            viscosity_gk = green_kubo_integral(avg_acf, timestep, temperature, volume)
+            viscosity_bulk = None if bulk_acf is None else green_kubo_integral(bulk_acf, timestep, temperature, volume)
+
+    gk_cutoff = bulk_cutoff = None
+    if cutoff == 'noise':
+        gk_cutoff = common_cutoff(avg_acf, steps, n_sigma, diag)
+        if gk_cutoff is not None:
+            avg_acf, viscosity_gk = avg_acf[..., :gk_cutoff + 1], viscosity_gk[..., :gk_cutoff + 1]
+        else:
+            print("Warning: the Green-Kubo ACF does not reach its noise level; it is integrated over all lags.")
+        if bulk_acf is not None:
+            bulk_cutoff = common_cutoff(bulk_acf, steps, n_sigma, channels=1)
+            if bulk_cutoff is not None:
+                bulk_acf, viscosity_bulk = bulk_acf[..., :bulk_cutoff + 1], viscosity_bulk[..., :bulk_cutoff + 1]
+            else:
+                print("Warning: the bulk ACF does not reach its noise level; it is integrated over all lags.")
+    return ViscosityResult(time_axis(steps, timestep), viscosity_einstein, avg_acf, viscosity_gk, each, points,
+                           gk_cutoff, bulk_acf, viscosity_bulk, bulk_cutoff, correlations if cross else None)
+
+
+def common_cutoff(avg_acf, steps, n_sigma=default_noise_sigma, diag=True, channels=None):
+    '''Largest noise_cutoff() of a (stacked) ACF, or None if one of them does not reach its noise level.'''
+    lags = noise_cutoff(avg_acf, steps, n_sigma, diag, channels)
+    return int(np.max(lags)) if np.all(lags >= 0) else None
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def saved_curves(result):
+    '''
+    {method: (time [ps], viscosity [Pa.s])} as saved in the viscosity_{method} tables: Green-Kubo
+    every `each` lags, Einstein every `each` steps (without the final point appended by
+    einstein_points()) with the value at step k saved at the time of step k-1, as before.
+    '''
+    Time, each = result.time, result.each
+    regular = (result.einstein_points - 1) % each == 0
+    return {
+        "GK": (Time[:result.green_kubo.shape[-1]:each], result.green_kubo[..., ::each]),
+        "Einstein": (Time[result.einstein_points[regular] - 1], result.einstein[..., regular]),
+    }
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def load_pressure_tensor(datafile, steps, unit='atm', dtype=np.float64, chunk_size=default_chunk_size,
+                         cache=True, cache_dir=default_cache_dir):
+    '''Read the pressure tensor file into a (6, steps) array in [Pa] (see pressure_io.py).'''
+    with stage("read_pressure"):
+        if cache:
+            return read_pressure_tensor_cached(datafile, steps, unit=unit, dtype=dtype,
+                                               chunk_size=chunk_size, cache_dir=cache_dir)
+        return read_pressure_tensor(datafile, steps, unit=unit, dtype=dtype, chunk_size=chunk_size)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def load_until_converged(datafile, steps, timestep, temperature, volume, tolerance, unit='atm', dtype=np.float64,
+                         chunk_size=default_chunk_size, cache=True, cache_dir=default_cache_dir, diag=True,
+                         n_sigma=default_noise_sigma, fft_backend=default_fft_backend, workers=None):
+    '''
+    Read at most `steps` rows of the pressure tensor in chunks, and stop once the Green-Kubo
+    viscosity at the noise cutoff changed by less than `tolerance` (relative) since the previous
+    check. Checks are made each time the rows read grew by converge_growth, so the repeated
+    FFTs cost a small multiple of one FFT of the rows finally read. Returns the (6, rows) array.
+    '''
+    pressure = np.empty((6, steps), dtype=dtype)
+    rows, checked, previous = 0, 0, None
+
+    with stage("read_pressure"):
+        for block in iter_pressure_tensor(datafile, steps, unit, chunk_size, cache, cache_dir):
+            n = block.shape[1]
+            pressure[:, rows:rows + n] = block
+            rows += n
+            if rows < converge_growth * checked or rows < 4:
+                continue
+            checked = rows
+
+            with stage("converge"):
+                avg_acf, viscosity_gk = green_kubo(pressure[:, :rows], timestep, temperature, volume, diag,
+                                                   fft_backend, workers)
+                cutoff = int(noise_cutoff(avg_acf, rows, n_sigma, diag))
+            if cutoff < 0:
+                print(f"{rows} data points: the ACF has not reached its noise level yet")
+                continue
+
+            value = viscosity_gk[cutoff]
+            print(f"{rows} data points: Viscosity (Green-Kubo) {value * 1000:.4g} [mPa.s] "
+                  f"at the noise cutoff {cutoff * timestep:g} ps")
+            if previous is not None and abs(value - previous) <= tolerance * abs(value):
+                break
+            previous = value
+
+    return pressure[:, :rows]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Output directory of a pressure tensor file, e.g. Viscosity_Data/NVT1_stress_tensor_data
+def output_directory(datafile):
+    base_filename = os.path.splitext(os.path.basename(datafile))[0]  # Extract base name
+    return os.path.join("Viscosity_Data", f"{base_filename}_data")
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def output_files(output_format='csv'):
+    '''Names of the viscosity tables written in output_dir for the given output format.'''
+    return table_files("viscosity_GK", output_format) + table_files("viscosity_Einstein", output_format)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def write_outputs(result, output_dir, plot=False, output_format='csv', metadata=None, float32=False, compress=False,
+                  plot_workers=1):
+    '''
+    Save the output tables (and optionally the plots) of a ViscosityResult in output_dir.
+    output_format, float32 and compress select the storage (see viscosity_io.py); metadata
+    is the dict of run parameters stored in .npz files, completed with the method and `each`.
+    The plots are drawn by plot_workers processes (see plotting.render_figures()).
+    '''
+    Time, avg_acf, viscosity_gk, each = result.time, result.acf, result.green_kubo, result.each
+
+    # Einstein viscosity every `each` steps (see saved_curves())
+    einstein_time, viscosity_einstein = saved_curves(result)["Einstein"]
+    os.makedirs(output_dir, exist_ok=True)  # Create the directory if it doesn't exist
+
+    # Plot the running integrals of viscosity and the ACF
+    if plot:
+        # matplotlib is only loaded when plots are requested
+        import plotting
+        with stage("plot"):
+            plotting.render_figures([
+                ("plot_series", (einstein_time, viscosity_einstein * 1000, 'Viscosity (Einstein)', 'Viscosity (mPa.s)',
+                                 'Viscosity (Einstein) vs Time', os.path.join(output_dir, "viscosity_Einstein.png")), {}),
+                *green_kubo_figures(Time, avg_acf, viscosity_gk, output_dir),
+                *([] if result.bulk is None else [
+                    ("plot_series", (Time[:len(result.bulk)], result.bulk * 1000, 'Bulk viscosity (Green-Kubo)',
+                                     'Viscosity (mPa.s)', 'Bulk Viscosity (Green-Kubo) vs Time',
+                                     os.path.join(output_dir, "viscosity_bulk.png")), {})]),
+            ], plot_workers)
+
+    # Save the running integral of viscosity
+    storage = dict(output_format=output_format, float32=float32, compress=compress)
+    write_table(os.path.join(output_dir, "viscosity_Einstein"), {
+        "time(ps)": einstein_time,
+        "viscosity(Pa.s)": viscosity_einstein
+    }, metadata={**(metadata or {}), "method": "Einstein", "each": each}, **storage)
+
+    write_green_kubo(Time, avg_acf, viscosity_gk, each, output_dir, metadata=metadata, **storage)
+
+    if result.bulk is not None:
+        write_correlation_tables(Time, result.bulk_acf, result.bulk, each, output_dir, "bulk_acf", "viscosity_bulk",
+                                 "bulk", metadata=metadata, **storage)
+
+    # Normalized cross-correlations every `each` lags
+    if result.cross:
+        lags = len(next(iter(result.cross.values())))
+        write_table(os.path.join(output_dir, "cross_correlations"), {
+            "time(ps)": Time[:lags:each],
+            **{pair: values[::each] for pair, values in result.cross.items()}
+        }, metadata={**(metadata or {}), "method": "cross", "each": each}, **storage)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def green_kubo_figures(Time, avg_acf, viscosity_gk, output_dir):
+    '''Plots of the normalized average ACF and of the running Green-Kubo viscosity, as plotting.render_figures() jobs.'''
+    return [
+        ("plot_series", (Time[:len(avg_acf)], avg_acf / avg_acf[0], 'Normalized ACF (Green-Kubo)', 'Normalized ACF',
+                         'Auto-Correlation Function (Green-Kubo) vs Time', os.path.join(output_dir, "acf_plot.png")), {}),
+        ("plot_series", (Time[:len(viscosity_gk)], viscosity_gk * 1000, 'Viscosity (Green-Kubo)', 'Viscosity (mPa.s)',
+                         'Viscosity (Green-Kubo) vs Time', os.path.join(output_dir, "viscosity_GK.png")), {}),
+    ]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def write_green_kubo(Time, avg_acf, viscosity_gk, each, output_dir, plot=False, output_format='csv', metadata=None,
+                     float32=False, compress=False):
+    '''Save the avg_acf and viscosity_GK tables (and optionally their plots) in output_dir (see write_outputs()).'''
+    os.makedirs(output_dir, exist_ok=True)
+    if plot:
+        import plotting
+        with stage("plot"):
+            plotting.render_figures(green_kubo_figures(Time, avg_acf, viscosity_gk, output_dir), workers=1)
+
+    write_correlation_tables(Time, avg_acf, viscosity_gk, each, output_dir, "avg_acf", "viscosity_GK", "GK",
+                             output_format, metadata, float32, compress)
+
+
+def write_correlation_tables(Time, avg_acf, viscosity, each, output_dir, acf_name, viscosity_name, method,
+                             output_format='csv', metadata=None, float32=False, compress=False):
+    '''Save a normalized ACF and its running integral as the tables acf_name and viscosity_name.'''
+    norm_avg_acf = avg_acf / avg_acf[0]
+
+    # Save the normalized average ACF: every lag in the CSV file, every `each` lags in the compact .npz file
+    storage = dict(float32=float32, compress=compress)
+    metadata = {**(metadata or {}), "method": method, "each": each}
+    acf_path = os.path.join(output_dir, acf_name)
+    if output_format in ('csv', 'both'):
+        write_table(acf_path, {"time(ps)": Time[:len(norm_avg_acf)], "ACF": norm_avg_acf}, 'csv', **storage)
+    if output_format in ('npz', 'both'):
+        write_table(acf_path, {"time(ps)": Time[:len(norm_avg_acf):each], "ACF": norm_avg_acf[::each]}, 'npz',
+                    metadata, **storage)
+
+    # Save running integral of the viscosity
+    write_table(os.path.join(output_dir, viscosity_name), {
+        "time(ps)": Time[:len(viscosity):each],  # Actual time points
+        "viscosity(Pa.s)": viscosity[::each]    # Corresponding viscosity values
+    }, output_format, metadata, **storage)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Command line interface: read the file, calculate and save the results for parsed arguments.
+# Raises PressureDataError for invalid input so that callers (e.g. the batch driver
+# in generate_visc_data_all_files.py) can carry on with other files.
+def run(args):
+    if args.profile:
+        enable_profiling()
+    with profile_run("viscosity_calculation", os.path.splitext(os.path.basename(args.datafile))[0]):
+        return _run(args)
+
+
+def _run(args):
+    # Read the pressure tensor elements from CSV file in chunks (see pressure_io.py)
+    print('\nReading the pressure tensor data file with Pandas')
+
+    dtype = np.float32 if args.float32 else np.float64
+    if args.converge is not None:
+        P = load_until_converged(args.datafile, args.steps, args.timestep, args.temperature, args.volume,
+                                 args.converge, unit=args.unit, dtype=dtype, chunk_size=args.chunk_size,
+                                 cache=args.cache, cache_dir=args.cache_dir, diag=args.diag,
+                                 n_sigma=args.noise_sigma, fft_backend=args.fft_backend, workers=args.workers)
+    else:
+        P = load_pressure_tensor(args.datafile, args.steps, unit=args.unit, dtype=dtype, chunk_size=args.chunk_size,
+                                 cache=args.cache, cache_dir=args.cache_dir)
+
+    print(f"Number of data points read: {P.shape[1]}")
+    print(f"Total simulation time: {P.shape[1] * args.timestep} ps")
+
+    with stage("calculate"):
+        result = calculate_viscosity(P, args.timestep, args.temperature, args.volume, diag=args.diag,
+                                     fft_backend=args.fft_backend, workers=args.workers, each=args.each,
+                                     origins=args.einstein_origins, max_lag=args.max_lag, cutoff=args.cutoff,
+                                     n_sigma=args.noise_sigma, bulk=args.bulk, cross=args.cross)
+
+    print(f"\nViscosity (Einstein): {round((result.einstein[-1] * 1000), 2)} [mPa.s]")
+    print(f"Viscosity (Green-Kubo): {round((result.green_kubo[-1] * 1000), 2)} [mPa.s]")
+    if result.gk_cutoff is not None:
+        print(f"(Green-Kubo integral up to the noise cutoff at {result.gk_cutoff * args.timestep:g} ps)")
+    if result.bulk is not None:
+        print(f"Bulk viscosity (Green-Kubo): {round((result.bulk[-1] * 1000), 2)} [mPa.s]")
+    for pair, values in (result.cross or {}).items():
+        print(f"Cross-correlation {pair} at t = 0: {values[0]:.3f}")
+    print("Note: Do not trust these values! You should fit an exponential function to the running integral and take its limit.")
+
+    # Run parameters stored with the .npz outputs
+    metadata = {"datafile": os.path.basename(args.datafile), "steps": P.shape[1], "timestep": args.timestep,
+                "temperature": args.temperature, "volume": args.volume, "unit": args.unit, "diag": args.diag,
+                "einstein_origins": args.einstein_origins, "precision": "float32" if args.output_float32 else "float64",
+                "gk_cutoff": result.gk_cutoff, "bulk_cutoff": result.bulk_cutoff}
+    with stage("write_outputs"):
+        write_outputs(result, output_directory(args.datafile), plot=args.plot and not args.no_plots,
+                      output_format=args.output_format, metadata=metadata, float32=args.output_float32,
+                      compress=args.compress, plot_workers=args.plot_workers)
+    return result
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def main(argv=None):
+    args = parser(argv)
+
+    try:
+        run(args)
+    except PressureDataError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
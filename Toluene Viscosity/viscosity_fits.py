@@ -0,0 +1,247 @@
+# --------------------------------------------------------------------------------------------
+
+# Fit models of the running viscosity.
+
+# The running Einstein or Green-Kubo integral is fitted with a double exponential
+# whose limit t -> infinity, A*a*T1 + A*(1-a)*T2, is the viscosity estimate. Time is in ns
+# and viscosity in Pa.s, as in the std_*.csv files.
+
+# All fits use the analytic Jacobian. fit_batch() fits many independent curves on the same
+# time grid (e.g. bootstrap replicates or trajectories) together with a vectorized
+# Levenberg-Marquardt iteration; fit_many() adds a process pool and a scipy fallback, and
+# scan_t_cut() warm-starts the fits at each t_cut from those at the previous one.
+# Failed fits are flagged (converged=False, NaN parameters) instead of raising.
+# check_fits.py compares the batch fits with curve_fit on std_*.csv.
+
+# -------------------------------------------------------------------------------------------
+
+import warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import curve_fit, OptimizeWarning
+
+# Starting point [A, a, T1, T2] of the double exponential fit
+initial_guess = [0.0003, 0.5, 0.001, 0.001]
+
+# Fewest time points a fit of the four parameters is attempted with
+min_fit_points = 4
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def double_exponential(t, A, a, T1, T2):
+    return A*a*T1*(1 - np.exp(-t / T1)) + A*(1 - a)*T2*(1 - np.exp(-t / T2))
+
+
+def double_exponential_limit(params):
+    '''Viscosity for t -> infinity of the double exponential; params has shape (..., 4).'''
+    A, a, T1, T2 = np.moveaxis(np.asarray(params), -1, 0)
+    return A*a*T1 + A*(1 - a)*T2
+
+
+def double_exponential_jacobian(t, A, a, T1, T2):
+    '''Analytic derivatives of double_exponential with respect to (A, a, T1, T2), shape (..., len(t), 4).'''
+    t = np.asarray(t)
+    e1, e2 = np.exp(-t / T1), np.exp(-t / T2)
+    return np.stack([
+        a*T1*(1 - e1) + (1 - a)*T2*(1 - e2),
+        A*T1*(1 - e1) - A*T2*(1 - e2),
+        A*a*((1 - e1) - t / T1 * e1),
+        A*(1 - a)*((1 - e2) - t / T2 * e2),
+    ], axis=-1)
+
+
+def _basis(t, T1, T2, weight):
+    # The model and its Jacobian are linear combinations of 1-e1, 1-e2, t*e1 and t*e2,
+    # with e_i = exp(-t/T_i); returned with the fit weights applied, shape (K, 4, len(t))
+    e1, e2 = np.exp(-t / T1[:, None]), np.exp(-t / T2[:, None])
+    B = np.empty((len(T1), 4, len(t)))
+    np.subtract(1, e1, out=B[:, 0])
+    np.subtract(1, e2, out=B[:, 1])
+    np.multiply(t, e1, out=B[:, 2])
+    np.multiply(t, e2, out=B[:, 3])
+    if weight is not None:
+        B *= weight[:, None, :]
+    return B
+
+
+def _coefficients(p):
+    # Rows: derivatives with respect to A, a, T1, T2 and the model itself, in terms of _basis()
+    A, a, T1, T2 = p.T
+    zero = np.zeros_like(A)
+    return np.stack([
+        np.stack([a*T1, (1 - a)*T2, zero, zero], axis=-1),
+        np.stack([A*T1, -A*T2, zero, zero], axis=-1),
+        np.stack([A*a, zero, -A*a/T1, zero], axis=-1),
+        np.stack([zero, A*(1 - a), zero, -A*(1 - a)/T2], axis=-1),
+        np.stack([A*a*T1, A*(1 - a)*T2, zero, zero], axis=-1),
+    ], axis=1)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def fit_double_exponential(time, visc, p0=initial_guess):
+    '''Fit one curve; returns (params, converged). Failed fits return NaN parameters.'''
+    try:
+        with warnings.catch_warnings(), np.errstate(over="ignore", invalid="ignore"):
+            warnings.simplefilter("ignore", OptimizeWarning)
+            params, _ = curve_fit(double_exponential, time, visc, p0=p0, jac=double_exponential_jacobian)
+    except (RuntimeError, ValueError, TypeError):
+        return np.full(4, np.nan), False
+    return params, bool(np.all(np.isfinite(params)))
+
+
+def fit_batch(time, curves, p0=initial_guess, n_points=None, max_iter=200, tol=1.49012e-08):
+    '''
+    Fit all rows of curves (shape (K, len(time))) at once with a vectorized Levenberg-Marquardt
+    iteration: the residuals, analytic Jacobians and 4x4 normal equations of every curve are
+    evaluated as stacked arrays, each curve with its own damping. p0 has shape (4,) or (K, 4);
+    n_points (K,) optionally limits each fit to the first n_points time points (e.g. t_cut rows).
+    A fit has converged when the actual and predicted relative reductions of the sum of squares
+    are both below tol (as ftol of MINPACK) and the residual is orthogonal to the Jacobian
+    within sqrt(tol) (as gtol), and if the result is physical: T1, T2 > 0 and 0 <= a <= 1.
+    Returns (params of shape (K, 4), converged of shape (K,)); unconverged fits are NaN.
+    '''
+    time = np.asarray(time, dtype=float)
+    curves = np.asarray(curves, dtype=float)
+    K = len(curves)
+
+    params = np.array(np.broadcast_to(p0, (K, 4)), dtype=float)
+    # The model is symmetric in (a, T1) <-> (1-a, T2): with T1 == T2 the Jacobian is singular
+    # and a symmetric iteration never leaves that line, so split equal time constants
+    equal = np.isclose(params[:, 2], params[:, 3])
+    params[equal, 2] *= 0.5
+    params[equal, 3] *= 2.0
+
+    weight = None
+    if n_points is not None:
+        weight = (np.arange(len(time)) < np.broadcast_to(n_points, K)[:, None]).astype(float)
+        curves = curves * weight
+
+    damping = np.full(K, 1e-3)
+    growth = np.full(K, 2.0)
+    converged = np.zeros(K, dtype=bool)
+
+    with np.errstate(over="ignore", invalid="ignore", divide="ignore"):
+        basis = _basis(time, params[:, 2], params[:, 3], weight)
+        residual = np.matmul(_coefficients(params)[:, 4:], basis)[:, 0] - curves
+        cost = np.einsum("kn,kn->k", residual, residual)
+        active = np.isfinite(cost)
+
+        for _ in range(max_iter):
+            idx = np.flatnonzero(active)
+            if len(idx) == 0:
+                break
+            # Plain slices instead of fancy indexing (copies) while all fits are still running
+            rows = slice(None) if len(idx) == K else idx
+            p = params[rows]
+
+            # Normal equations J^T J = C (B B^T) C^T and gradient J^T r = C (B r)
+            C = _coefficients(p)[:, :4]
+            B = basis[rows]
+            H = C @ np.matmul(B, B.transpose(0, 2, 1)) @ C.transpose(0, 2, 1)
+            g = (C @ np.matmul(B, residual[rows, :, None]))[..., 0]
+            del B
+
+            # Marquardt scaling of the damping by the diagonal of J^T J
+            M = H + damping[idx, None, None] * np.maximum(np.einsum("kii->ki", H), 1e-300)[:, None, :] * np.eye(4)
+            try:
+                step = -np.linalg.solve(M, g[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                step = -(np.linalg.pinv(M) @ g[..., None])[..., 0]
+
+            trial = p + step
+            trial_basis = _basis(time, trial[:, 2], trial[:, 3], None if weight is None else weight[rows])
+            r = np.matmul(_coefficients(trial)[:, 4:], trial_basis)[:, 0] - curves[rows]
+            trial_cost = np.einsum("kn,kn->k", r, r)
+
+            # Gain ratio of the actual to the predicted reduction of the sum of squares
+            actual = cost[rows] - trial_cost
+            predicted = -(2 * np.einsum("ki,ki->k", step, g) + np.einsum("ki,kij,kj->k", step, H, step))
+            gain = actual / predicted
+            better = np.isfinite(trial_cost) & (actual >= 0) & (gain > 0)
+
+            # Nielsen's damping update
+            accepted, rejected = idx[better], idx[~better]
+            damping[accepted] *= np.maximum(1 / 3, 1 - (2 * gain[better] - 1)**3)
+            growth[accepted] = 2.0
+            damping[rejected] *= growth[rejected]
+            growth[rejected] *= 2
+
+            # Converged when the relative reductions of the sum of squares are below tol and, so
+            # that a fit stalled by a large damping is not mistaken for a minimum, the gradient is
+            # negligible too: the largest cosine between the residual and a Jacobian column (gtol
+            # test of MINPACK) must be below sqrt(tol)
+            cosine = np.max(np.abs(g) / np.sqrt(np.einsum("kii->ki", H) * cost[rows, None]), axis=1)
+            done = ((actual[better] <= tol * cost[accepted]) & (np.abs(predicted[better]) <= tol * cost[accepted])
+                    & (cosine[better] <= np.sqrt(tol)))
+            params[accepted] = trial[better]
+            if len(accepted) == K:
+                basis, residual = trial_basis, r
+            else:
+                basis[accepted] = trial_basis[better]
+                residual[accepted] = r[better]
+            cost[accepted] = trial_cost[better]
+            del trial_basis
+
+            converged[accepted[done]] = True
+            active[accepted[done]] = False
+            active[rejected[~np.isfinite(damping[rejected]) | (damping[rejected] > 1e16)]] = False
+
+    # Four parameters need at least four points; time constants must be positive and the
+    # weight a in [0, 1], anything else is left to the scipy fallback of fit_many()
+    A, a, T1, T2 = params.T
+    converged &= np.all(np.isfinite(params), axis=1) & (T1 > 0) & (T2 > 0) & (a >= 0) & (a <= 1)
+    converged &= np.broadcast_to(len(time) if n_points is None else n_points, K) >= min_fit_points
+    params[~converged] = np.nan
+    return params, converged
+
+
+def _fit_block(time, curves, p0, n_points):
+    # Vectorized fit of the whole block; fits that did not converge are retried one by one
+    params, converged = fit_batch(time, curves, p0, n_points)
+    p0 = np.broadcast_to(p0, (len(curves), 4))
+    for i in np.flatnonzero(~converged):
+        n = len(time) if n_points is None else n_points[i]
+        params[i], converged[i] = fit_double_exponential(time[:n], curves[i, :n], p0[i])
+    return params, converged
+
+
+def fit_many(time, curves, p0=initial_guess, jobs=1, n_points=None):
+    '''
+    Fit every row of curves (shape (K, len(time))) with the double exponential.
+    Returns (params of shape (K, 4), converged of shape (K,)). The rows are fitted together by
+    fit_batch(); with jobs > 1 they are split into contiguous blocks fitted in parallel processes.
+    p0 and n_points are as for fit_batch().
+    '''
+    time = np.asarray(time, dtype=float)
+    curves = np.asarray(curves, dtype=float)
+    p0 = np.broadcast_to(np.asarray(p0, dtype=float), (len(curves), 4))
+    n_points = None if n_points is None else np.broadcast_to(n_points, len(curves))
+    if jobs <= 1 or len(curves) < 2:
+        return _fit_block(time, curves, p0, n_points)
+
+    blocks = np.array_split(np.arange(len(curves)), min(jobs, len(curves)))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(_fit_block, [time] * len(blocks), [curves[b] for b in blocks],
+                                    [p0[b] for b in blocks],
+                                    [None if n_points is None else n_points[b] for b in blocks]))
+
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+def scan_t_cut(time, curves, t_cuts, p0=initial_guess, jobs=1):
+    '''
+    Fit every curve up to each of the t_cut rows in t_cuts (sorted ascending).
+    The fits at one t_cut start from the solutions at the previous one (warm start).
+    Returns (params of shape (len(t_cuts), K, 4), converged of shape (len(t_cuts), K)).
+    '''
+    curves = np.atleast_2d(np.asarray(curves, dtype=float))
+    K = len(curves)
+    params = np.empty((len(t_cuts), K, 4))
+    converged = np.empty((len(t_cuts), K), dtype=bool)
+
+    start = np.array(np.broadcast_to(p0, (K, 4)), dtype=float)
+    for i, t_cut in enumerate(t_cuts):
+        params[i], converged[i] = fit_many(time[:t_cut], curves[:, :t_cut], start, jobs)
+        start[converged[i]] = params[i][converged[i]]
+
+    return params, converged
@@ -0,0 +1,111 @@
+# --------------------------------------------------------------------------------------------
+
+# Storage of the per-trajectory outputs of viscosity_calculation.py
+
+# Every table (viscosity_GK, viscosity_Einstein, avg_acf) is written as a CSV file, as a
+# NumPy .npz file, or both. An .npz file holds one array per CSV column under the same
+# column name (e.g. "time(ps)" and "viscosity(Pa.s)") plus a "metadata" entry with the
+# parameters of the run (timestep, temperature, volume, unit, method, each, ...) as JSON.
+# The values can be stored in single precision (time stays double precision, so the time
+# grids of all trajectories still match exactly) and deflate-compressed.
+
+# read_table() reads either format, so the aggregation and plot scripts never depend on
+# which one was written; find_table() picks the newer file if both exist. Running this
+# module exports .npz tables to CSV:  python viscosity_io.py Viscosity_Data/*/*.npz
+
+# -------------------------------------------------------------------------------------------
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from instrumentation import stage
+
+# Formats of the per-trajectory output tables
+output_formats = ['csv', 'npz', 'both']
+
+# File extension of each storage format
+extensions = {'csv': '.csv', 'npz': '.npz'}
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def table_files(name, output_format='csv'):
+    '''File names written for the table `name` (without extension) in the given output format.'''
+    formats = ['csv', 'npz'] if output_format == 'both' else [output_format]
+    return [name + extensions[fmt] for fmt in formats]
+
+
+def write_table(path, columns, output_format='csv', metadata=None, float32=False, compress=False):
+    '''
+    Write the {column name: array} table `columns` to `path` (without extension) as CSV and/or .npz.
+    The first column is the time axis and is always kept in double precision.
+    '''
+    names = list(columns)
+    arrays = {name: np.asarray(values) for name, values in columns.items()}
+    if float32:
+        for name in names[1:]:
+            arrays[name] = arrays[name].astype(np.float32)
+
+    if output_format in ('csv', 'both'):
+        with stage("write_csv"):
+            pd.DataFrame(arrays).to_csv(path + extensions['csv'], index=False)
+
+    if output_format in ('npz', 'both'):
+        # Written to a temporary file first, so readers never see a partial file
+        with stage("write_npz"):
+            tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+            save = np.savez_compressed if compress else np.savez
+            save(tmp_path, metadata=np.array(json.dumps(metadata or {})), **arrays)
+            os.replace(tmp_path, path + extensions['npz'])
+
+
+def read_table(path, columns=None):
+    '''{column name: float64 array} of a CSV or .npz table; only `columns` if given.'''
+    with stage("read_table"):
+        if path.endswith(extensions['npz']):
+            with np.load(path) as table:
+                names = columns if columns is not None else [key for key in table.files if key != "metadata"]
+                return {name: table[name].astype(np.float64) for name in names}
+
+        df = pd.read_csv(path, usecols=columns, dtype=np.float64)
+        return {name: df[name].to_numpy() for name in df.columns}
+
+
+def read_metadata(path):
+    '''Run parameters stored in an .npz table ({} for CSV files or files without metadata).'''
+    if not path.endswith(extensions['npz']):
+        return {}
+    with np.load(path) as table:
+        return json.loads(str(table["metadata"])) if "metadata" in table.files else {}
+
+
+def find_table(directory, name):
+    '''Path of the table `name` in directory (.npz or .csv, the newer one if both exist), or None.'''
+    candidates = [os.path.join(directory, name + ext) for ext in extensions.values()]
+    candidates = [path for path in candidates if os.path.isfile(path)]
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def export_csv(path):
+    '''Write the CSV file next to the .npz table `path`; returns the CSV path.'''
+    csv_path = os.path.splitext(path)[0] + extensions['csv']
+    pd.DataFrame(read_table(path)).to_csv(csv_path, index=False)
+    return csv_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export .npz viscosity tables to CSV files next to them.')
+    parser.add_argument('files', nargs='+', help='.npz tables, e.g. Viscosity_Data/*/viscosity_GK.npz')
+    args = parser.parse_args(argv)
+
+    for path in args.files:
+        metadata = read_metadata(path)
+        print(f"{export_csv(path)}" + (f" ({', '.join(f'{k}={v}' for k, v in metadata.items())})" if metadata else ""))
+
+
+if __name__ == "__main__":
+    main()